@@ -1,38 +1,136 @@
 import collections
+import contextlib
 import glob
+import itertools
 import json
-from typing import Dict, List, Tuple, cast
+import os
+import threading
+from typing import Container, Dict, Iterator, List, Tuple, cast
 
 import duckdb
-import pymupdf
+import numpy
+import pandas
+import structlog
 
-from models import Invoice, InvoiceDenormalized
+from caching import cache_path, file_sha256
+from corpus_index import get_corpus_index
+from models import (
+    INVOICE_HEADER_FIELDS,
+    INVOICE_LINE_ITEM_FIELDS,
+    Invoice,
+    InvoiceBatch,
+    InvoiceDenormalized,
+    InvoiceLineItem,
+    LazyInvoice,
+)
+
+logger = structlog.stdlib.get_logger()
 
 INFIX_INVOICES_MANUAL_EXTRACT_INFO = (
     "2024-07-01_Prod_Infinx_Invoices_2024-6-3to17_AllInfo_v2.json"
 )
 PDFS_FOR_COMPARISON_DIR = "2024-06-20_AI_Testing_3"
+# Rows per Arrow record batch when decoding the manifest
+RECORD_BATCH_ROWS = 64 * 1024
 
 
-def load_pdfs_and_manual_extraction() -> (
-    Tuple[duckdb.DuckDBPyConnection, Dict[str, Invoice], List[str]]
-):
-    # Create an in-memory DuckDB connection
-    con = duckdb.connect(database=":memory:")
+def _arrow_available() -> bool:
+    # DuckDB only returns record batches with the optional `pyarrow` package
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return False
+    return True
 
-    # Execute the query to load the data
-    con.execute(
-        f"""
-        CREATE TABLE prod_data AS 
-        SELECT * FROM read_json_auto('{INFIX_INVOICES_MANUAL_EXTRACT_INFO}')
+
+def record_batches(cursor: duckdb.DuckDBPyConnection, rows_per_batch: int):
+    """Arrow record batch reader over the cursor's result."""
+    # Newer DuckDB releases renamed `fetch_record_batch`
+    to_arrow_reader = getattr(cursor, "to_arrow_reader", None)
+    if to_arrow_reader is not None:
+        return to_arrow_reader(rows_per_batch)
+    return cursor.fetch_record_batch(rows_per_batch)
+
+
+def _manifest_cache_key(manifest_path: str) -> str:
+    """Returns the content hash of the manifest, only re-hashing it when its size or
+    mtime differ from the last time it was seen."""
+    stat = os.stat(manifest_path)
+    meta_path = cache_path("manifest", os.path.basename(manifest_path) + ".meta.json")
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+    if meta.get("size") == stat.st_size and meta.get("mtime_ns") == stat.st_mtime_ns:
+        return meta["sha256"]
+
+    sha256 = file_sha256(manifest_path)
+    with open(meta_path, "w") as f:
+        json.dump(
+            {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": sha256}, f
+        )
+    return sha256
+
+
+def load_manifest(
+    con: duckdb.DuckDBPyConnection,
+    manifest_path: str = INFIX_INVOICES_MANUAL_EXTRACT_INFO,
+    use_cache: bool = True,
+) -> None:
+    """Creates the `prod_data` table from the manual extraction JSON.
+
+    Schema inference with `read_json_auto` on the full export dominates startup, so
+    the parsed table is cached as Parquet under `CACHE_DIR`, keyed by the JSON's size,
+    mtime and content hash, and later loads read the Parquet file instead.
     """
+    if not use_cache:
+        con.execute(
+            f"""
+            CREATE TABLE prod_data AS 
+            SELECT * FROM read_json_auto('{manifest_path}')
+        """
+        )
+        return
+
+    parquet_path = cache_path(
+        "manifest", f"{_manifest_cache_key(manifest_path)}.parquet"
     )
+    if os.path.exists(parquet_path):
+        logger.debug("loading cached manifest", parquet_path=parquet_path)
+        con.execute(
+            f"CREATE TABLE prod_data AS SELECT * FROM read_parquet('{parquet_path}')"
+        )
+        return
 
+    logger.info(
+        "parsing manifest", manifest_path=manifest_path, parquet_path=parquet_path
+    )
+    load_manifest(con, manifest_path, use_cache=False)
+    # Write to a temporary file first so a concurrent or interrupted run never sees a
+    # partial cache entry
+    tmp_path = f"{parquet_path}.{os.getpid()}.tmp"
+    con.execute(f"COPY prod_data TO '{tmp_path}' (FORMAT PARQUET)")
+    os.replace(tmp_path, parquet_path)
+
+
+def _glob_pdf_files(pdfs_dir: str) -> List[Tuple[str, str]]:
+    """Returns `(file_path, OriginalMessageItemId)` for every file in the comparison tree."""
+    files = []
+    for file_path in sorted(glob.glob(f"{pdfs_dir}/*/*/*")):
+        # dir1 is "message id" which is not in the JSON (note from Chris's slack on 2024-07-01)
+        dir1, og_msg_item_id, file = file_path.split("/")[-3:]
+        files.append((file_path, og_msg_item_id))
+    return files
+
+
+def _load_per_file(
+    con: duckdb.DuckDBPyConnection, files: List[Tuple[str, str]]
+) -> Tuple[Dict[str, Invoice], List[str]]:
+    """Original ingestion path which scans `prod_data` once per file. Kept around as
+    the reference implementation for `_load_bulk`."""
     pdfs_with_manual_extractions = collections.OrderedDict[str, Invoice]()
     missing_item_ids = []
-    for file_path in sorted(glob.glob(f"{PDFS_FOR_COMPARISON_DIR}/*/*/*")):
-        # dir1 is "message id" which is not in the JSON (note from Chris's slack on 2024-07-01)
-        _, dir1, og_msg_item_id, file = file_path.split("/")
+    for file_path, og_msg_item_id in files:
         query = (
             f"SELECT * FROM prod_data WHERE OriginalMessageItemId = '{og_msg_item_id}'"
         )
@@ -43,6 +141,202 @@ def load_pdfs_and_manual_extraction() -> (
         else:
             invoice = Invoice.from_denormalized(items, file_path)
             pdfs_with_manual_extractions[og_msg_item_id] = invoice
+    return pdfs_with_manual_extractions, missing_item_ids
+
+
+@contextlib.contextmanager
+def _joined_manifest_rows(
+    con: duckdb.DuckDBPyConnection,
+    files: List[Tuple[str, str]],
+    columns: str = "prod_data.*",
+    first_row_only: bool = False,
+) -> Iterator[Tuple[duckdb.DuckDBPyConnection, Dict[str, str]]]:
+    """Joins the file list against `prod_data` in a single query, instead of one full
+    scan of the (unindexed) table per file.
+
+    Yields the cursor over the matching rows, ordered by the first file that references
+    their invoice and then by manifest order, and the last file path per item id. With
+    `first_row_only`, only the first row of each invoice is returned.
+    """
+    file_index_by_id: Dict[str, int] = {}
+    file_path_by_id: Dict[str, str] = {}
+    for i, (file_path, og_msg_item_id) in enumerate(files):
+        file_index_by_id.setdefault(og_msg_item_id, i)
+        file_path_by_id[og_msg_item_id] = file_path
+
+    pdf_files = pandas.DataFrame(
+        {
+            "og_msg_item_id": list(file_index_by_id.keys()),
+            "file_index": list(file_index_by_id.values()),
+        }
+    )
+    con.register("pdf_files", pdf_files)
+    try:
+        qualify = (
+            """
+            QUALIFY row_number() OVER (
+                PARTITION BY prod_data.OriginalMessageItemId ORDER BY prod_data.rowid
+            ) = 1
+        """
+            if first_row_only
+            else ""
+        )
+        cursor = con.execute(
+            f"""
+            SELECT {columns} FROM prod_data
+            JOIN pdf_files
+                ON CAST(prod_data.OriginalMessageItemId AS VARCHAR) = pdf_files.og_msg_item_id
+            {qualify}
+            ORDER BY pdf_files.file_index, prod_data.rowid
+        """
+        )
+        yield cursor, file_path_by_id
+    finally:
+        con.unregister("pdf_files")
+
+
+def _missing_item_ids(files: List[Tuple[str, str]], found: Container[str]) -> List[str]:
+    return [
+        og_msg_item_id for _, og_msg_item_id in files if og_msg_item_id not in found
+    ]
+
+
+def _load_bulk(
+    con: duckdb.DuckDBPyConnection, files: List[Tuple[str, str]]
+) -> Tuple[Dict[str, Invoice], List[str]]:
+    """Produces the same output as `_load_per_file` from a single query: invoices are
+    ordered by the first file that references them, keep the path of the last such
+    file, and line items are kept in manifest order.
+    """
+    pdfs_with_manual_extractions = collections.OrderedDict[str, Invoice]()
+    with _joined_manifest_rows(con, files) as (cursor, file_path_by_id):
+        if _arrow_available():
+            invoices = Invoice.from_record_batches(
+                record_batches(cursor, RECORD_BATCH_ROWS), file_path_by_id
+            )
+        else:
+            invoices = (
+                Invoice.from_denormalized(list(items), file_path_by_id[og_msg_item_id])
+                for og_msg_item_id, items in itertools.groupby(
+                    InvoiceDenormalized.from_db_cursor(cursor),
+                    key=lambda item: str(item.OriginalMessageItemId),
+                )
+            )
+        for invoice in invoices:
+            pdfs_with_manual_extractions[str(invoice.OriginalMessageItemId)] = invoice
+    return pdfs_with_manual_extractions, _missing_item_ids(
+        files, pdfs_with_manual_extractions
+    )
+
+
+def load_invoice_batch(
+    manifest_path: str = INFIX_INVOICES_MANUAL_EXTRACT_INFO,
+    pdfs_dir: str = PDFS_FOR_COMPARISON_DIR,
+    use_cache: bool = True,
+) -> Tuple[duckdb.DuckDBPyConnection, InvoiceBatch, List[str]]:
+    """Columnar counterpart of `load_pdfs_and_manual_extraction`, for holding the whole
+    manifest in memory. `batch[i]` is the i-th invoice the latter returns."""
+    con = duckdb.connect(database=":memory:")
+    load_manifest(con, manifest_path, use_cache=use_cache)
+    files = _glob_pdf_files(pdfs_dir)
+    with _joined_manifest_rows(con, files) as (cursor, file_path_by_id):
+        columns = cast(Dict[str, numpy.ndarray], cursor.fetchnumpy())
+        batch = InvoiceBatch.from_denormalized_columns(columns, file_path_by_id)
+    return con, batch, _missing_item_ids(files, set(batch.item_ids()))
+
+
+class LineItemStore:
+    """Fetches the line items of single invoices from `prod_data` on demand.
+
+    The first fetch copies the line item columns into a table sorted and indexed by
+    item id, so each later fetch is an index lookup rather than a full table scan. It
+    uses its own cursor, so fetches don't interrupt a result being streamed from the
+    connection it was created with.
+    """
+
+    def __init__(self, con: duckdb.DuckDBPyConnection):
+        self._con = con.cursor()
+        self._lock = threading.Lock()
+        self._prepared = False
+
+    def _prepare(self) -> None:
+        columns = ", ".join(INVOICE_LINE_ITEM_FIELDS)
+        self._con.execute(
+            f"""
+            CREATE TABLE invoice_line_items AS
+            SELECT
+                CAST(OriginalMessageItemId AS VARCHAR) AS item_id,
+                rowid AS manifest_row,
+                ContactType,
+                {columns}
+            FROM prod_data
+            ORDER BY item_id, manifest_row
+        """
+        )
+        self._con.execute(
+            "CREATE INDEX invoice_line_items_item_id ON invoice_line_items (item_id)"
+        )
+        self._prepared = True
+
+    def line_items(self, og_msg_item_id: str) -> List[InvoiceLineItem]:
+        with self._lock:
+            if not self._prepared:
+                self._prepare()
+            rows = self._con.execute(
+                f"""
+                SELECT ContactType, {", ".join(INVOICE_LINE_ITEM_FIELDS)}
+                FROM invoice_line_items
+                WHERE item_id = ?
+                ORDER BY manifest_row
+            """,
+                [og_msg_item_id],
+            ).fetchall()
+        return [InvoiceLineItem(*row[1:]) for row in rows if row[0] != 5]
+
+
+def iter_lazy_invoices(
+    manifest_path: str = INFIX_INVOICES_MANUAL_EXTRACT_INFO,
+    pdfs_dir: str = PDFS_FOR_COMPARISON_DIR,
+    use_cache: bool = True,
+) -> Iterator[LazyInvoice]:
+    """Lazy counterpart of `load_pdfs_and_manual_extraction`, yielding the same
+    invoices in the same order as lightweight handles as soon as their headers are
+    read. Line items are only fetched when a handle's `line_items`, `to_extracted()`
+    or `load()` is used."""
+    con = duckdb.connect(database=":memory:")
+    load_manifest(con, manifest_path, use_cache=use_cache)
+    store = LineItemStore(con)
+    columns = ", ".join(f"prod_data.{name}" for name in INVOICE_HEADER_FIELDS)
+    with _joined_manifest_rows(
+        con, _glob_pdf_files(pdfs_dir), columns, first_row_only=True
+    ) as (cursor, file_path_by_id):
+        while rows := cursor.fetchmany(256):
+            for row in rows:
+                header = dict(zip(INVOICE_HEADER_FIELDS, row))
+                yield LazyInvoice(
+                    header,
+                    file_path_by_id[str(header["OriginalMessageItemId"])],
+                    store.line_items,
+                )
+
+
+def load_pdfs_and_manual_extraction(
+    manifest_path: str = INFIX_INVOICES_MANUAL_EXTRACT_INFO,
+    pdfs_dir: str = PDFS_FOR_COMPARISON_DIR,
+    bulk: bool = True,
+    use_cache: bool = True,
+) -> Tuple[duckdb.DuckDBPyConnection, Dict[str, Invoice], List[str]]:
+    # Create an in-memory DuckDB connection
+    con = duckdb.connect(database=":memory:")
+
+    # Execute the query to load the data
+    load_manifest(con, manifest_path, use_cache=use_cache)
+
+    files = _glob_pdf_files(pdfs_dir)
+    if bulk:
+        pdfs_with_manual_extractions, missing_item_ids = _load_bulk(con, files)
+    else:
+        pdfs_with_manual_extractions, missing_item_ids = _load_per_file(con, files)
 
     return con, pdfs_with_manual_extractions, missing_item_ids
 
@@ -72,24 +366,30 @@ if __name__ == "__main__":
         first_valid_item = pdfs_with_manual_extractions[first_valid_item_key]
         print(f"First item (OriginalMessageItemId: {first_valid_item_key}):")
         print(f"Number of line items for the entry: {len(first_valid_item.line_items)}")
-        print(json.dumps(first_valid_item.to_dict(), indent=4))
+        print(json.dumps(first_valid_item.to_dict(), indent=4, default=str))
         # TBD: we now have the raw validation data to start the new LLM's pipeline around Invoice.file_path.
         # TBD: we also need to figure out performance of this existing pipeline, which means ingesting data from Chris's folder and comparing it against the .json.
     else:
         print("No valid items found.")
 
+    # Page counts come from the corpus index, which only opens new or changed PDFs
+    pdf_paths = [
+        file_path
+        for file_path, _ in _glob_pdf_files(PDFS_FOR_COMPARISON_DIR)
+        if file_path.endswith(".pdf")
+    ]
+    pdf_infos = get_corpus_index().update(pdf_paths)
     page_count_dict = collections.defaultdict(int)
     page_paths_dict = collections.defaultdict(list)
-    for file_path in glob.glob(f"{PDFS_FOR_COMPARISON_DIR}/*/*/*"):
-        if file_path.endswith(".pdf"):
-            doc = pymupdf.open(file_path)
-            num_pages = len(doc)
-            page_count_dict[num_pages] += 1
-            if num_pages > 10:
-                page_paths_dict[num_pages].append(file_path)
+    for info in pdf_infos.values():
+        page_count_dict[info.page_count] += 1
+        if info.page_count > 10:
+            page_paths_dict[info.page_count].append(info.file_path)
     print("Number of documents for each page length:")
     for num_pages, count in sorted(page_count_dict.items()):
         print(f"\t{num_pages} pages: {count} document(s)")
         if num_pages > 10:
             for path in page_paths_dict[num_pages]:
                 print(f"\t\t{path}")
+    scanned = sum(not info.has_text_layer for info in pdf_infos.values())
+    print(f"Documents without a full text layer (scanned): {scanned}")
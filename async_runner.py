@@ -0,0 +1,405 @@
+import asyncio
+import base64
+import json
+import random
+import time
+from typing import (
+    AsyncIterator,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    NamedTuple,
+    Optional,
+    Protocol,
+    Set,
+    Tuple,
+    Union,
+)
+
+import openai
+import structlog
+from openai.types.chat import ChatCompletion
+
+from instrumentation import REQUEST, stage
+from openai_client import ClientConfig, create_async_client, with_pool_size
+from rasterize import image_dimensions, image_tokens
+from response_cache import CACHED_RESPONSE_ID, get_response_cache
+from scoring import FieldCounts
+from streaming import (
+    ChunkAccumulator,
+    Completed,
+    ExtractionStreamParser,
+    StreamEvent,
+    tool_arguments,
+)
+from tool_schema import TOOLS, TOOLS_JSON
+
+logger = structlog.stdlib.get_logger()
+
+# Rough token cost of a letter-size page image, for images of unknown dimensions
+IMAGE_TOKENS_ESTIMATE = 765
+# Reserved against the token budget for the response until the real usage is known
+COMPLETION_TOKENS_ESTIMATE = 1_000
+
+
+class ExtractionBackend(Protocol):
+    """Implemented by the extraction modules, e.g., `bb_gpt_4o_vision_chat`.
+
+    Backends may also define `async def abuild_request(pdf_path) -> dict`, which is
+    used instead of running `build_request` in a thread, and
+    `async def aextract(runner, pdf_path) -> Tuple[dict, List[ChatCompletion]]` to
+    make their own requests through `runner.extract_with`, e.g., to route between
+    backends. `parse_responses(responses) -> List[Union[dict, Exception]]` parses many
+    responses at once, e.g., a finished batch.
+    """
+
+    def build_request(self, pdf_path: str) -> dict:
+        ...
+
+    def parse_response(self, response: ChatCompletion) -> dict:
+        ...
+
+
+def _image_part_tokens(part: dict) -> int:
+    url: str = part["image_url"]["url"]
+    if url.startswith("data:"):
+        # The header is all that's needed for the dimensions, so only slice (and
+        # decode) the start of the payload rather than copying all of it
+        start = url.index(",") + 1
+        header = base64.b64decode(url[start : start + 4096])
+        dimensions = image_dimensions(header)
+        if dimensions is not None:
+            return image_tokens(*dimensions)
+    return IMAGE_TOKENS_ESTIMATE
+
+
+def _request_parts(request: dict) -> Generator[dict, None, None]:
+    for message in request["messages"]:
+        content = message["content"]
+        if isinstance(content, str):
+            yield {"type": "text", "text": content}
+        else:
+            yield from content
+
+
+class ExtractionResult(NamedTuple):
+    key: str
+    # The parsed extraction, or why it failed
+    result: Union[dict, Exception]
+    # Wall time from starting to build the request until the response was parsed
+    latency_s: float
+    usage: Optional[dict] = None
+    cached: bool = False
+    # Scored against the manual extraction already, by `run_pipeline`
+    scores: Optional[Dict[str, FieldCounts]] = None
+
+
+def estimate_request_tokens(request: dict) -> int:
+    """Approximates the tokens a request counts against the rate limit, before it's sent."""
+    tools = request.get("tools", [])
+    # The shared tools are serialized once, rather than for every request
+    chars = len(TOOLS_JSON) if tools is TOOLS else len(json.dumps(tools))
+    tokens = 0
+    for part in _request_parts(request):
+        if part["type"] == "text":
+            chars += len(part["text"])
+        elif part["type"] == "image_url":
+            tokens += _image_part_tokens(part)
+    return (
+        chars // 4 + tokens + (request.get("max_tokens") or COMPLETION_TOKENS_ESTIMATE)
+    )
+
+
+def request_payload_stats(request: dict) -> dict:
+    """Size of what's uploaded for a request, for comparing image encodings."""
+    image_parts = [p for p in _request_parts(request) if p["type"] == "image_url"]
+    return {
+        "request_bytes": len(json.dumps(request)),
+        "image_count": len(image_parts),
+        "image_bytes": sum(len(p["image_url"]["url"]) for p in image_parts),
+        "image_tokens_estimate": sum(_image_part_tokens(p) for p in image_parts),
+    }
+
+
+def total_usage(responses: List[ChatCompletion]) -> Optional[dict]:
+    """Token usage summed over the responses an extraction needed."""
+    usages = [r.usage for r in responses if r.usage is not None]
+    if not usages:
+        return None
+    if len(usages) == 1:
+        return usages[0].model_dump()
+    return {
+        "prompt_tokens": sum(u.prompt_tokens for u in usages),
+        "completion_tokens": sum(u.completion_tokens for u in usages),
+        "total_tokens": sum(u.total_tokens for u in usages),
+    }
+
+
+class TokenBucket:
+    """Per-minute budget which refills continuously, so a full minute's worth of
+    requests can't all be sent in the first second after a pause."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self._rate = per_minute / 60
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self._updated) * self._rate)
+        self._updated = now
+
+    async def acquire(self, amount: float) -> None:
+        # A single request larger than the whole budget would otherwise wait forever
+        amount = min(amount, self.capacity)
+        # The lock makes waiters take turns, so large requests aren't starved
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.level >= amount:
+                    self.level -= amount
+                    return
+                await asyncio.sleep((amount - self.level) / self._rate)
+
+    def adjust(self, amount: float) -> None:
+        """Charges (or refunds, if negative) the difference between an estimate and the
+        actual usage. The level may go negative, which delays the next `acquire`."""
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, openai.APIConnectionError):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def _retry_after_s(error: Exception) -> Optional[float]:
+    if not isinstance(error, openai.APIStatusError):
+        return None
+    headers = error.response.headers
+    try:
+        if "retry-after-ms" in headers:
+            return float(headers["retry-after-ms"]) / 1000
+        if "retry-after" in headers:
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class AsyncExtractionRunner:
+    """Runs extractions concurrently within a request and token per-minute budget,
+    retrying rate limit and server errors with jittered exponential backoff.
+
+    Pass `client` to point it somewhere else, e.g., at a `MockOpenAIServer`.
+    """
+
+    def __init__(
+        self,
+        backend: ExtractionBackend,
+        client: Optional[openai.AsyncOpenAI] = None,
+        max_concurrency: int = 16,
+        requests_per_minute: float = 500,
+        tokens_per_minute: float = 300_000,
+        max_retries: int = 8,
+        backoff_base_s: float = 1.0,
+        backoff_max_s: float = 60.0,
+        use_cache: bool = True,
+    ):
+        self.backend = backend
+        # Retries are handled here, so they share the rate budget and backoff
+        self.client = client or create_async_client(
+            with_pool_size(ClientConfig(max_retries=0), max_concurrency)
+        )
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base_s = backoff_base_s
+        self.backoff_max_s = backoff_max_s
+        self.cache = get_response_cache() if use_cache else None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._requests = TokenBucket(requests_per_minute)
+        self._tokens = TokenBucket(tokens_per_minute)
+
+    async def __aenter__(self) -> "AsyncExtractionRunner":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        await self.client.close()
+        if self.cache is not None:
+            logger.info("response cache stats", **self.cache.stats())
+
+    def _backoff_s(self, attempt: int, error: Exception) -> float:
+        # "Full jitter" so that requests which failed together don't retry together
+        delay = random.uniform(
+            0, min(self.backoff_max_s, self.backoff_base_s * 2**attempt)
+        )
+        retry_after = _retry_after_s(error)
+        return max(delay, retry_after) if retry_after is not None else delay
+
+    async def _send(self, request: dict, estimated_tokens: int, **kwargs):
+        """`chat.completions.create` within the rate budget, with retries."""
+        for attempt in range(self.max_retries + 1):
+            await self._requests.acquire(1)
+            await self._tokens.acquire(estimated_tokens)
+            try:
+                return await self.client.chat.completions.create(**request, **kwargs)
+            except Exception as e:
+                if not _is_retryable(e) or attempt == self.max_retries:
+                    raise
+                delay = self._backoff_s(attempt, e)
+                logger.warning(
+                    "retrying chat completion",
+                    attempt=attempt + 1,
+                    delay_s=round(delay, 3),
+                    error=repr(e),
+                )
+                await asyncio.sleep(delay)
+        raise AssertionError("unreachable")
+
+    def _received(
+        self, request: dict, response: ChatCompletion, estimated_tokens: int
+    ) -> None:
+        if response.usage is not None:
+            self._tokens.adjust(response.usage.total_tokens - estimated_tokens)
+        if self.cache is not None:
+            self.cache.set_response(request, response)
+
+    async def create(self, request: dict) -> ChatCompletion:
+        if self.cache is not None:
+            cached = self.cache.get_response(request)
+            if cached is not None:
+                return cached
+        estimated_tokens = estimate_request_tokens(request)
+        with stage(REQUEST) as sample:
+            response = await self._send(request, estimated_tokens)
+            sample.tokens = response.usage.total_tokens if response.usage else 0
+        self._received(request, response, estimated_tokens)
+        return response
+
+    async def _build_request(self, backend: ExtractionBackend, pdf_path: str) -> dict:
+        abuild_request = getattr(backend, "abuild_request", None)
+        if abuild_request is not None:
+            return await abuild_request(pdf_path)
+        # Building the request renders the PDF, so keep it off the event loop
+        return await asyncio.to_thread(backend.build_request, pdf_path)
+
+    async def extract_with(
+        self, backend: ExtractionBackend, pdf_path: str
+    ) -> Tuple[dict, ChatCompletion]:
+        """One extraction request built and parsed by `backend`."""
+        async with self._semaphore:
+            request = await self._build_request(backend, pdf_path)
+            response = await self.create(request)
+        return backend.parse_response(response), response
+
+    async def stream_with(
+        self, backend: ExtractionBackend, pdf_path: str
+    ) -> AsyncIterator[StreamEvent]:
+        """Like `extract_with`, but streams the response: yields each header field and
+        line item as soon as the model has generated it, then `Completed` with what
+        `extract_with` would have returned.
+
+        A field failing validation raises `StreamValidationError` and closes the
+        stream, so the rest isn't generated (or paid for). The request holds its
+        concurrency slot until the consumer has taken every event.
+        """
+        async with self._semaphore:
+            request = await self._build_request(backend, pdf_path)
+            parser = ExtractionStreamParser()
+            cached = self.cache.get_response(request) if self.cache else None
+            if cached is not None:
+                for event in parser.feed(tool_arguments(cached)):
+                    yield event
+                yield Completed(backend.parse_response(cached), cached)
+                return
+            estimated_tokens = estimate_request_tokens(request)
+            # Includes the time the consumer spends on each event
+            with stage(REQUEST, stream=True) as sample:
+                stream = await self._send(
+                    request,
+                    estimated_tokens,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                )
+                accumulator = ChunkAccumulator()
+                try:
+                    async for chunk in stream:
+                        for event in parser.feed(accumulator.add(chunk)):
+                            yield event
+                finally:
+                    await stream.close()
+                response = accumulator.completion()
+                sample.tokens = response.usage.total_tokens if response.usage else 0
+            self._received(request, response, estimated_tokens)
+        yield Completed(backend.parse_response(response), response)
+
+    async def _extract(self, pdf_path: str) -> Tuple[dict, List[ChatCompletion]]:
+        aextract = getattr(self.backend, "aextract", None)
+        if aextract is not None:
+            return await aextract(self, pdf_path)
+        result, response = await self.extract_with(self.backend, pdf_path)
+        return result, [response]
+
+    async def extract(self, pdf_path: str) -> dict:
+        result, _ = await self._extract(pdf_path)
+        return result
+
+    async def run(
+        self, items: Iterable[Tuple[str, str]]
+    ) -> AsyncIterator[ExtractionResult]:
+        """Extracts each `(key, pdf_path)` and yields an `ExtractionResult` per item in
+        completion order. Only a bounded number of items are in flight at once, so
+        `items` may be a lazy iterator over the whole corpus."""
+
+        async def extract(key: str, pdf_path: str) -> ExtractionResult:
+            start = time.perf_counter()
+            try:
+                result, responses = await self._extract(pdf_path)
+            except Exception as e:
+                logger.exception("extraction failed", key=key, pdf_path=pdf_path)
+                return ExtractionResult(key, e, time.perf_counter() - start)
+            return ExtractionResult(
+                key,
+                result,
+                time.perf_counter() - start,
+                total_usage(responses),
+                all(response.id == CACHED_RESPONSE_ID for response in responses),
+            )
+
+        items_iter = iter(items)
+        pending: Set[asyncio.Task[ExtractionResult]] = set()
+        try:
+            while True:
+                for key, pdf_path in items_iter:
+                    pending.add(asyncio.create_task(extract(key, pdf_path)))
+                    if len(pending) >= self.max_concurrency * 2:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    yield task.result()
+        finally:
+            # Interrupted or closed early, don't leave requests running unobserved
+            for task in pending:
+                task.cancel()
+
+
+def run_extractions(
+    backend: ExtractionBackend, items: Iterable[Tuple[str, str]], **kwargs
+) -> List[ExtractionResult]:
+    """Synchronous wrapper around `AsyncExtractionRunner.run`."""
+
+    async def main():
+        async with AsyncExtractionRunner(backend, **kwargs) as runner:
+            return [result async for result in runner.run(items)]
+
+    return asyncio.run(main())
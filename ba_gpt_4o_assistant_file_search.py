@@ -1,84 +1,26 @@
-import os
 from pathlib import Path
 
-import openai
+import tool_schema
+from openai_client import get_client
 
 
 # Function to upload PDF and extract information
 def extract_invoice_info_from_pdf(pdf_path):
-    client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+    client = get_client()
 
     f = client.files.create(file=pdf_path, purpose="assistants")
 
     assistant = client.beta.assistants.create(
-        model="gpt-4o-2024-05-13",
-        instructions="You are an accounts payable clerk. You extract information from submitted PDF invoices and call the provided function.",
-        tools=[
-            {
-                "type": "function",
-                "function": {
-                    "name": "extract_invoice_info",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "InvoiceHeaderInfo": {
-                                "type": "object",
-                                "properties": {
-                                    "SalesTaxAmount": {"type": "number"},
-                                    "ShippingCharges": {"type": "number"},
-                                    "InvoiceNumber": {"type": "string"},
-                                    "InvoiceAmount": {"type": "number"},
-                                    "InvoiceDate": {"type": "string"},
-                                    "VendorNumber": {"type": "string"},
-                                    "PurchaseOrder": {"type": "string"},
-                                },
-                                "required": [
-                                    "SalesTaxAmount",
-                                    "ShippingCharges",
-                                    "InvoiceNumber",
-                                    "InvoiceAmount",
-                                    "InvoiceDate",
-                                    "VendorNumber",
-                                    "PurchaseOrder",
-                                ],
-                            },
-                            "InvoiceLineItems": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "properties": {
-                                        "ItemDescription": {"type": "string"},
-                                        "UnitOfMeasure": {"type": "string"},
-                                        "UnitPrice": {"type": "number"},
-                                        "Quantity": {"type": "number"},
-                                        "LineItemNetTotal": {"type": "number"},
-                                        "LineItemTotal": {"type": "number"},
-                                        "SupplierPartNum": {"type": "string"},
-                                    },
-                                    "required": [
-                                        "ItemDescription",
-                                        "UnitOfMeasure",
-                                        "UnitPrice",
-                                        "Quantity",
-                                        "LineItemNetTotal",
-                                        "LineItemTotal",
-                                        "SupplierPartNum",
-                                    ],
-                                },
-                            },
-                        },
-                        "required": ["InvoiceHeaderInfo", "InvoiceLineItems"],
-                    },
-                },
-            }
-        ],
+        model=tool_schema.MODEL,
+        instructions=tool_schema.SYSTEM_PROMPT,
+        tools=tool_schema.TOOLS,  # pyright: ignore[reportArgumentType]
     )
 
     thread = client.beta.threads.create()
     client.beta.threads.messages.create(
         thread_id=thread.id,
         role="user",
-        content="Call extract_invoice_info for the provided file",
+        content=f"Call {tool_schema.TOOL_NAME} for the provided file",
         attachments=[{"file_id": f.id, "tools": [{"type": "file_search"}]}],
     )
 
@@ -0,0 +1,335 @@
+import asyncio
+import itertools
+import json
+import os
+import time
+from typing import AsyncIterator, BinaryIO, Dict, Iterable, List, Optional, Tuple, Union
+
+import openai
+import structlog
+from openai.types import Batch
+from openai.types.chat import ChatCompletion
+
+from async_runner import ExtractionBackend, ExtractionResult
+from caching import cache_path
+from jobs import JobLedger, shard_of
+from openai_client import create_async_client
+
+logger = structlog.stdlib.get_logger()
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+# The Batch API's limits per input file are 50,000 requests and 200 MB
+BATCH_MAX_REQUESTS = 50_000
+# Kept under the 200 MB limit, whichever MB the API means
+BATCH_MAX_BYTES = 150 * 1024 * 1024
+BATCH_POLL_INTERVAL_S = 60.0
+# Requests built concurrently while writing batch files
+BUILD_CONCURRENCY = 8
+FINISHED_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchRequestError(Exception):
+    """A request of a batch failed, or the batch finished without running it."""
+
+
+async def _build_request(backend: ExtractionBackend, pdf_path: str) -> dict:
+    abuild_request = getattr(backend, "abuild_request", None)
+    if abuild_request is not None:
+        return await abuild_request(pdf_path)
+    return await asyncio.to_thread(backend.build_request, pdf_path)
+
+
+async def write_batch_files(
+    backend: ExtractionBackend,
+    items: Iterable[Tuple[str, str]],
+    directory: str,
+    max_requests: int = BATCH_MAX_REQUESTS,
+    max_bytes: int = BATCH_MAX_BYTES,
+) -> AsyncIterator[Tuple[str, List[str], List[ExtractionResult]]]:
+    """Writes the requests `backend` builds for each `(key, pdf_path)` to JSONL batch
+    input files of at most `max_requests` lines and `max_bytes`, with the key as
+    `custom_id`. Yields `(path, keys, failures)` as each file fills up, where
+    `failures` are the items whose request couldn't be built (or alone exceeds
+    `max_bytes`)."""
+    os.makedirs(directory, exist_ok=True)
+    items_iter = iter(items)
+    file_index = 0
+    path = ""
+    f: Optional[BinaryIO] = None
+    keys: List[str] = []
+    failures: List[ExtractionResult] = []
+    size = 0
+    try:
+        while chunk := list(itertools.islice(items_iter, BUILD_CONCURRENCY)):
+            start = time.perf_counter()
+            requests = await asyncio.gather(
+                *(_build_request(backend, pdf_path) for _, pdf_path in chunk),
+                return_exceptions=True,
+            )
+            for (key, pdf_path), request in zip(chunk, requests):
+                if isinstance(request, BaseException):
+                    if not isinstance(request, Exception):
+                        raise request
+                    logger.error(
+                        "building batch request failed",
+                        key=key,
+                        pdf_path=pdf_path,
+                        error=repr(request),
+                    )
+                    failures.append(
+                        ExtractionResult(key, request, time.perf_counter() - start)
+                    )
+                    continue
+                line = (
+                    json.dumps(
+                        {
+                            "custom_id": key,
+                            "method": "POST",
+                            "url": BATCH_ENDPOINT,
+                            "body": request,
+                        }
+                    ).encode()
+                    + b"\n"
+                )
+                if len(line) > max_bytes:
+                    error = ValueError(
+                        f"Request of {len(line)} bytes exceeds the batch file limit of {max_bytes}"
+                    )
+                    logger.error("batch request too large", key=key, pdf_path=pdf_path)
+                    failures.append(
+                        ExtractionResult(key, error, time.perf_counter() - start)
+                    )
+                    continue
+                if f is not None and (
+                    len(keys) == max_requests or size + len(line) > max_bytes
+                ):
+                    f.close()
+                    f = None
+                    logger.info(
+                        "wrote batch file", path=path, requests=len(keys), bytes=size
+                    )
+                    yield path, keys, failures
+                    file_index += 1
+                    keys, failures, size = [], [], 0
+                if f is None:
+                    path = os.path.join(
+                        directory, f"batch-{os.getpid()}-{file_index}.jsonl"
+                    )
+                    f = open(path, "wb")
+                f.write(line)
+                size += len(line)
+                keys.append(key)
+        if f is not None:
+            f.close()
+            f = None
+            logger.info("wrote batch file", path=path, requests=len(keys), bytes=size)
+            yield path, keys, failures
+        elif failures:
+            yield path, keys, failures
+    finally:
+        if f is not None:
+            f.close()
+
+
+async def submit_batch(
+    client: openai.AsyncOpenAI, path: str, metadata: Optional[Dict[str, str]] = None
+) -> Batch:
+    with open(path, "rb") as f:
+        file = await client.files.create(file=f, purpose="batch")
+    batch = await client.batches.create(
+        input_file_id=file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata=metadata,
+    )
+    logger.info("submitted batch", batch_id=batch.id, input_file_id=file.id)
+    return batch
+
+
+async def wait_for_batch(
+    client: openai.AsyncOpenAI,
+    batch_id: str,
+    poll_interval_s: float = BATCH_POLL_INTERVAL_S,
+) -> Batch:
+    """Polls the batch until it's finished, successfully or not."""
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in FINISHED_STATUSES:
+            logger.info(
+                "batch finished",
+                batch_id=batch_id,
+                status=batch.status,
+                request_counts=batch.request_counts and batch.request_counts.to_dict(),
+            )
+            return batch
+        logger.debug("batch pending", batch_id=batch_id, status=batch.status)
+        await asyncio.sleep(poll_interval_s)
+
+
+async def _output_lines(client: openai.AsyncOpenAI, file_id: Optional[str]):
+    if file_id is None:
+        return []
+    content = await client.files.content(file_id)
+    return [json.loads(line) for line in content.content.splitlines() if line.strip()]
+
+
+def _parse(
+    backend: ExtractionBackend, completions: List[ChatCompletion]
+) -> List[Union[dict, Exception]]:
+    parse_responses = getattr(backend, "parse_responses", None)
+    if parse_responses is not None:
+        return parse_responses(completions)
+    results: List[Union[dict, Exception]] = []
+    for completion in completions:
+        try:
+            results.append(backend.parse_response(completion))
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+async def batch_results(
+    client: openai.AsyncOpenAI,
+    batch: Batch,
+    item_ids: List[str],
+    backend: ExtractionBackend,
+) -> List[ExtractionResult]:
+    """Parses the finished batch's responses with `backend`, one result per item id.
+    Items without a successful response get a `BatchRequestError`."""
+    # Batches don't time individual requests, so each result gets the batch's
+    # turnaround instead
+    finished_at = (
+        batch.completed_at
+        or batch.failed_at
+        or batch.expired_at
+        or batch.cancelled_at
+        or time.time()
+    )
+    latency_s = float(finished_at - batch.created_at)
+    results: Dict[str, ExtractionResult] = {}
+    completions: Dict[str, ChatCompletion] = {}
+    lines = await _output_lines(client, batch.output_file_id)
+    lines += await _output_lines(client, batch.error_file_id)
+    for line in lines:
+        key = line["custom_id"]
+        response = line.get("response") or {}
+        if line.get("error") or response.get("status_code") != 200:
+            error = line.get("error") or response.get("body", {}).get("error")
+            results[key] = ExtractionResult(
+                key,
+                BatchRequestError(f"{response.get('status_code')}: {error}"),
+                latency_s,
+            )
+            continue
+        completions[key] = ChatCompletion.model_validate(response["body"])
+    for key, result in zip(completions, _parse(backend, list(completions.values()))):
+        usage = completions[key].usage
+        if isinstance(result, Exception):
+            results[key] = ExtractionResult(key, result, latency_s)
+        else:
+            results[key] = ExtractionResult(
+                key, result, latency_s, usage.model_dump() if usage else None
+            )
+    for key in item_ids:
+        if key not in results:
+            results[key] = ExtractionResult(
+                key,
+                BatchRequestError(f"Batch {batch.id} {batch.status} without a result"),
+                latency_s,
+            )
+    return [results[key] for key in item_ids]
+
+
+async def run_batch_job(
+    backend: ExtractionBackend,
+    items: Iterable[Tuple[str, str]],
+    ledger: JobLedger,
+    shard: Tuple[int, int] = (0, 1),
+    completed: Optional[Dict[str, ExtractionResult]] = None,
+    client: Optional[openai.AsyncOpenAI] = None,
+    directory: Optional[str] = None,
+    poll_interval_s: float = BATCH_POLL_INTERVAL_S,
+    **batch_kwargs,
+) -> AsyncIterator[ExtractionResult]:
+    """Counterpart of `jobs.run_job` through the Batch API, which costs half as much
+    per token but may take up to a day: writes this shard's items to batch files,
+    submits them, polls until they finish and yields the results, recording them in
+    `ledger`.
+
+    Submitted batches are recorded in `ledger` too, so a resumed run of the shard waits
+    on them rather than submitting their items again. Only `build_request` and
+    `parse_response` are used, so backends' `aextract` hooks (e.g., routing fallbacks
+    or chunking) don't apply.
+    """
+    index, num_shards = shard
+    if completed is None:
+        completed = ledger.completed()
+    own_client = client is None
+    client = client or create_async_client()
+    directory = directory or cache_path("batches")
+    shard_name = f"{index}/{num_shards}"
+    selected = [
+        (item_id, pdf_path)
+        for item_id, pdf_path in items
+        if shard_of(item_id, num_shards) == index and item_id not in completed
+    ]
+    selected_ids = {item_id for item_id, _ in selected}
+    # Batches an earlier run of this shard left pending, if any of their items are
+    # still to do in this run (e.g., not when it's run with a smaller `--limit`)
+    pending = {
+        batch_id: item_ids
+        for batch_id, item_ids in ledger.pending_batches(shard_name).items()
+        if selected_ids.intersection(item_ids)
+    }
+    submitted = {key for item_ids in pending.values() for key in item_ids}
+    todo = (
+        (item_id, pdf_path)
+        for item_id, pdf_path in selected
+        if item_id not in submitted
+    )
+    try:
+        async for path, item_ids, failures in write_batch_files(
+            backend, todo, directory, **batch_kwargs
+        ):
+            for result in failures:
+                ledger.record(result)
+                yield result
+            if not item_ids:
+                continue
+            batch = await submit_batch(client, path, {"shard": shard_name})
+            ledger.record_batch(batch.id, shard_name, item_ids)
+            pending[batch.id] = item_ids
+            # Uploaded, and base64 page images make these large
+            os.remove(path)
+
+        waits = [
+            asyncio.create_task(wait_for_batch(client, batch_id, poll_interval_s))
+            for batch_id in pending
+        ]
+        try:
+            for wait in asyncio.as_completed(waits):
+                batch = await wait
+                for result in await batch_results(
+                    client, batch, pending[batch.id], backend
+                ):
+                    # A resumed batch may hold items completed since, or left out of
+                    # this run, which are recorded for later runs but not yielded
+                    if result.key in completed:
+                        continue
+                    ledger.record(result)
+                    if result.key in selected_ids:
+                        yield result
+                ledger.finish_batch(batch.id)
+        finally:
+            for wait in waits:
+                wait.cancel()
+    finally:
+        if own_client:
+            await client.close()
+    logger.info(
+        "batch job shard finished",
+        shard=shard_name,
+        batches=len(pending),
+        ledger=ledger.counts(),
+    )
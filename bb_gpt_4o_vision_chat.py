@@ -1,148 +1,155 @@
+import asyncio
 import base64
-import difflib
-import json
+import functools
+import itertools
 import logging
-import os
-from typing import Any, Generator
+import sys
+from types import SimpleNamespace
+from typing import AsyncIterator, Generator, List, Optional, Union, cast
 
-import openai
-import pymupdf
 import structlog
+from openai.types.chat import ChatCompletion
 
+import tool_schema
 from a_ingestion import load_pdfs_and_manual_extraction
-from models import ExtractedInvoice
+from async_runner import ExtractionBackend, request_payload_stats, run_extractions
+from instrumentation import ENCODE, RASTERIZE, stage
+from openai_client import get_client
+from rasterize import (
+    PNG_ENCODING,
+    ImageEncoding,
+    arender_pages,
+    page_count,
+    render_pages,
+)
+from response_cache import create_with_cache
+from scoring import field_differences
 
 logger = structlog.stdlib.get_logger()
 
 
-def pdf_to_images(pdf_path: str) -> Generator[bytes, None, None]:
+def pdf_to_images(
+    pdf_path: str,
+    encoding: ImageEncoding = PNG_ENCODING,
+    pages: Optional[range] = None,
+) -> Generator[bytes, None, None]:
     logger.debug("opening pdf", pdf_path=pdf_path)
-    doc = pymupdf.Document(pdf_path)
-    logger.info("pdf details", pdf_path=pdf_path, pdf_page_count=len(doc))
-    for page in doc:
-        p: Any = page
-        pix: pymupdf.Pixmap = p.get_pixmap(dpi=138)
-        b = pix.tobytes()
+    logger.info("pdf details", pdf_path=pdf_path, pdf_page_count=page_count(pdf_path))
+    yield from render_pages(pdf_path, encoding, pages=pages)
+
+
+async def apdf_to_images(
+    pdf_path: str,
+    encoding: ImageEncoding = PNG_ENCODING,
+    pages: Optional[range] = None,
+) -> AsyncIterator[bytes]:
+    logger.debug("opening pdf", pdf_path=pdf_path)
+    async for b in arender_pages(pdf_path, encoding, pages=pages):
         yield b
 
 
-# Function to extract information from images using GPT-4o API
-def extract_invoice_info_from_pdf(pdf_path):
-    client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
-    response = client.chat.completions.create(
-        model="gpt-4o-2024-05-13",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an accounts payable clerk."
-                + " You extract information from submitted PDF invoices and call the provided function."
-                + " Unless otherwise instructured, preserve the case and formatting as is from the PDF."
-                + " It is okay to leave fields blank if you don't know.",
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Generate a data object from this PDF"},
-                    *(
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64.b64encode(b).decode('utf-8')}"
-                            },
-                        }
-                        for b in pdf_to_images(pdf_path)
-                    ),
-                ],
-            },
-        ],
-        tool_choice={"type": "function", "function": {"name": "extract_invoice_info"}},
-        tools=[
-            {
-                "type": "function",
-                "function": {
-                    "name": "extract_invoice_info",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "InvoiceHeaderInfo": {
-                                "type": "object",
-                                "properties": {
-                                    "SalesTaxAmount": {"type": "number"},
-                                    "ShippingCharges": {"type": "number"},
-                                    "InvoiceNumber": {"type": "string"},
-                                    "InvoiceAmount": {"type": "number"},
-                                    "InvoiceDate": {
-                                        "type": "string",
-                                        "description": "Use YYYY-MM-DDTHH:mm:SS format, and specify 00:00:00 if the time is not known.",
-                                    },
-                                    "PurchaseOrder": {
-                                        "type": "string",
-                                        "description": "Usually an abbreviation, like PO. Do NOT use the 'Sales Order' or 'Invoice #' or 'Customer #' or similar as the purchase order.",
-                                    },
-                                    "VendorContactInfo": {
-                                        "type": "object",
-                                        "description": "Under a remit to or other vendor stated section. Do not use the purchaser's contact information.",
-                                        "properties": {
-                                            "ContactName": {"type": "string"},
-                                            "ContactAddress1": {"type": "string"},
-                                            "ContactAddress2": {"type": "string"},
-                                            "ContactCity": {"type": "string"},
-                                            "ContactState": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "required": [
-                                    "InvoiceAmount",
-                                    "InvoiceDate",
-                                    "VendorNumber",
-                                ],
-                            },
-                            "InvoiceLineItems": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "description": "Make sure to capture ALL line items on the document. Capture each item. Look for horizontal entries which have a price in them on the far right side.",
-                                    "properties": {
-                                        "ItemDescription": {
-                                            "type": "string",
-                                            "description": "Do not correct typos in the source document.",
-                                        },
-                                        "Quantity": {"type": "number"},
-                                        "LineItemNetTotal": {"type": "number"},
-                                        "LineItemTotal": {"type": "number"},
-                                        "SupplierPartNum": {
-                                            "type": "string",
-                                            "description": "This may be called 'Model', 'Product', or similar names.",
-                                        },
-                                        "UnitOfMeasure": {"type": "string"},
-                                        "UnitPrice": {"type": "number"},
-                                    },
-                                    "required": [
-                                        "ItemDescription",
-                                        "LineItemTotal",
-                                    ],
-                                },
-                            },
-                        },
-                        "required": ["InvoiceHeaderInfo", "InvoiceLineItems"],
-                    },
-                },
-            }
-        ],
+def _image_part(b: bytes, encoding: ImageEncoding) -> dict:
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{encoding.mime_type};base64,{base64.b64encode(b).decode('utf-8')}"
+        },
+    }
+
+
+def _page_note(pages: Optional[range], pdf_page_count: int) -> List[dict]:
+    """Tells the model which pages it's looking at, when it isn't the whole PDF."""
+    if pages is None or len(pages) == pdf_page_count:
+        return []
+    text = (
+        f"These are pages {pages.start + 1}-{pages.stop} of a {pdf_page_count} page PDF."
+        + " Only include the line items on these pages."
     )
+    return [{"type": "text", "text": text}]
+
+
+def _encode_request(
+    pdf_path: str, images: List[bytes], encoding: ImageEncoding, note: List[dict]
+) -> dict:
+    with stage(ENCODE, pdf_path=pdf_path) as sample:
+        request = tool_schema.build_request(
+            note + [_image_part(b, encoding) for b in images]
+        )
+        sample.bytes = sum(
+            len(part["image_url"]["url"])
+            for part in request["messages"][-1]["content"]
+            if part["type"] == "image_url"
+        )
+    return request
+
+
+def _log_payload(pdf_path: str, request: dict) -> dict:
+    logger.info("vision payload", pdf_path=pdf_path, **request_payload_stats(request))
+    return request
+
+
+def build_request(
+    pdf_path: str,
+    encoding: ImageEncoding = PNG_ENCODING,
+    pages: Optional[range] = None,
+) -> dict:
+    """Returns the keyword arguments for `chat.completions.create` for the given PDF,
+    or for only its `pages`."""
+    with stage(RASTERIZE, pdf_path=pdf_path) as sample:
+        images = list(pdf_to_images(pdf_path, encoding, pages))
+        sample.bytes = sum(len(b) for b in images)
+    note = _page_note(pages, page_count(pdf_path)) if pages else []
+    return _log_payload(pdf_path, _encode_request(pdf_path, images, encoding, note))
+
 
-    logger.info(
-        "model response for extract_invoice_info",
-        llm_usage=response.usage.model_dump(),  # pyright: ignore[reportOptionalMemberAccess]
+async def abuild_request(
+    pdf_path: str,
+    encoding: ImageEncoding = PNG_ENCODING,
+    pages: Optional[range] = None,
+) -> dict:
+    """Like `build_request`, but awaits each page as it's rendered instead of blocking
+    a thread on the whole document."""
+    with stage(RASTERIZE, pdf_path=pdf_path) as sample:
+        images = [b async for b in apdf_to_images(pdf_path, encoding, pages)]
+        sample.bytes = sum(len(b) for b in images)
+    note = []
+    if pages:
+        note = _page_note(pages, await asyncio.to_thread(page_count, pdf_path))
+    return _log_payload(pdf_path, _encode_request(pdf_path, images, encoding, note))
+
+
+def parse_response(response: ChatCompletion) -> dict:
+    return tool_schema.parse_response(response)
+
+
+def parse_responses(responses: List[ChatCompletion]) -> List[Union[dict, Exception]]:
+    return tool_schema.parse_responses(responses)
+
+
+# Function to extract information from images using GPT-4o API
+def extract_invoice_info_from_pdf(
+    pdf_path, use_cache: bool = True, encoding: ImageEncoding = PNG_ENCODING
+):
+    response = create_with_cache(
+        get_client(), build_request(pdf_path, encoding), use_cache
     )
-    raw = json.loads(
-        response.choices[0]  # pyright: ignore[reportOptionalSubscript]
-        .message.tool_calls[0]  # pyright: ignore[reportOptionalSubscript]
-        .function.arguments
+    return parse_response(response)
+
+
+def with_encoding(encoding: ImageEncoding) -> ExtractionBackend:
+    """This backend with pages rendered using `encoding`, e.g., for `run_extractions`:
+
+    run_extractions(with_encoding(ImageEncoding(format="jpeg", dpi=None)), items)
+    """
+    return cast(
+        ExtractionBackend,
+        SimpleNamespace(
+            build_request=functools.partial(build_request, encoding=encoding),
+            abuild_request=functools.partial(abuild_request, encoding=encoding),
+            parse_response=parse_response,
+            parse_responses=parse_responses,
+        ),
     )
-    e = ExtractedInvoice(**raw)
-    return e.model_dump()
 
 
 # Example usage
@@ -151,26 +158,19 @@ if __name__ == "__main__":
         wrapper_class=structlog.make_filtering_bound_logger(logging.INFO)
     )
     _, pdfs_with_manual_extractions, _ = load_pdfs_and_manual_extraction()
-    for i, invoice in enumerate(pdfs_with_manual_extractions.values()):
-        if i >= 3:
-            break
+    invoices = dict(itertools.islice(pdfs_with_manual_extractions.items(), 3))
+    results = run_extractions(
+        cast(ExtractionBackend, sys.modules[__name__]),
+        ((key, cast(str, invoice.file_path)) for key, invoice in invoices.items()),
+    )
+    for key, ai_bb_invoice, *_ in results:
+        invoice = invoices[key]
         print(invoice.file_path)
+        if isinstance(ai_bb_invoice, Exception):
+            continue
 
-        ai_bb_invoice = extract_invoice_info_from_pdf(invoice.file_path)
-
-        manual_invoice = json.dumps(
-            invoice.to_extracted().model_dump(), indent=4, sort_keys=True
-        )
-        ai_bb_invoice = json.dumps(ai_bb_invoice, indent=4, sort_keys=True)
-
-        diff = difflib.unified_diff(
-            manual_invoice.splitlines(),
-            ai_bb_invoice.splitlines(),
-            fromfile="manual_invoice",
-            tofile="ai_bb_invoice",
-            lineterm="",
-            n=10,
+        differences = field_differences(
+            ai_bb_invoice, invoice.to_extracted().model_dump(warnings=False)
         )
-
-        for line in diff:
-            print(line)
+        for field, extracted, expected in differences:
+            print(f"  {field}: extracted {extracted!r}, expected {expected!r}")
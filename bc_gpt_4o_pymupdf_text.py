@@ -1,136 +1,116 @@
-import difflib
-import json
+import contextlib
+import functools
+import importlib.metadata
+import itertools
 import logging
-import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Iterable, List, Optional, Union, cast
 
-import openai
 import pymupdf4llm
 import structlog
+from openai.types.chat import ChatCompletion
 
+import tool_schema
 from a_ingestion import load_pdfs_and_manual_extraction
-from models import ExtractedInvoice
+from async_runner import ExtractionBackend, run_extractions
+from caching import DiskCache, cache_path, file_digest
+from instrumentation import MARKDOWN, stage
+from openai_client import get_client
+from response_cache import create_with_cache
+from scoring import field_differences
 
 logger = structlog.stdlib.get_logger()
 
 
-def pdf_to_text(pdf_path: str) -> str:
-    txt = pymupdf4llm.to_markdown(pdf_path)
+MARKDOWN_CACHE_MAX_BYTES = 1 << 30
+
+
+class MarkdownCache(DiskCache):
+    """`pymupdf4llm` output keyed by PDF content and `pymupdf4llm` version, since its
+    layout analysis costs hundreds of milliseconds per page."""
+
+    @staticmethod
+    def markdown_key(pdf_path: str) -> str:
+        return f"{file_digest(pdf_path)}:pymupdf4llm={importlib.metadata.version('pymupdf4llm')}"
+
+
+def open_markdown_cache() -> MarkdownCache:
+    return MarkdownCache(
+        cache_path("markdown.sqlite"), max_bytes=MARKDOWN_CACHE_MAX_BYTES
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_markdown_cache() -> MarkdownCache:
+    return open_markdown_cache()
+
+
+def pdf_to_text(pdf_path: str, use_cache: bool = True) -> str:
+    cache = get_markdown_cache() if use_cache else None
+    key = MarkdownCache.markdown_key(pdf_path) if cache is not None else ""
+    cached = cache.get(key) if cache is not None else None
+    with stage(MARKDOWN, pdf_path=pdf_path, cached=cached is not None) as sample:
+        if cached is not None:
+            txt = cached.decode()
+        else:
+            txt = pymupdf4llm.to_markdown(pdf_path)
+            assert isinstance(txt, str)
+            if cache is not None:
+                cache.set(key, txt.encode())
+        sample.bytes = len(txt)
     logger.debug("pdf to markdown", pdf_path=pdf_path, markdown=txt)
     return txt
 
 
-# Function to extract information from images using GPT-4o API
-def extract_invoice_info_from_pdf(pdf_path):
-    client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-
-    response = client.chat.completions.create(
-        model="gpt-4o-2024-05-13",
-        messages=[
-            {
-                "role": "system",
-                "content": "You are an accounts payable clerk."
-                + " You extract information from submitted PDF invoices and call the provided function."
-                + " Unless otherwise instructured, preserve the case and formatting as is from the PDF."
-                + " It is okay to leave fields blank if you don't know.",
-            },
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": "Generate a data object from this PDF"},
-                    {
-                        "type": "text",
-                        "text": pdf_to_text(pdf_path),
-                    },
-                ],
-            },
-        ],
-        tool_choice={"type": "function", "function": {"name": "extract_invoice_info"}},
-        tools=[
-            {
-                "type": "function",
-                "function": {
-                    "name": "extract_invoice_info",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "InvoiceHeaderInfo": {
-                                "type": "object",
-                                "properties": {
-                                    "SalesTaxAmount": {"type": "number"},
-                                    "ShippingCharges": {"type": "number"},
-                                    "InvoiceNumber": {"type": "string"},
-                                    "InvoiceAmount": {"type": "number"},
-                                    "InvoiceDate": {
-                                        "type": "string",
-                                        "description": "Use YYYY-MM-DDTHH:mm:SS format, and specify 00:00:00 if the time is not known.",
-                                    },
-                                    "PurchaseOrder": {
-                                        "type": "string",
-                                        "description": "Usually an abbreviation, like PO. Do NOT use the 'Sales Order' or 'Invoice #' or 'Customer #' or similar as the purchase order.",
-                                    },
-                                    "VendorContactInfo": {
-                                        "type": "object",
-                                        "description": "Under a remit to or other vendor stated section. Do not use the purchaser's contact information.",
-                                        "properties": {
-                                            "ContactName": {"type": "string"},
-                                            "ContactAddress1": {"type": "string"},
-                                            "ContactAddress2": {"type": "string"},
-                                            "ContactCity": {"type": "string"},
-                                            "ContactState": {"type": "string"},
-                                        },
-                                    },
-                                },
-                                "required": [
-                                    "InvoiceAmount",
-                                    "InvoiceDate",
-                                    "VendorNumber",
-                                ],
-                            },
-                            "InvoiceLineItems": {
-                                "type": "array",
-                                "items": {
-                                    "type": "object",
-                                    "description": "Make sure to capture ALL line items on the document. Capture each item. Look for horizontal entries which have a price in them on the far right side.",
-                                    "properties": {
-                                        "ItemDescription": {
-                                            "type": "string",
-                                            "description": "Do not correct typos in the source document.",
-                                        },
-                                        "Quantity": {"type": "number"},
-                                        "LineItemNetTotal": {"type": "number"},
-                                        "LineItemTotal": {"type": "number"},
-                                        "SupplierPartNum": {
-                                            "type": "string",
-                                            "description": "This may be called 'Model', 'Product', or similar names.",
-                                        },
-                                        "UnitOfMeasure": {"type": "string"},
-                                        "UnitPrice": {"type": "number"},
-                                    },
-                                    "required": [
-                                        "ItemDescription",
-                                        "LineItemTotal",
-                                    ],
-                                },
-                            },
-                        },
-                        "required": ["InvoiceHeaderInfo", "InvoiceLineItems"],
-                    },
-                },
-            }
-        ],
-    )
+def _prewarm(pdf_path: str) -> None:
+    pdf_to_text(pdf_path)
 
-    logger.info(
-        "model response for extract_invoice_info",
-        llm_usage=response.usage.model_dump(),  # pyright: ignore[reportOptionalMemberAccess]
-    )
-    raw = json.loads(
-        response.choices[0]  # pyright: ignore[reportOptionalSubscript]
-        .message.tool_calls[0]  # pyright: ignore[reportOptionalSubscript]
-        .function.arguments
-    )
-    e = ExtractedInvoice(**raw)
-    return e.model_dump()
+
+def prewarm_markdown_cache(
+    pdf_paths: Iterable[str], max_workers: Optional[int] = None
+) -> int:
+    """Converts every PDF not already in the markdown cache across a process pool.
+    Returns the number of PDFs converted."""
+    # A SQLite connection mustn't be carried across fork, so this one is closed
+    # before the pool starts, and workers open their own in place of any inherited
+    with contextlib.closing(open_markdown_cache()) as cache:
+        missing = [
+            p for p in pdf_paths if cache.get(MarkdownCache.markdown_key(p)) is None
+        ]
+    logger.info("prewarming markdown cache", pdf_count=len(missing))
+    converted = 0
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=get_markdown_cache.cache_clear
+    ) as executor:
+        # Workers write straight to the cache, so the markdown isn't sent back
+        futures = {executor.submit(_prewarm, p): p for p in missing}
+        for future in as_completed(futures):
+            try:
+                future.result()
+                converted += 1
+            except Exception:
+                logger.exception("markdown conversion failed", pdf_path=futures[future])
+    return converted
+
+
+def build_request(pdf_path: str) -> dict:
+    """Returns the keyword arguments for `chat.completions.create` for the given PDF."""
+    return tool_schema.build_request([{"type": "text", "text": pdf_to_text(pdf_path)}])
+
+
+def parse_response(response: ChatCompletion) -> dict:
+    return tool_schema.parse_response(response)
+
+
+def parse_responses(responses: List[ChatCompletion]) -> List[Union[dict, Exception]]:
+    return tool_schema.parse_responses(responses)
+
+
+# Function to extract information from images using GPT-4o API
+def extract_invoice_info_from_pdf(pdf_path, use_cache: bool = True):
+    response = create_with_cache(get_client(), build_request(pdf_path), use_cache)
+    return parse_response(response)
 
 
 # Example usage
@@ -139,26 +119,19 @@ if __name__ == "__main__":
         wrapper_class=structlog.make_filtering_bound_logger(logging.INFO)
     )
     _, pdfs_with_manual_extractions, _ = load_pdfs_and_manual_extraction()
-    for i, invoice in enumerate(pdfs_with_manual_extractions.values()):
-        if i >= 3:
-            break
+    invoices = dict(itertools.islice(pdfs_with_manual_extractions.items(), 3))
+    results = run_extractions(
+        cast(ExtractionBackend, sys.modules[__name__]),
+        ((key, cast(str, invoice.file_path)) for key, invoice in invoices.items()),
+    )
+    for key, ai_bb_invoice, *_ in results:
+        invoice = invoices[key]
         print(invoice.file_path)
+        if isinstance(ai_bb_invoice, Exception):
+            continue
 
-        ai_bb_invoice = extract_invoice_info_from_pdf(invoice.file_path)
-
-        manual_invoice = json.dumps(
-            invoice.to_extracted().model_dump(), indent=4, sort_keys=True
-        )
-        ai_bb_invoice = json.dumps(ai_bb_invoice, indent=4, sort_keys=True)
-
-        diff = difflib.unified_diff(
-            manual_invoice.splitlines(),
-            ai_bb_invoice.splitlines(),
-            fromfile="manual_invoice",
-            tofile="ai_bb_invoice",
-            lineterm="",
-            n=10,
+        differences = field_differences(
+            ai_bb_invoice, invoice.to_extracted().model_dump(warnings=False)
         )
-
-        for line in diff:
-            print(line)
+        for field, extracted, expected in differences:
+            print(f"  {field}: extracted {extracted!r}, expected {expected!r}")
@@ -0,0 +1,20 @@
+import glob
+import logging
+import time
+
+import structlog
+
+from a_ingestion import PDFS_FOR_COMPARISON_DIR
+from bc_gpt_4o_pymupdf_text import get_markdown_cache, prewarm_markdown_cache
+
+if __name__ == "__main__":
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.INFO)
+    )
+    pdf_paths = sorted(glob.glob(f"{PDFS_FOR_COMPARISON_DIR}/*/*/*.pdf"))
+    start = time.perf_counter()
+    converted = prewarm_markdown_cache(pdf_paths)
+    print(
+        f"Converted {converted} of {len(pdf_paths)} PDFs in {time.perf_counter() - start:.1f}s"
+    )
+    print(f"Markdown cache: {get_markdown_cache().stats()}")
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import time
+
+import openai
+import structlog
+from openai.types.chat import ChatCompletion
+
+from async_runner import AsyncExtractionRunner
+from mock_openai_server import MockOpenAIServer
+from models import ExtractedInvoice
+from streaming import tool_arguments
+
+NUM_INVOICES = 200
+MOCK_LATENCY_S = 0.5
+MOCK_ERROR_RATE = 0.05
+
+
+class StaticBackend:
+    """Sends the same small request for every PDF, so only the runner is measured."""
+
+    def build_request(self, pdf_path: str) -> dict:
+        return dict(
+            model="mock",
+            messages=[{"role": "user", "content": pdf_path}],
+            tool_choice={
+                "type": "function",
+                "function": {"name": "extract_invoice_info"},
+            },
+        )
+
+    def parse_response(self, response: ChatCompletion) -> dict:
+        return ExtractedInvoice.model_validate_json(
+            tool_arguments(response)
+        ).model_dump()
+
+
+async def bench(base_url: str, max_concurrency: int, num_invoices: int) -> float:
+    async with AsyncExtractionRunner(
+        StaticBackend(),
+        client=openai.AsyncOpenAI(base_url=base_url, api_key="mock", max_retries=0),
+        max_concurrency=max_concurrency,
+        requests_per_minute=10_000,
+        backoff_base_s=0.05,
+        use_cache=False,
+    ) as runner:
+        start = time.perf_counter()
+        items = ((str(i), f"invoice_{i}.pdf") for i in range(num_invoices))
+        results = [result async for result in runner.run(items)]
+        elapsed = time.perf_counter() - start
+    assert all(not isinstance(r.result, Exception) for r in results)
+    return elapsed
+
+
+if __name__ == "__main__":
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+    print(
+        f"mock latency {MOCK_LATENCY_S}s, {MOCK_ERROR_RATE:.0%} of requests fail with 429"
+    )
+    print(f"{'concurrency':>12} {'invoices':>9} {'seconds':>8} {'invoices/hour':>14}")
+    with MockOpenAIServer(
+        latency_s=MOCK_LATENCY_S, error_rate=MOCK_ERROR_RATE
+    ) as server:
+        for max_concurrency in [1, 8, 32, 64]:
+            # Keep the sequential case short, it's ~latency * count
+            num_invoices = 10 if max_concurrency == 1 else NUM_INVOICES
+            elapsed = asyncio.run(bench(server.base_url, max_concurrency, num_invoices))
+            print(
+                f"{max_concurrency:>12} {num_invoices:>9} {elapsed:8.2f} {num_invoices / elapsed * 3600:14.0f}"
+            )
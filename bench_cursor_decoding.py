@@ -0,0 +1,54 @@
+import itertools
+import os
+import tempfile
+import time
+
+import duckdb
+
+from a_ingestion import RECORD_BATCH_ROWS, load_manifest, record_batches
+from models import Invoice, InvoiceDenormalized
+from synthetic import make_manifest_rows, write_manifest
+
+NUM_INVOICES = 20_000
+REPEATS = 3
+QUERY = "SELECT * FROM prod_data ORDER BY rowid"
+
+
+def decode_rows(con: duckdb.DuckDBPyConnection) -> int:
+    """The row-at-a-time path: a dataclass per row, grouped into invoices."""
+    invoices = 0
+    for _, items in itertools.groupby(
+        InvoiceDenormalized.from_db_cursor(con.execute(QUERY)),
+        key=lambda item: item.OriginalMessageItemId,
+    ):
+        Invoice.from_denormalized(list(items))
+        invoices += 1
+    return invoices
+
+
+def decode_record_batches(con: duckdb.DuckDBPyConnection) -> int:
+    reader = record_batches(con.execute(QUERY), RECORD_BATCH_ROWS)
+    return sum(1 for _ in Invoice.from_record_batches(reader, {}))
+
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        manifest_path = os.path.join(tmp_dir, "manifest.json")
+        rows = make_manifest_rows(NUM_INVOICES)
+        write_manifest(rows, manifest_path)
+        con = duckdb.connect(database=":memory:")
+        load_manifest(con, manifest_path, use_cache=False)
+
+    print(f"{len(rows)} rows, {NUM_INVOICES} invoices, best of {REPEATS}")
+    print(f"{'decoder':>16} {'seconds':>8} {'rows/s':>10}")
+    for name, decode in [
+        ("from_db_cursor", decode_rows),
+        ("record batches", decode_record_batches),
+    ]:
+        elapsed = []
+        for _ in range(REPEATS):
+            start = time.perf_counter()
+            assert decode(con) == NUM_INVOICES
+            elapsed.append(time.perf_counter() - start)
+        best = min(elapsed)
+        print(f"{name:>16} {best:8.3f} {len(rows) / best:10.0f}")
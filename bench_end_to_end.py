@@ -0,0 +1,214 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+import openai
+import pymupdf
+import structlog
+
+import caching
+from a_ingestion import load_pdfs_and_manual_extraction
+from async_runner import AsyncExtractionRunner, ExtractionBackend, ExtractionResult
+from bc_gpt_4o_pymupdf_text import get_markdown_cache, pdf_to_text
+from c_evaluation import BACKENDS, load_backend
+from corpus_index import get_corpus_index
+from mock_openai_server import MockOpenAIServer
+from pipeline import PipelineConfig, run_pipeline
+from rasterize import get_page_cache, render_pages
+from response_cache import get_response_cache
+from scoring import score_invoice
+from synthetic import make_corpus
+
+NUM_INVOICES = 40
+MOCK_LATENCY_S = 0.2
+MAX_CONCURRENCY = 16
+# Scoring a few dozen invoices is too quick to time reliably, so repeat it
+SCORING_ROUNDS = 20
+# A throughput this much below its baseline is flagged as a regression
+TOLERANCE = 0.2
+BASELINE_PATH = "bench_end_to_end.baseline.json"
+
+
+def use_fresh_caches(directory: str) -> None:
+    """Points the on-disk caches at an empty `directory`, so every stage runs cold
+    and the repo's `.cache/` isn't touched."""
+    caching.CACHE_DIR = directory
+    for get_cache in [
+        get_page_cache,
+        get_markdown_cache,
+        get_response_cache,
+        get_corpus_index,
+    ]:
+        get_cache.cache_clear()
+
+
+async def extract(
+    backend: ExtractionBackend,
+    items: List[Tuple[str, str]],
+    base_url: str,
+    pipeline: Optional[PipelineConfig] = None,
+) -> Tuple[float, List[ExtractionResult]]:
+    async with AsyncExtractionRunner(
+        backend,
+        client=openai.AsyncOpenAI(base_url=base_url, api_key="mock", max_retries=0),
+        max_concurrency=MAX_CONCURRENCY,
+        requests_per_minute=100_000,
+        tokens_per_minute=100_000_000,
+        use_cache=False,
+    ) as runner:
+        start = time.perf_counter()
+        if pipeline is None:
+            results = [result async for result in runner.run(items)]
+        else:
+            results = [r async for r in run_pipeline(runner, items, pipeline)]
+        return time.perf_counter() - start, results
+
+
+def bench(
+    tmp_dir: str, num_invoices: int, latency_s: float, backends: List[str]
+) -> Dict[str, float]:
+    """Throughput of each stage over a synthetic corpus, higher is better."""
+    metrics = {}
+    manifest_path, pdfs_dir = make_corpus(tmp_dir, num_invoices)
+    use_fresh_caches(os.path.join(tmp_dir, "cache-ingestion"))
+
+    start = time.perf_counter()
+    _, invoices, _ = load_pdfs_and_manual_extraction(
+        manifest_path, pdfs_dir, use_cache=False
+    )
+    metrics["ingestion invoices/s"] = len(invoices) / (time.perf_counter() - start)
+    assert len(invoices) == num_invoices, (len(invoices), num_invoices)
+    pdf_paths = [str(invoice.file_path) for invoice in invoices.values()]
+    num_pages = 0
+    for pdf_path in pdf_paths:
+        with pymupdf.Document(pdf_path) as doc:
+            num_pages += len(doc)
+
+    start = time.perf_counter()
+    for pdf_path in pdf_paths:
+        for _ in render_pages(pdf_path, use_cache=False):
+            pass
+    metrics["render pages/s"] = num_pages / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for pdf_path in pdf_paths:
+        pdf_to_text(pdf_path, use_cache=False)
+    metrics["markdown pages/s"] = num_pages / (time.perf_counter() - start)
+
+    items = [(key, str(invoice.file_path)) for key, invoice in invoices.items()]
+    with MockOpenAIServer(latency_s=latency_s) as server:
+        for name in backends:
+            backend = load_backend(name)
+            runs: Dict[str, Optional[PipelineConfig]] = {
+                f"extract {name} invoices/s": None
+            }
+            if getattr(backend, "aextract", None) is None:
+                runs[f"extract {name} pipelined invoices/s"] = PipelineConfig()
+            for metric, pipeline in runs.items():
+                use_fresh_caches(os.path.join(tmp_dir, f"cache-{name}-{len(metrics)}"))
+                elapsed, results = asyncio.run(
+                    extract(backend, items, server.base_url, pipeline)
+                )
+                failed = [r for r in results if isinstance(r.result, Exception)]
+                if failed:
+                    sys.exit(f"{metric}: {len(failed)} failed, e.g., {failed[0]}")
+                metrics[metric] = len(results) / elapsed
+
+    # Score each invoice against itself with its line items reversed, so matching
+    # them does the same work as on a real extraction
+    expected = [
+        invoice.to_extracted().model_dump(warnings=False)
+        for invoice in invoices.values()
+    ]
+    extracted = [
+        {**e, "InvoiceLineItems": e["InvoiceLineItems"][::-1]} for e in expected
+    ]
+    start = time.perf_counter()
+    for _ in range(SCORING_ROUNDS):
+        for x, e in zip(extracted, expected):
+            score_invoice(x, e)
+    metrics["score invoices/s"] = (
+        SCORING_ROUNDS * len(expected) / (time.perf_counter() - start)
+    )
+    return metrics
+
+
+def compare(
+    metrics: Dict[str, float], baseline: Dict[str, float], tolerance: float
+) -> List[str]:
+    """Prints `metrics` against `baseline`, returning the ones which regressed."""
+    regressions = []
+    print(f"{'metric':>38} {'current':>10} {'baseline':>10} {'change':>8}")
+    for name, value in metrics.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:>38} {value:10.1f} {'-':>10} {'-':>8}")
+            continue
+        change = value / base - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSION"
+        print(f"{name:>38} {value:10.1f} {base:10.1f} {change:+8.0%}{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+    parser = argparse.ArgumentParser(
+        description="Measures ingestion, rendering, extraction and scoring throughput on a synthetic corpus against a mock API, flagging regressions against a saved baseline."
+    )
+    parser.add_argument("--invoices", type=int, default=NUM_INVOICES)
+    parser.add_argument(
+        "--latency", type=float, default=MOCK_LATENCY_S, help="mock response time (s)"
+    )
+    parser.add_argument(
+        "--backend", choices=sorted(BACKENDS), action="append", dest="backends"
+    )
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument(
+        "--save-baseline",
+        action="store_true",
+        help="save this run's results as the baseline instead of comparing",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=TOLERANCE,
+        help="fraction of baseline throughput a metric may lose before it's flagged",
+    )
+    args = parser.parse_args()
+    config = {
+        "invoices": args.invoices,
+        "latency_s": args.latency,
+        "backends": args.backends or list(BACKENDS),
+    }
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        metrics = bench(tmp_dir, args.invoices, args.latency, config["backends"])
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"config": config, "metrics": metrics}, f, indent=4)
+        compare(metrics, {}, args.tolerance)
+        print(f"Baseline written to {args.baseline}")
+        sys.exit()
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            saved = json.load(f)
+        if saved["config"] == config:
+            baseline = saved["metrics"]
+        else:
+            print(f"Ignoring {args.baseline}, it was run with {saved['config']}")
+    regressions = compare(metrics, baseline, args.tolerance)
+    if regressions:
+        sys.exit(f"{len(regressions)} regressed by more than {args.tolerance:.0%}")
@@ -0,0 +1,55 @@
+import os
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import tool_schema
+from async_runner import request_payload_stats
+from bb_gpt_4o_vision_chat import _image_part
+from rasterize import ImageEncoding, render_pages
+from synthetic import make_manifest_rows, write_invoice_pdf
+
+NUM_PAGES = 12
+ENCODINGS = {
+    "png 138dpi (default)": ImageEncoding(),
+    "png auto dpi": ImageEncoding(dpi=None),
+    "png gray auto dpi": ImageEncoding(dpi=None, grayscale=True),
+    "jpeg q85 auto dpi": ImageEncoding(format="jpeg", dpi=None),
+    "jpeg q70 gray auto dpi": ImageEncoding(
+        format="jpeg", dpi=None, grayscale=True, quality=70
+    ),
+    "jpeg <=255 tokens/page": ImageEncoding(
+        format="jpeg", dpi=None, max_tokens_per_page=255
+    ),
+    "jpeg <=50KB/page": ImageEncoding(
+        format="jpeg", dpi=None, max_bytes_per_page=50_000
+    ),
+}
+
+if __name__ == "__main__":
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, "invoice.pdf")
+        # One row per synthetic invoice, but only the first row's header is printed
+        write_invoice_pdf(
+            pdf_path, make_manifest_rows(NUM_PAGES * 40, max_line_items=1)
+        )
+
+        print(f"{NUM_PAGES} page invoice")
+        print(
+            f"{'encoding':>24} {'render (s)':>11} {'request (KB)':>13} {'image tokens':>13}"
+        )
+        # A thread "pool" of one keeps the render timings comparable between machines
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for name, encoding in ENCODINGS.items():
+                start = time.perf_counter()
+                images = list(
+                    render_pages(pdf_path, encoding, executor, use_cache=False)
+                )
+                elapsed = time.perf_counter() - start
+                request = tool_schema.build_request(
+                    [_image_part(b, encoding) for b in images]
+                )
+                stats = request_payload_stats(request)
+                print(
+                    f"{name:>24} {elapsed:11.2f} {stats['request_bytes'] / 1000:13.0f} {stats['image_tokens_estimate']:13}"
+                )
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import time
+
+from a_ingestion import load_pdfs_and_manual_extraction
+from synthetic import make_manifest_rows, make_pdf_tree, write_manifest
+
+# Manifest sizes (in invoices, ~3 rows each) to measure load time at
+MANIFEST_SIZES = [250, 1_000, 4_000, 16_000]
+# The per-file path scans the whole table once per file, so skip it once it gets slow
+MAX_PER_FILE_SIZE = 4_000
+
+
+def bench_load(num_invoices: int, bulk: bool, tmp_dir: str) -> float:
+    start = time.perf_counter()
+    _, invoices, missing_item_ids = load_pdfs_and_manual_extraction(
+        manifest_path=os.path.join(tmp_dir, "manifest.json"),
+        pdfs_dir=os.path.join(tmp_dir, "pdfs"),
+        bulk=bulk,
+        use_cache=False,
+    )
+    elapsed = time.perf_counter() - start
+    assert len(invoices) == num_invoices, (len(invoices), num_invoices)
+    assert len(missing_item_ids) == num_invoices // 10
+    return elapsed
+
+
+if __name__ == "__main__":
+    print(f"{'invoices':>10} {'rows':>10} {'per-file (s)':>14} {'bulk (s)':>10}")
+    for num_invoices in MANIFEST_SIZES:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            rows = make_manifest_rows(num_invoices)
+            write_manifest(rows, os.path.join(tmp_dir, "manifest.json"))
+            make_pdf_tree(
+                os.path.join(tmp_dir, "pdfs"),
+                sorted({row["OriginalMessageItemId"] for row in rows}),
+                num_missing=num_invoices // 10,
+            )
+            bulk_s = bench_load(num_invoices, bulk=True, tmp_dir=tmp_dir)
+            per_file_s = (
+                f"{bench_load(num_invoices, bulk=False, tmp_dir=tmp_dir):14.3f}"
+                if num_invoices <= MAX_PER_FILE_SIZE
+                else f"{'skipped':>14}"
+            )
+            print(f"{num_invoices:>10} {len(rows):>10} {per_file_s} {bulk_s:10.3f}")
@@ -0,0 +1,54 @@
+import gc
+import os
+import tempfile
+import tracemalloc
+
+from a_ingestion import load_invoice_batch, load_pdfs_and_manual_extraction
+from synthetic import make_manifest_rows, make_pdf_tree, write_manifest
+
+# Manifest sizes (in invoices, ~3 rows each) to measure retained memory at
+MANIFEST_SIZES = [1_000, 4_000, 16_000]
+
+
+def retained_bytes(load) -> int:
+    """Python heap (and NumPy buffers) still held by what `load()` returns, after the
+    DuckDB connection it also returns is closed."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        con, invoices, _ = load()
+        con.close()
+        gc.collect()
+        retained = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del invoices
+    return retained
+
+
+if __name__ == "__main__":
+    print(
+        f"{'invoices':>10} {'objects (KB)':>13} {'per invoice (B)':>16} {'batch (KB)':>11} {'per invoice (B)':>16}"
+    )
+    for num_invoices in MANIFEST_SIZES:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            manifest_path = os.path.join(tmp_dir, "manifest.json")
+            pdfs_dir = os.path.join(tmp_dir, "pdfs")
+            rows = make_manifest_rows(num_invoices)
+            write_manifest(rows, manifest_path)
+            make_pdf_tree(
+                pdfs_dir, sorted({row["OriginalMessageItemId"] for row in rows})
+            )
+            del rows
+            objects = retained_bytes(
+                lambda: load_pdfs_and_manual_extraction(
+                    manifest_path, pdfs_dir, use_cache=False
+                )
+            )
+            batch = retained_bytes(
+                lambda: load_invoice_batch(manifest_path, pdfs_dir, use_cache=False)
+            )
+            print(
+                f"{num_invoices:>10} {objects / 1000:13.0f} {objects / num_invoices:16.0f} {batch / 1000:11.0f} {batch / num_invoices:16.0f}"
+            )
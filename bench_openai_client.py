@@ -0,0 +1,49 @@
+import os
+import statistics
+import time
+from typing import Any, Callable, Dict, List
+
+import openai
+
+from mock_openai_server import MockOpenAIServer
+from openai_client import ClientConfig, _http2_available, get_client
+
+NUM_REQUESTS = 200
+REQUEST: Dict[str, Any] = dict(
+    model="mock",
+    messages=[{"role": "user", "content": "Generate a data object from this PDF"}],
+    tool_choice={"type": "function", "function": {"name": "extract_invoice_info"}},
+)
+
+
+def bench(make_client: Callable[[], openai.OpenAI]) -> List[float]:
+    latencies = []
+    for _ in range(NUM_REQUESTS):
+        start = time.perf_counter()
+        make_client().chat.completions.create(**REQUEST)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+if __name__ == "__main__":
+    with MockOpenAIServer() as server:
+        config = ClientConfig(base_url=server.base_url)
+        os.environ.setdefault("OPENAI_API_KEY", "mock")
+
+        results = {
+            # What the extraction scripts used to do for every invoice
+            "new client per request": bench(
+                lambda: openai.OpenAI(base_url=server.base_url)
+            ),
+            "shared pooled client": bench(lambda: get_client(config)),
+        }
+
+    print(
+        f"{NUM_REQUESTS} sequential requests to a local mock, http2={_http2_available()}"
+    )
+    print(f"{'':>24} {'mean (ms)':>10} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    for name, latencies in results.items():
+        ms = sorted(l * 1000 for l in latencies)
+        print(
+            f"{name:>24} {statistics.mean(ms):10.2f} {ms[len(ms) // 2]:10.2f} {ms[int(len(ms) * 0.95)]:10.2f}"
+        )
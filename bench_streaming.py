@@ -0,0 +1,64 @@
+import asyncio
+import json
+import logging
+import time
+from typing import Dict
+
+import openai
+import structlog
+
+from async_runner import AsyncExtractionRunner
+from bench_async_runner import StaticBackend
+from mock_openai_server import MOCK_EXTRACTION, MockOpenAIServer
+from streaming import Completed, HeaderField, LineItem
+
+# Time the mock takes to generate a whole response, streamed or not
+MOCK_LATENCY_S = 2.0
+LINE_ITEM_COUNTS = [1, 10, 50, 200]
+
+
+def arguments(line_items: int) -> str:
+    extraction = dict(MOCK_EXTRACTION)
+    item = MOCK_EXTRACTION["InvoiceLineItems"][0]
+    extraction["InvoiceLineItems"] = [
+        {**item, "ItemDescription": f"Widget {i}"} for i in range(line_items)
+    ]
+    return json.dumps(extraction)
+
+
+async def bench(base_url: str) -> Dict[str, float]:
+    backend = StaticBackend()
+    async with AsyncExtractionRunner(
+        backend,
+        client=openai.AsyncOpenAI(base_url=base_url, api_key="mock", max_retries=0),
+        use_cache=False,
+    ) as runner:
+        start = time.perf_counter()
+        await runner.extract_with(backend, "invoice.pdf")
+        timings = {"whole": time.perf_counter() - start}
+
+        start = time.perf_counter()
+        async for event in runner.stream_with(backend, "invoice.pdf"):
+            name = {HeaderField: "header", LineItem: "item", Completed: "streamed"}[
+                type(event)
+            ]
+            timings.setdefault(name, time.perf_counter() - start)
+    return timings
+
+
+if __name__ == "__main__":
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+    print(f"mock generation time {MOCK_LATENCY_S}s per response")
+    print(
+        f"{'line items':>10} {'whole response':>15} {'first header field':>19} {'first line item':>16} {'streamed response':>18}"
+    )
+    for line_items in LINE_ITEM_COUNTS:
+        with MockOpenAIServer(
+            latency_s=MOCK_LATENCY_S, arguments=arguments(line_items)
+        ) as server:
+            t = asyncio.run(bench(server.base_url))
+        print(
+            f"{line_items:>10} {t['whole']:14.2f}s {t['header']:18.2f}s {t['item']:15.2f}s {t['streamed']:17.2f}s"
+        )
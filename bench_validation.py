@@ -0,0 +1,72 @@
+import json
+import logging
+import time
+from typing import Callable
+
+import structlog
+from openai.types.chat import ChatCompletion
+
+import tool_schema
+from bench_streaming import arguments
+from instrumentation import VALIDATE, stage
+from mock_openai_server import chat_completion
+from models import ExtractedInvoice
+
+LINE_ITEM_COUNTS = [1, 10, 100, 1_000, 5_000]
+# Responses parsed per `parse_responses` call
+BULK_SIZE = 100
+# Line items validated per measurement, so small responses are repeated more
+LINE_ITEMS_PER_RUN = 50_000
+
+
+def loads_then_validate(response: ChatCompletion) -> dict:
+    """How responses were parsed before, instrumentation included, for comparison."""
+    with stage("parse"):
+        raw = json.loads(
+            response.choices[0]  # pyright: ignore[reportOptionalSubscript]
+            .message.tool_calls[0]  # pyright: ignore[reportOptionalSubscript]
+            .function.arguments  # pyright: ignore[reportAttributeAccessIssue]
+        )
+    with stage(VALIDATE):
+        return ExtractedInvoice(**raw).model_dump()
+
+
+def per_response_s(f: Callable[[], object], responses: int) -> float:
+    start = time.perf_counter()
+    f()
+    return (time.perf_counter() - start) / responses
+
+
+if __name__ == "__main__":
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.ERROR)
+    )
+    print(
+        f"{'line items':>10} {'loads + validate (ms)':>22} {'validate_json (ms)':>19} {'bulk of 100 (ms)':>17}"
+    )
+    for line_items in LINE_ITEM_COUNTS:
+        response = ChatCompletion.model_validate(
+            chat_completion({}, arguments(line_items))
+        )
+        expected = loads_then_validate(response)
+        assert tool_schema.parse_response(response) == expected
+        assert tool_schema.parse_responses([response]) == [expected]
+        runs = max(LINE_ITEMS_PER_RUN // line_items // BULK_SIZE, 1)
+        responses = [response] * BULK_SIZE
+        loads = per_response_s(
+            lambda: [loads_then_validate(r) for _ in range(runs) for r in responses],
+            runs * BULK_SIZE,
+        )
+        validate_json = per_response_s(
+            lambda: [
+                tool_schema.parse_response(r) for _ in range(runs) for r in responses
+            ],
+            runs * BULK_SIZE,
+        )
+        bulk = per_response_s(
+            lambda: [tool_schema.parse_responses(responses) for _ in range(runs)],
+            runs * BULK_SIZE,
+        )
+        print(
+            f"{line_items:>10} {loads * 1000:22.3f} {validate_json * 1000:19.3f} {bulk * 1000:17.3f}"
+        )
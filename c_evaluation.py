@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import datetime
+import importlib
+import itertools
+import json
+import logging
+import os
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple, cast
+
+import duckdb
+import numpy
+import structlog
+
+from a_ingestion import iter_lazy_invoices
+from async_runner import ExtractionBackend, ExtractionResult
+from batch_api import run_batch_job
+from instrumentation import SCORE, get_stage_report, stage
+from jobs import JobLedger, parse_shard, run_job, shard_of
+from models import InvoiceLike
+from pipeline import PipelineConfig
+from router import RoutingReport
+from scoring import FieldCounts, score_invoice
+
+logger = structlog.stdlib.get_logger()
+
+BACKENDS = {
+    "vision": "bb_gpt_4o_vision_chat",
+    "text": "bc_gpt_4o_pymupdf_text",
+    "routed": "router",
+    "chunked": "chunking",
+}
+EVALUATIONS_DIR = "evaluations"
+
+
+def load_backend(name: str) -> ExtractionBackend:
+    module = importlib.import_module(BACKENDS[name])
+    # Modules are backends themselves, unless they create one
+    create_backend = getattr(module, "create_backend", None)
+    if create_backend is not None:
+        return create_backend()
+    return cast(ExtractionBackend, module)
+
+
+@dataclass
+class EvaluationReport:
+    counts: Dict[str, FieldCounts] = field(default_factory=dict)
+    latencies_s: List[float] = field(default_factory=list)
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    invoices: int = 0
+    errors: int = 0
+    cached: int = 0
+
+    def add(self, record: dict) -> None:
+        self.invoices += 1
+        if record["error"] is not None:
+            self.errors += 1
+            return
+        self.cached += record["cached"]
+        # Cached responses would skew the latency distribution towards zero
+        if not record["cached"]:
+            self.latencies_s.append(record["latency_s"])
+        usage = record["usage"] or {}
+        self.prompt_tokens += usage.get("prompt_tokens", 0)
+        self.completion_tokens += usage.get("completion_tokens", 0)
+        for name, (predicted, expected, correct) in record["scores"].items():
+            self.counts.setdefault(name, FieldCounts()).add(
+                FieldCounts(predicted, expected, correct)
+            )
+
+    def latency_percentiles(self) -> Dict[str, Optional[float]]:
+        if not self.latencies_s:
+            return {"p50": None, "p95": None, "p99": None}
+        p50, p95, p99 = numpy.percentile(self.latencies_s, [50, 95, 99])
+        return {"p50": float(p50), "p95": float(p95), "p99": float(p99)}
+
+    def summary(self) -> dict:
+        total = FieldCounts()
+        for counts in self.counts.values():
+            total.add(counts)
+        scored = max(self.invoices - self.errors, 1)
+        return {
+            "invoices": self.invoices,
+            "errors": self.errors,
+            "cached": self.cached,
+            "precision": total.precision,
+            "recall": total.recall,
+            "latency_s": self.latency_percentiles(),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "prompt_tokens_per_invoice": self.prompt_tokens / scored,
+            "completion_tokens_per_invoice": self.completion_tokens / scored,
+            "fields": {
+                name: {
+                    "precision": c.precision,
+                    "recall": c.recall,
+                    "predicted": c.predicted,
+                    "expected": c.expected,
+                    "correct": c.correct,
+                }
+                for name, c in sorted(self.counts.items())
+            },
+        }
+
+    def print(self) -> None:
+        def pct(value: Optional[float]) -> str:
+            return "-" if value is None else f"{value:.1%}"
+
+        summary = self.summary()
+        print(f"{'field':>34} {'precision':>10} {'recall':>8} {'expected':>9}")
+        for name, f in summary["fields"].items():
+            print(
+                f"{name:>34} {pct(f['precision']):>10} {pct(f['recall']):>8} {f['expected']:>9}"
+            )
+        print(
+            f"{'all fields':>34} {pct(summary['precision']):>10} {pct(summary['recall']):>8}"
+        )
+        print()
+        print(
+            f"Invoices: {self.invoices} ({self.errors} failed, {self.cached} from cache)"
+        )
+        latency = summary["latency_s"]
+        if latency["p50"] is not None:
+            print(
+                f"Latency: p50 {latency['p50']:.2f}s, p95 {latency['p95']:.2f}s, p99 {latency['p99']:.2f}s"
+            )
+        print(
+            f"Tokens per invoice: {summary['prompt_tokens_per_invoice']:.0f} prompt, {summary['completion_tokens_per_invoice']:.0f} completion"
+        )
+
+
+def to_record(invoice: InvoiceLike, result: ExtractionResult) -> dict:
+    record = {
+        "OriginalMessageItemId": invoice.OriginalMessageItemId,
+        "file_path": invoice.file_path,
+        "latency_s": result.latency_s,
+        "usage": result.usage,
+        "cached": result.cached,
+        "error": None,
+        "scores": {},
+        "extracted": None,
+    }
+    if isinstance(result.result, Exception):
+        record["error"] = repr(result.result)
+        return record
+    scores = result.scores
+    if scores is None:
+        expected = invoice.to_extracted().model_dump(warnings=False)
+        with stage(SCORE):
+            scores = score_invoice(result.result, expected)
+    record["scores"] = {
+        name: [c.predicted, c.expected, c.correct] for name, c in scores.items()
+    }
+    record["extracted"] = result.result
+    return record
+
+
+async def evaluate(
+    invoices: Iterable[InvoiceLike],
+    backend: ExtractionBackend,
+    output_path: str,
+    ledger: JobLedger,
+    shard: Tuple[int, int] = (0, 1),
+    batch: bool = False,
+    **runner_kwargs,
+) -> EvaluationReport:
+    """Extracts and scores this shard's invoices as results arrive, appending one JSON
+    line per invoice to `output_path`. Invoices `ledger` has completed are scored from
+    it rather than extracted again, so re-running an interrupted job resumes it.
+
+    With `batch`, the invoices are extracted through the Batch API (`run_batch_job`,
+    which `runner_kwargs` are passed to) instead. With a `pipeline` config, the
+    invoices go through `run_pipeline`, which scores them in its worker processes."""
+    report = EvaluationReport()
+    completed = ledger.completed()
+    in_flight: Dict[str, InvoiceLike] = {}
+
+    def items():
+        for invoice in invoices:
+            key = str(invoice.OriginalMessageItemId)
+            if shard_of(key, shard[1]) != shard[0]:
+                continue
+            if key in completed:
+                report.add(to_record(invoice, completed[key]))
+                continue
+            in_flight[key] = invoice
+            yield key, cast(str, invoice.file_path)
+
+    if runner_kwargs.get("pipeline") is not None:
+        runner_kwargs["expected"] = (
+            lambda key: in_flight[key].to_extracted().model_dump(warnings=False)
+        )
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    run = run_batch_job if batch else run_job
+    with open(output_path, "a") as f:
+        async for result in run(
+            backend, items(), ledger, shard, completed, **runner_kwargs
+        ):
+            invoice = in_flight.pop(result.key, None)
+            if invoice is None:
+                logger.warning("result for an invoice not evaluated", key=result.key)
+                continue
+            record = to_record(invoice, result)
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+            report.add(record)
+            if report.invoices % 100 == 0:
+                logger.info("evaluation progress", invoices=report.invoices)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Score an extraction backend against the manual extractions"
+    )
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="vision")
+    parser.add_argument("--limit", type=int, help="Only evaluate the first N invoices")
+    parser.add_argument("--max-concurrency", type=int, default=16)
+    parser.add_argument(
+        "--job",
+        help="Name of the job to start or resume, defaults to <backend>-<timestamp>",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=(0, 1),
+        help="Only evaluate shard i of n, as i/n, e.g., 0/4",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Extract through the Batch API, at half the cost but within 24 hours",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=60.0,
+        help="Seconds between checks on submitted batches, with --batch",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Build requests and score results in worker processes, see pipeline.py",
+    )
+    parser.add_argument(
+        "--prepare-workers",
+        type=int,
+        help="Processes building requests with --pipeline, defaults to one per core",
+    )
+    parser.add_argument(
+        "--score-workers",
+        type=int,
+        default=1,
+        help="Processes parsing and scoring responses with --pipeline",
+    )
+    args = parser.parse_args()
+
+    structlog.configure(
+        wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING)
+    )
+    job = args.job or f"{args.backend}-{datetime.datetime.now():%Y-%m-%dT%H%M%S}"
+    index, num_shards = args.shard
+    output_name = job if num_shards == 1 else f"{job}.shard-{index}-of-{num_shards}"
+    output_path = os.path.join(EVALUATIONS_DIR, f"{output_name}.jsonl")
+    # Shared by all shards of the job
+    ledger = JobLedger(os.path.join(EVALUATIONS_DIR, f"{job}.ledger.sqlite"))
+
+    # Extraction starts as soon as the first header is read, line items are only
+    # fetched to score each result
+    invoices = itertools.islice(iter_lazy_invoices(), args.limit)
+    backend = load_backend(args.backend)
+    if args.pipeline and getattr(backend, "aextract", None) is not None:
+        parser.error(f"--pipeline doesn't support the {args.backend} backend")
+    if args.batch:
+        runner_kwargs = {
+            "directory": os.path.join(EVALUATIONS_DIR, f"{job}.batches"),
+            "poll_interval_s": args.poll_interval,
+        }
+    else:
+        runner_kwargs = {"max_concurrency": args.max_concurrency}
+        if args.pipeline:
+            runner_kwargs["pipeline"] = PipelineConfig(
+                prepare_workers=args.prepare_workers, score_workers=args.score_workers
+            )
+    try:
+        report = asyncio.run(
+            evaluate(
+                invoices,
+                backend,
+                output_path,
+                ledger,
+                args.shard,
+                args.batch,
+                **runner_kwargs,
+            )
+        )
+    except KeyboardInterrupt:
+        sys.exit(
+            f"Interrupted, resume with --job {job}" + (" --batch" if args.batch else "")
+        )
+    finally:
+        ledger.close()
+    report.print()
+    summary = report.summary()
+    routing = getattr(backend, "report", None)
+    if isinstance(routing, RoutingReport):
+        print()
+        routing.print()
+        summary["routing"] = routing.summary()
+    stages = get_stage_report()
+    print()
+    stages.print()
+    summary["stages"] = stages.summary()
+    output_name = output_path.removesuffix(".jsonl")
+    with duckdb.connect(output_name + ".stages.duckdb") as con:
+        stages.to_duckdb(con)
+    with open(output_name + ".summary.json", "w") as f:
+        json.dump(summary, f, indent=4)
+    print(f"Results written to {output_path}")
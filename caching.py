@@ -0,0 +1,166 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional
+
+# Root directory for all on-disk caches, relative to the repo root like the input data
+CACHE_DIR = ".cache"
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+@functools.lru_cache(maxsize=4096)
+def _file_sha256_memo(path: str, size: int, mtime_ns: int) -> str:
+    return file_sha256(path)
+
+
+def file_digest(path: str) -> str:
+    """`file_sha256`, memoized per process until the file's size or mtime change."""
+    stat = os.stat(path)
+    return _file_sha256_memo(os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+
+
+def cache_path(*parts: str) -> str:
+    """Returns a path under `CACHE_DIR`, creating its parent directory if needed."""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class DiskCache:
+    """Persistent key/value store backed by SQLite, evicting the least recently used
+    entries once the stored values exceed `max_bytes`.
+
+    `hits` and `misses` count lookups made through this instance. SQLite handles the
+    locking, so several processes can share the same file.
+
+    Triggers keep the total size in a one-row `totals` table, so a `set` only scans
+    the entries when they need evicting, rather than summing them every time.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS entries (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                accessed_at REAL NOT NULL
+            )
+        """
+        )
+        self._con.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)"
+        )
+        self._con.execute("BEGIN IMMEDIATE")
+        try:
+            self._con.execute(
+                "CREATE TABLE IF NOT EXISTS totals (bytes INTEGER NOT NULL)"
+            )
+            # Counts what a cache created before the table already holds, once
+            self._con.execute(
+                """
+                INSERT INTO totals SELECT COALESCE(SUM(size), 0) FROM entries
+                WHERE NOT EXISTS (SELECT 1 FROM totals)
+            """
+            )
+            for trigger in [
+                """
+                CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+                BEGIN UPDATE totals SET bytes = bytes + new.size; END
+            """,
+                """
+                CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+                BEGIN UPDATE totals SET bytes = bytes - old.size + new.size; END
+            """,
+                """
+                CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+                BEGIN UPDATE totals SET bytes = bytes - old.size; END
+            """,
+            ]:
+                self._con.execute(trigger)
+            self._con.execute("COMMIT")
+        except BaseException:
+            self._con.execute("ROLLBACK")
+            raise
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            row = self._con.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._con.execute(
+                "UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key)
+            )
+            return row[0]
+
+    def set(self, key: str, value: bytes) -> None:
+        with self._lock:
+            # An upsert rather than `INSERT OR REPLACE`, whose delete doesn't fire the
+            # triggers
+            self._con.execute(
+                """
+                INSERT INTO entries VALUES (?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET
+                    value = excluded.value,
+                    size = excluded.size,
+                    accessed_at = excluded.accessed_at
+            """,
+                (key, value, len(value), time.time()),
+            )
+            self._evict()
+
+    def _total_bytes(self) -> int:
+        return self._con.execute("SELECT bytes FROM totals").fetchone()[0]
+
+    def _evict(self) -> None:
+        excess = self._total_bytes() - self.max_bytes
+        if excess <= 0:
+            return
+        keys = []
+        for key, size in self._con.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at"
+        ):
+            keys.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        self._con.executemany("DELETE FROM entries WHERE key = ?", keys)
+
+    def stats(self) -> dict:
+        with self._lock:
+            (entries,) = self._con.execute("SELECT COUNT(*) FROM entries").fetchone()
+            total = self._total_bytes()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": total,
+            "max_bytes": self.max_bytes,
+        }
+
+    def close(self) -> None:
+        self._con.close()
@@ -0,0 +1,180 @@
+import asyncio
+import functools
+from types import SimpleNamespace
+from typing import Callable, List, Optional, Tuple, cast
+
+import structlog
+from openai.types.chat import ChatCompletion
+
+import bb_gpt_4o_vision_chat
+from async_runner import AsyncExtractionRunner, ExtractionBackend
+from corpus_index import CorpusIndex, get_corpus_index
+from models import ExtractedInvoice
+
+logger = structlog.stdlib.get_logger()
+
+# Documents with fewer pages go out in a single request
+CHUNK_MIN_PAGES = 10
+PAGES_PER_CHUNK = 4
+# Pages each window shares with the previous one, so a table row broken across a page
+# boundary is seen whole by at least one request. Line items read twice are dropped
+# when merging
+CHUNK_OVERLAP_PAGES = 1
+# Printed at the end of the invoice, so taken from the last chunk that has them
+TOTAL_FIELDS = ("InvoiceAmount", "SalesTaxAmount", "ShippingCharges")
+
+
+def page_windows(
+    page_count: int,
+    pages_per_chunk: int = PAGES_PER_CHUNK,
+    overlap: int = CHUNK_OVERLAP_PAGES,
+) -> List[range]:
+    """Consecutive windows of `pages_per_chunk` pages covering the document, each
+    starting `overlap` pages before the previous one ends."""
+    if not 0 <= overlap < pages_per_chunk:
+        raise ValueError(
+            f"Overlap must be in [0, {pages_per_chunk}), got {overlap} pages"
+        )
+    windows = []
+    start = 0
+    while True:
+        stop = min(start + pages_per_chunk, page_count)
+        windows.append(range(start, stop))
+        if stop >= page_count:
+            return windows
+        start = stop - overlap
+
+
+def _line_item_key(item: dict) -> tuple:
+    return (
+        " ".join(str(item.get("ItemDescription") or "").split()).casefold(),
+        str(item.get("SupplierPartNum") or "").strip().casefold(),
+        item.get("Quantity"),
+        item.get("LineItemTotal"),
+    )
+
+
+def _fill_blanks(merged: dict, other: dict) -> None:
+    for name, value in other.items():
+        if isinstance(value, dict) and isinstance(merged.get(name), dict):
+            _fill_blanks(merged[name], value)
+        elif not merged.get(name) and value:
+            merged[name] = value
+
+
+def _overlap_length(previous: List[tuple], current: List[tuple]) -> int:
+    """Number of leading `current` items which repeat the items `previous` ends with,
+    i.e., the ones read from the pages both windows share. The last `previous` item
+    may be skipped, as it can be a row the window cut off at its last page."""
+    for length in range(min(len(previous), len(current)), 0, -1):
+        for cut_off in (0, 1):
+            end = len(previous) - cut_off
+            if length <= end and previous[end - length : end] == current[:length]:
+                return length
+    return 0
+
+
+def merge_extractions(chunks: List[dict], dedupe_adjacent: bool = True) -> dict:
+    """Merges the extractions of consecutive page windows into one extraction.
+
+    Identifying header fields come from the first chunk that has them, totals from the
+    last. Line items are concatenated in page order; with `dedupe_adjacent`, the run
+    of line items a chunk starts with is dropped if the previous chunk ended with the
+    same run, as it was read from the pages they share. Identical rows elsewhere, e.g.,
+    a part ordered on several pages, are kept.
+    """
+    header: dict = {}
+    for chunk in chunks:
+        _fill_blanks(header, chunk.get("InvoiceHeaderInfo") or {})
+    for name in TOTAL_FIELDS:
+        for chunk in reversed(chunks):
+            value = (chunk.get("InvoiceHeaderInfo") or {}).get(name)
+            if value:
+                header[name] = value
+                break
+
+    line_items: List[dict] = []
+    previous: List[tuple] = []
+    for chunk in chunks:
+        items = chunk.get("InvoiceLineItems") or []
+        keys = [_line_item_key(item) for item in items]
+        skip = _overlap_length(previous, keys) if dedupe_adjacent else 0
+        line_items.extend(items[skip:])
+        previous = keys
+
+    merged = ExtractedInvoice.model_validate(
+        {"InvoiceHeaderInfo": header, "InvoiceLineItems": line_items}
+    )
+    return merged.model_dump()
+
+
+class ChunkedBackend:
+    """Vision backend which splits long PDFs into overlapping page windows, extracts
+    each window concurrently and merges the results with `merge_extractions`.
+
+    A long invoice then takes about as long as its slowest window rather than as long
+    as one request over every page, and no request exceeds `pages_per_chunk` images.
+    Only `AsyncExtractionRunner` chunks, through `aextract`; `build_request` sends the
+    whole document.
+    """
+
+    def __init__(
+        self,
+        backend: ExtractionBackend = cast(ExtractionBackend, bb_gpt_4o_vision_chat),
+        pages_per_chunk: int = PAGES_PER_CHUNK,
+        overlap: int = CHUNK_OVERLAP_PAGES,
+        min_pages: int = CHUNK_MIN_PAGES,
+        index: Optional[CorpusIndex] = None,
+    ):
+        self.backend = backend
+        self.pages_per_chunk = pages_per_chunk
+        self.overlap = overlap
+        self.min_pages = min_pages
+        self.index = index or get_corpus_index()
+
+    def build_request(self, pdf_path: str) -> dict:
+        return self.backend.build_request(pdf_path)
+
+    def parse_response(self, response: ChatCompletion) -> dict:
+        return self.backend.parse_response(response)
+
+    def _window_backend(self, pages: range) -> ExtractionBackend:
+        """`backend` restricted to `pages`."""
+        # Backends chunked this way take the `pages` to send
+        build_request: Callable[..., dict] = self.backend.build_request
+        methods = dict(
+            build_request=functools.partial(build_request, pages=pages),
+            parse_response=self.backend.parse_response,
+        )
+        abuild_request = getattr(self.backend, "abuild_request", None)
+        if abuild_request is not None:
+            methods["abuild_request"] = functools.partial(abuild_request, pages=pages)
+        return cast(ExtractionBackend, SimpleNamespace(**methods))
+
+    async def aextract(
+        self, runner: AsyncExtractionRunner, pdf_path: str
+    ) -> Tuple[dict, List[ChatCompletion]]:
+        info = await asyncio.to_thread(self.index.lookup, pdf_path)
+        if info.page_count < self.min_pages:
+            result, response = await runner.extract_with(self.backend, pdf_path)
+            return result, [response]
+        windows = page_windows(info.page_count, self.pages_per_chunk, self.overlap)
+        logger.info(
+            "extracting in chunks",
+            pdf_path=pdf_path,
+            pdf_page_count=info.page_count,
+            chunks=len(windows),
+        )
+        extractions = await asyncio.gather(
+            *(
+                runner.extract_with(self._window_backend(pages), pdf_path)
+                for pages in windows
+            )
+        )
+        chunks = [result for result, _ in extractions]
+        responses = [response for _, response in extractions]
+        return merge_extractions(chunks, dedupe_adjacent=self.overlap > 0), responses
+
+
+def create_backend(**kwargs) -> ExtractionBackend:
+    return cast(ExtractionBackend, ChunkedBackend(**kwargs))
@@ -0,0 +1,235 @@
+import functools
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import pymupdf
+import structlog
+
+from caching import cache_path, file_sha256
+
+logger = structlog.stdlib.get_logger()
+
+# Characters of extracted text above which a page counts as having a text layer, so
+# stray OCR artifacts or page numbers stamped on a scan don't
+TEXT_LAYER_MIN_CHARS = 32
+# Rows written per transaction while indexing
+INDEX_COMMIT_EVERY = 256
+
+
+@dataclass(frozen=True, slots=True)
+class PdfInfo:
+    """What the pipeline needs to know about a PDF without opening it again."""
+
+    file_path: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    # `(width, height)` in points and characters of extractable text, per page
+    page_sizes: List[Tuple[float, float]]
+    page_text_chars: List[int]
+    # Why the file couldn't be read, e.g., it isn't a PDF
+    error: Optional[str] = None
+
+    @property
+    def page_count(self) -> int:
+        return len(self.page_sizes)
+
+    @property
+    def text_pages(self) -> int:
+        return sum(chars >= TEXT_LAYER_MIN_CHARS for chars in self.page_text_chars)
+
+    @property
+    def has_text_layer(self) -> bool:
+        """Whether every page has a text layer, i.e., the PDF is text-native rather
+        than (partly) scanned."""
+        return self.page_count > 0 and self.text_pages == self.page_count
+
+
+def inspect_pdf(file_path: str) -> PdfInfo:
+    """Reads a PDF's metadata. Runs in the worker processes."""
+    stat = os.stat(file_path)
+    sha256 = file_sha256(file_path)
+    page_sizes: List[Tuple[float, float]] = []
+    page_text_chars: List[int] = []
+    try:
+        with pymupdf.open(file_path) as doc:
+            for page in doc:
+                page_sizes.append((page.rect.width, page.rect.height))
+                text: str = page.get_text(
+                    "text"
+                )  # pyright: ignore[reportAssignmentType]
+                page_text_chars.append(len(text.strip()))
+    except Exception as e:
+        return PdfInfo(
+            file_path, stat.st_size, stat.st_mtime_ns, sha256, [], [], repr(e)
+        )
+    return PdfInfo(
+        file_path,
+        stat.st_size,
+        stat.st_mtime_ns,
+        sha256,
+        page_sizes,
+        page_text_chars,
+    )
+
+
+class CorpusIndex:
+    """Persistent `PdfInfo` per file path, valid while the file's size and mtime are
+    unchanged. `update` only inspects new or changed files, across a process pool.
+
+    SQLite handles the locking, so several processes can share the same file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pdfs (
+                file_path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                page_sizes TEXT NOT NULL,
+                page_text_chars TEXT NOT NULL,
+                error TEXT,
+                indexed_at REAL NOT NULL
+            )
+        """
+        )
+
+    @staticmethod
+    def _from_row(row: tuple) -> PdfInfo:
+        file_path, size, mtime_ns, sha256, page_sizes, page_text_chars, error = row
+        return PdfInfo(
+            file_path,
+            size,
+            mtime_ns,
+            sha256,
+            [tuple(s) for s in json.loads(page_sizes)],
+            json.loads(page_text_chars),
+            error,
+        )
+
+    def _entries(self, file_paths: Optional[List[str]] = None) -> Dict[str, PdfInfo]:
+        query = "SELECT file_path, size, mtime_ns, sha256, page_sizes, page_text_chars, error FROM pdfs"
+        with self._lock:
+            if file_paths is None:
+                rows = self._con.execute(query).fetchall()
+            else:
+                rows = []
+                # Stay under SQLite's limit on bound parameters
+                for i in range(0, len(file_paths), 500):
+                    chunk = file_paths[i : i + 500]
+                    rows += self._con.execute(
+                        f"{query} WHERE file_path IN ({', '.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+        return {row[0]: self._from_row(row) for row in rows}
+
+    def get(self, file_path: str) -> Optional[PdfInfo]:
+        """The indexed info, or `None` if the file isn't indexed or has changed since."""
+        info = self._entries([file_path]).get(file_path)
+        if info is None:
+            return None
+        stat = os.stat(file_path)
+        if (info.size, info.mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            return None
+        return info
+
+    def lookup(self, file_path: str) -> PdfInfo:
+        """`get`, inspecting and indexing the file in this process if needed."""
+        info = self.get(file_path)
+        if info is None:
+            info = inspect_pdf(file_path)
+            self._put([info])
+        return info
+
+    def _put(self, infos: List[PdfInfo]) -> None:
+        now = time.time()
+        with self._lock:
+            self._con.execute("BEGIN")
+            try:
+                self._con.executemany(
+                    "INSERT OR REPLACE INTO pdfs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            info.file_path,
+                            info.size,
+                            info.mtime_ns,
+                            info.sha256,
+                            json.dumps(info.page_sizes),
+                            json.dumps(info.page_text_chars),
+                            info.error,
+                            now,
+                        )
+                        for info in infos
+                    ],
+                )
+                self._con.execute("COMMIT")
+            except BaseException:
+                # Otherwise the connection stays in the transaction, and the next
+                # `BEGIN` fails
+                self._con.execute("ROLLBACK")
+                raise
+
+    def update(
+        self,
+        file_paths: Iterable[str],
+        max_workers: Optional[int] = None,
+        prune: bool = False,
+    ) -> Dict[str, PdfInfo]:
+        """Indexes the new or changed `file_paths` and returns the info of all of them.
+        With `prune`, entries for files not in `file_paths` are removed."""
+        file_paths = list(file_paths)
+        entries = self._entries(file_paths)
+        stale = []
+        for file_path in file_paths:
+            stat = os.stat(file_path)
+            info = entries.get(file_path)
+            if info is None or (info.size, info.mtime_ns) != (
+                stat.st_size,
+                stat.st_mtime_ns,
+            ):
+                stale.append(file_path)
+        logger.info("updating corpus index", files=len(file_paths), stale=len(stale))
+
+        if stale:
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                infos = executor.map(inspect_pdf, stale, chunksize=16)
+                # Commit as results arrive, so an interrupted update keeps its progress
+                while batch := list(itertools.islice(infos, INDEX_COMMIT_EVERY)):
+                    self._put(batch)
+                    entries.update((info.file_path, info) for info in batch)
+
+        if prune:
+            keep = set(file_paths)
+            removed = [p for p in self._entries() if p not in keep]
+            with self._lock:
+                self._con.executemany(
+                    "DELETE FROM pdfs WHERE file_path = ?", [(p,) for p in removed]
+                )
+        return {file_path: entries[file_path] for file_path in file_paths}
+
+    def __iter__(self) -> Iterator[PdfInfo]:
+        return iter(self._entries().values())
+
+    def close(self) -> None:
+        self._con.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_corpus_index() -> CorpusIndex:
+    return CorpusIndex(cache_path("corpus_index.sqlite"))
@@ -0,0 +1,187 @@
+import array
+import functools
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Dict, Iterator
+
+import duckdb
+import numpy
+import pandas
+import structlog
+
+logger = structlog.stdlib.get_logger()
+
+PDF_OPEN = "pdf_open"
+RASTERIZE = "rasterize"
+MARKDOWN = "markdown"
+ENCODE = "encode"
+REQUEST = "request"
+VALIDATE = "validate"
+SCORE = "score"
+# Pipeline order, for the summary table
+STAGES = (PDF_OPEN, RASTERIZE, MARKDOWN, ENCODE, REQUEST, VALIDATE, SCORE)
+
+
+def _peak_rss_bytes() -> int:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+@dataclass(slots=True)
+class StageSample:
+    stage: str
+    wall_s: float = 0.0
+    # CPU time of the thread running the stage. For stages spanning `await`s, this
+    # includes whatever else the event loop ran meanwhile
+    cpu_s: float = 0.0
+    # The process's high-water mark when the stage finished
+    peak_rss_bytes: int = 0
+    # Set by the stage, e.g., image bytes rendered or tokens used
+    bytes: int = 0
+    tokens: int = 0
+    failed: bool = False
+
+
+# Columns of `StageSample` kept per stage, with their `array` type codes
+_COLUMNS = {
+    "wall_s": "d",
+    "cpu_s": "d",
+    "peak_rss_bytes": "q",
+    "bytes": "q",
+    "tokens": "q",
+    "failed": "b",
+}
+
+
+class StageReport:
+    """`StageSample`s of a run, aggregated per stage. Samples are kept as compact
+    columns, ~50 bytes each, so a run over the whole corpus can keep all of them.
+
+    Only stages running in this process are recorded, e.g., page rendering in the
+    render pool's workers shows up as the `rasterize` stage waiting on them.
+    """
+
+    def __init__(self):
+        self.columns: Dict[str, Dict[str, array.array]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, sample: StageSample) -> None:
+        with self._lock:
+            columns = self.columns.get(sample.stage)
+            if columns is None:
+                columns = {name: array.array(code) for name, code in _COLUMNS.items()}
+                self.columns[sample.stage] = columns
+            for name, column in columns.items():
+                column.append(getattr(sample, name))
+
+    def summary(self) -> Dict[str, dict]:
+        order = {name: i for i, name in enumerate(STAGES)}
+        summary = {}
+        with self._lock:
+            for name in sorted(
+                self.columns, key=lambda name: order.get(name, len(order))
+            ):
+                c = {
+                    k: numpy.frombuffer(v, dtype=v.typecode)
+                    for k, v in self.columns[name].items()
+                }
+                p50, p95 = numpy.percentile(c["wall_s"], [50, 95])
+                summary[name] = {
+                    "count": len(c["wall_s"]),
+                    "failed": int(c["failed"].sum()),
+                    "wall_s": float(c["wall_s"].sum()),
+                    "wall_s_p50": float(p50),
+                    "wall_s_p95": float(p95),
+                    "cpu_s": float(c["cpu_s"].sum()),
+                    "bytes": int(c["bytes"].sum()),
+                    "tokens": int(c["tokens"].sum()),
+                    "peak_rss_bytes": int(c["peak_rss_bytes"].max()),
+                }
+        return summary
+
+    def print(self) -> None:
+        print(
+            f"{'stage':>10} {'count':>7} {'wall s':>9} {'p50 ms':>8} {'p95 ms':>8} {'cpu s':>8} {'MB':>9} {'tokens':>10} {'peak RSS MB':>12}"
+        )
+        for name, s in self.summary().items():
+            print(
+                f"{name:>10} {s['count']:>7} {s['wall_s']:9.2f} {s['wall_s_p50'] * 1000:8.1f} {s['wall_s_p95'] * 1000:8.1f} "
+                f"{s['cpu_s']:8.2f} {s['bytes'] / 1e6:9.1f} {s['tokens']:>10} {s['peak_rss_bytes'] / 1e6:12.0f}"
+            )
+
+    def to_duckdb(self, con: duckdb.DuckDBPyConnection, table: str = "stages") -> None:
+        """Appends every sample to `table`, one row per stage run, for querying runs
+        at production scale."""
+        con.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                stage VARCHAR, wall_s DOUBLE, cpu_s DOUBLE, peak_rss_bytes BIGINT,
+                bytes BIGINT, tokens BIGINT, failed BOOLEAN
+            )
+        """
+        )
+        with self._lock:
+            frames = [
+                pandas.DataFrame(
+                    {
+                        "stage": name,
+                        **{
+                            k: numpy.frombuffer(v, dtype=v.typecode).copy()
+                            for k, v in columns.items()
+                        },
+                    }
+                )
+                for name, columns in self.columns.items()
+            ]
+        if not frames:
+            return
+        samples = pandas.concat(frames, ignore_index=True)
+        samples["failed"] = samples["failed"].astype(bool)
+        # One bulk insert, row by row `executemany` takes seconds per 10k samples
+        con.register("stage_samples", samples)
+        try:
+            con.execute(
+                f"INSERT INTO {table} SELECT stage, {', '.join(_COLUMNS)} FROM stage_samples"
+            )
+        finally:
+            con.unregister("stage_samples")
+
+
+@functools.lru_cache(maxsize=None)
+def get_stage_report() -> StageReport:
+    """The process-wide report every `stage` is recorded in."""
+    return StageReport()
+
+
+@contextmanager
+def stage(name: str, **log_fields) -> Iterator[StageSample]:
+    """Measures the block as a run of stage `name`, logging it and recording it in
+    `get_stage_report()`. Set `bytes` and `tokens` on the yielded sample."""
+    sample = StageSample(name)
+    start_wall, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield sample
+    except BaseException:
+        sample.failed = True
+        raise
+    finally:
+        sample.wall_s = time.perf_counter() - start_wall
+        sample.cpu_s = time.thread_time() - start_cpu
+        sample.peak_rss_bytes = _peak_rss_bytes()
+        get_stage_report().add(sample)
+        logger.debug(
+            "stage",
+            stage=name,
+            wall_s=sample.wall_s,
+            cpu_s=sample.cpu_s,
+            peak_rss_bytes=sample.peak_rss_bytes,
+            bytes=sample.bytes,
+            tokens=sample.tokens,
+            failed=sample.failed,
+            **log_fields,
+        )
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+import structlog
+
+from async_runner import AsyncExtractionRunner, ExtractionBackend, ExtractionResult
+from pipeline import PipelineConfig, run_pipeline
+
+logger = structlog.stdlib.get_logger()
+
+DONE = "done"
+FAILED = "failed"
+
+
+def shard_of(item_id: str, num_shards: int) -> int:
+    """Stable shard of an item, the same in every process and on every machine (unlike
+    the salted `hash()`)."""
+    digest = hashlib.sha256(item_id.encode()).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parses `"i/n"`, e.g., `"0/4"` for the first of four shards."""
+    index, num_shards = (int(part) for part in value.split("/"))
+    if not 0 <= index < num_shards:
+        raise ValueError(f"Shard index must be in [0, {num_shards}), got {index}")
+    return index, num_shards
+
+
+class JobLedger:
+    """Status and result of every item of an extraction job, committed as each item
+    completes so an interrupted job can resume where it stopped.
+
+    Failed items are retried on the next run, only completed ones are skipped. SQLite
+    handles the locking, so shards running in separate processes can share a ledger.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._con = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                item_id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                result TEXT,
+                error TEXT,
+                latency_s REAL,
+                usage TEXT,
+                cached INTEGER,
+                updated_at REAL NOT NULL
+            )
+        """
+        )
+        # Batch API submissions whose results haven't been recorded yet, so a resumed
+        # job polls them instead of submitting their items again. `shard` is the
+        # `"i/n"` of the run which submitted the batch
+        self._con.execute(
+            """
+            CREATE TABLE IF NOT EXISTS batches (
+                batch_id TEXT PRIMARY KEY,
+                shard TEXT NOT NULL,
+                item_ids TEXT NOT NULL,
+                finished INTEGER NOT NULL,
+                submitted_at REAL NOT NULL
+            )
+        """
+        )
+
+    def record(self, result: ExtractionResult) -> None:
+        failed = isinstance(result.result, Exception)
+        with self._lock:
+            self._con.execute(
+                """
+                INSERT INTO items VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (item_id) DO UPDATE SET
+                    status = excluded.status,
+                    attempts = attempts + 1,
+                    result = excluded.result,
+                    error = excluded.error,
+                    latency_s = excluded.latency_s,
+                    usage = excluded.usage,
+                    cached = excluded.cached,
+                    updated_at = excluded.updated_at
+            """,
+                (
+                    result.key,
+                    FAILED if failed else DONE,
+                    None if failed else json.dumps(result.result, default=str),
+                    repr(result.result) if failed else None,
+                    result.latency_s,
+                    json.dumps(result.usage) if result.usage else None,
+                    result.cached,
+                    time.time(),
+                ),
+            )
+
+    def completed(self) -> Dict[str, ExtractionResult]:
+        """Results of the completed items, as they were when first extracted."""
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT item_id, result, latency_s, usage, cached FROM items WHERE status = ?",
+                (DONE,),
+            ).fetchall()
+        return {
+            item_id: ExtractionResult(
+                item_id,
+                json.loads(result),
+                latency_s,
+                json.loads(usage) if usage else None,
+                bool(cached),
+            )
+            for item_id, result, latency_s, usage, cached in rows
+        }
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(
+                self._con.execute(
+                    "SELECT status, COUNT(*) FROM items GROUP BY status"
+                ).fetchall()
+            )
+
+    def record_batch(self, batch_id: str, shard: str, item_ids: List[str]) -> None:
+        with self._lock:
+            self._con.execute(
+                "INSERT INTO batches VALUES (?, ?, ?, 0, ?)",
+                (batch_id, shard, json.dumps(item_ids), time.time()),
+            )
+
+    def finish_batch(self, batch_id: str) -> None:
+        with self._lock:
+            self._con.execute(
+                "UPDATE batches SET finished = 1 WHERE batch_id = ?", (batch_id,)
+            )
+
+    def pending_batches(self, shard: Optional[str] = None) -> Dict[str, List[str]]:
+        """Item ids per submitted batch whose results aren't recorded yet, only of the
+        batches `shard` submitted if given."""
+        with self._lock:
+            rows = self._con.execute(
+                "SELECT batch_id, item_ids FROM batches WHERE finished = 0"
+                + (" AND shard = ?" if shard is not None else ""),
+                () if shard is None else (shard,),
+            ).fetchall()
+        return {batch_id: json.loads(item_ids) for batch_id, item_ids in rows}
+
+    def close(self) -> None:
+        self._con.close()
+
+
+async def run_job(
+    backend: ExtractionBackend,
+    items: Iterable[Tuple[str, str]],
+    ledger: JobLedger,
+    shard: Tuple[int, int] = (0, 1),
+    completed: Optional[Dict[str, ExtractionResult]] = None,
+    pipeline: Optional[PipelineConfig] = None,
+    expected: Optional[Callable[[str], Optional[dict]]] = None,
+    **runner_kwargs,
+) -> AsyncIterator[ExtractionResult]:
+    """`AsyncExtractionRunner.run` over this shard's `(item id, pdf_path)` items,
+    skipping the items `ledger` has completed and recording every new result in it.
+    With `pipeline`, the items go through `run_pipeline` instead (scored with
+    `expected`).
+
+    Pass `completed` when the caller already read `ledger.completed()`.
+    """
+    index, num_shards = shard
+    if completed is None:
+        completed = ledger.completed()
+    skipped = 0
+
+    def todo():
+        nonlocal skipped
+        for item_id, pdf_path in items:
+            if shard_of(item_id, num_shards) != index:
+                continue
+            if item_id in completed:
+                skipped += 1
+                continue
+            yield item_id, pdf_path
+
+    async with AsyncExtractionRunner(backend, **runner_kwargs) as runner:
+        if pipeline is None:
+            results = runner.run(todo())
+        else:
+            results = run_pipeline(runner, todo(), pipeline, expected)
+        async for result in results:
+            ledger.record(result)
+            yield result
+    logger.info(
+        "job shard finished",
+        shard=f"{index}/{num_shards}",
+        skipped=skipped,
+        ledger=ledger.counts(),
+    )
@@ -0,0 +1,451 @@
+import json
+import random
+import socket
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple, cast
+
+import structlog
+
+logger = structlog.stdlib.get_logger()
+
+# Characters of tool call arguments per streamed chunk, a few tokens' worth
+STREAM_CHUNK_CHARS = 16
+
+# Canned `extract_invoice_info` arguments returned by the mock
+MOCK_EXTRACTION = {
+    "InvoiceHeaderInfo": {
+        "InvoiceNumber": "INV-0000001",
+        "InvoiceAmount": 123.45,
+        "InvoiceDate": "2024-06-01T00:00:00",
+        "PurchaseOrder": "PO000001",
+        "SalesTaxAmount": 0.0,
+        "ShippingCharges": 0.0,
+        "VendorContactInfo": {
+            "ContactName": "Vendor 1",
+            "ContactAddress1": "1 Main St",
+            "ContactAddress2": "",
+            "ContactCity": "Springfield",
+            "ContactState": "IL",
+        },
+    },
+    "InvoiceLineItems": [
+        {
+            "ItemDescription": "Widget",
+            "Quantity": 1.0,
+            "UnitPrice": 123.45,
+            "LineItemNetTotal": 123.45,
+            "LineItemTotal": 123.45,
+            "SupplierPartNum": "P-00001",
+            "UnitOfMeasure": "EA",
+        }
+    ],
+}
+
+
+def chat_completion(request: dict, arguments: str) -> dict:
+    """Builds a chat completion which calls the requested tool with `arguments`."""
+    tool_choice = request.get("tool_choice") or {}
+    tool_name = tool_choice.get("function", {}).get("name", "extract_invoice_info")
+    prompt_tokens = len(json.dumps(request.get("messages", []))) // 4
+    completion_tokens = len(arguments) // 4
+    return {
+        "id": f"chatcmpl-mock-{random.getrandbits(32):08x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": request.get("model", "mock"),
+        "choices": [
+            {
+                "index": 0,
+                "finish_reason": "tool_calls",
+                "message": {
+                    "role": "assistant",
+                    "content": None,
+                    "tool_calls": [
+                        {
+                            "id": "call_mock",
+                            "type": "function",
+                            "function": {"name": tool_name, "arguments": arguments},
+                        }
+                    ],
+                },
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def _multipart_form(content_type: str, body: bytes) -> Dict[str, Tuple[str, bytes]]:
+    """`(filename, content)` per field of a `multipart/form-data` body."""
+    message = BytesParser(policy=HTTP).parsebytes(
+        f"Content-Type: {content_type}\r\n\r\n".encode() + body
+    )
+    form = {}
+    for part in message.iter_parts():
+        name = str(part.get_param("name", header="content-disposition"))
+        form[name] = (
+            part.get_filename() or "",
+            cast(bytes, part.get_payload(decode=True)),
+        )
+    return form
+
+
+def _batch_output_line(batch_id: str, line: dict, status: int, body: dict) -> str:
+    return json.dumps(
+        {
+            "id": f"batch_req_{random.getrandbits(32):08x}",
+            "custom_id": line["custom_id"],
+            "response": {
+                "status_code": status,
+                "request_id": f"{batch_id}-{line['custom_id']}",
+                "body": body,
+            },
+            "error": None,
+        }
+    )
+
+
+class MockOpenAIServer:
+    """Local stand-in for the OpenAI chat completions endpoint, for exercising the
+    extraction clients without network access or API spend.
+
+    `latency_s` is added to every response, and `error_rate` of requests fail with
+    `error_status` (e.g., 429 or 500) to exercise retries. Streamed responses
+    (`stream=True`) spread `latency_s` over their chunks instead.
+
+    The files and batches endpoints are faked too: a batch completes on the first poll
+    at least `batch_latency_s` after it was created, with `error_rate` of its requests
+    in the error file.
+
+        with MockOpenAIServer(latency_s=0.5) as server:
+            client = openai.OpenAI(base_url=server.base_url, api_key="mock")
+    """
+
+    def __init__(
+        self,
+        latency_s: float = 0.0,
+        error_rate: float = 0.0,
+        error_status: int = 429,
+        arguments: Optional[str] = None,
+        batch_latency_s: float = 0.0,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ):
+        self.latency_s = latency_s
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.arguments = arguments or json.dumps(MOCK_EXTRACTION)
+        self.batch_latency_s = batch_latency_s
+        self.request_count = 0
+        self.error_count = 0
+        self.streams_closed_early = 0
+        self.files: Dict[str, dict] = {}
+        self.file_contents: Dict[str, bytes] = {}
+        self.batches: Dict[str, dict] = {}
+        # `created_at` is in whole seconds, so keep the precise time for
+        # `batch_latency_s`
+        self._batch_created: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _new_id(self, prefix: str) -> str:
+        return f"{prefix}-mock-{random.getrandbits(32):08x}"
+
+    def _create_file(self, filename: str, content: bytes, purpose: str) -> dict:
+        file = {
+            "id": self._new_id("file"),
+            "object": "file",
+            "bytes": len(content),
+            "created_at": int(time.time()),
+            "filename": filename,
+            "purpose": purpose,
+            "status": "processed",
+        }
+        self.files[file["id"]] = file
+        self.file_contents[file["id"]] = content
+        return file
+
+    def _create_batch(self, request: dict) -> dict:
+        batch = {
+            "id": self._new_id("batch"),
+            "object": "batch",
+            "endpoint": request["endpoint"],
+            "input_file_id": request["input_file_id"],
+            "completion_window": request["completion_window"],
+            "metadata": request.get("metadata"),
+            "status": "in_progress",
+            "created_at": int(time.time()),
+            "in_progress_at": int(time.time()),
+            "request_counts": {"total": 0, "completed": 0, "failed": 0},
+        }
+        self.batches[batch["id"]] = batch
+        self._batch_created[batch["id"]] = time.monotonic()
+        return batch
+
+    def _process_batch(self, batch: dict) -> None:
+        """Runs the batch's requests, writing the output and error files."""
+        lines = [
+            json.loads(line)
+            for line in self.file_contents[batch["input_file_id"]].splitlines()
+            if line.strip()
+        ]
+        output, errors = [], []
+        for line in lines:
+            self.request_count += 1
+            if random.random() < self.error_rate:
+                self.error_count += 1
+                errors.append(
+                    _batch_output_line(
+                        batch["id"],
+                        line,
+                        self.error_status,
+                        {"error": {"message": "mock error", "type": "mock"}},
+                    )
+                )
+            else:
+                output.append(
+                    _batch_output_line(
+                        batch["id"],
+                        line,
+                        200,
+                        chat_completion(line["body"], self.arguments),
+                    )
+                )
+        for name, file_lines in [("output", output), ("error", errors)]:
+            if file_lines:
+                file = self._create_file(
+                    f"{batch['id']}_{name}.jsonl",
+                    "\n".join(file_lines).encode() + b"\n",
+                    "batch_output",
+                )
+                batch[f"{name}_file_id"] = file["id"]
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {
+            "total": len(lines),
+            "completed": len(output),
+            "failed": len(errors),
+        }
+
+    def _get_batch(self, batch_id: str) -> Optional[dict]:
+        with self._lock:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return None
+            if (
+                batch["status"] == "in_progress"
+                and time.monotonic() - self._batch_created[batch_id]
+                >= self.batch_latency_s
+            ):
+                self._process_batch(batch)
+            return dict(batch)
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                # Headers and body are written separately, so without this Nagle's
+                # algorithm adds ~40ms to every keep-alive response
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(
+                self, status: int, body: dict, headers: Optional[dict] = None
+            ):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def _send_stream(self, request: dict):
+                """Streams the completion as server-sent events, spreading `latency_s`
+                over the argument chunks like a model generating them."""
+                completion = chat_completion(request, server.arguments)
+                call = completion["choices"][0]["message"]["tool_calls"][0]
+                arguments = call["function"]["arguments"]
+                pieces = [
+                    arguments[i : i + STREAM_CHUNK_CHARS]
+                    for i in range(0, len(arguments), STREAM_CHUNK_CHARS)
+                ]
+                base = {
+                    "id": completion["id"],
+                    "object": "chat.completion.chunk",
+                    "created": completion["created"],
+                    "model": completion["model"],
+                }
+
+                def delta(delta: dict, finish_reason: Optional[str] = None) -> dict:
+                    choice = {
+                        "index": 0,
+                        "delta": delta,
+                        "finish_reason": finish_reason,
+                    }
+                    return {**base, "choices": [choice]}
+
+                events = [
+                    delta(
+                        {
+                            "role": "assistant",
+                            "tool_calls": [
+                                {
+                                    "index": 0,
+                                    "id": call["id"],
+                                    "type": "function",
+                                    "function": {
+                                        "name": call["function"]["name"],
+                                        "arguments": "",
+                                    },
+                                }
+                            ],
+                        }
+                    ),
+                    *(
+                        delta(
+                            {
+                                "tool_calls": [
+                                    {"index": 0, "function": {"arguments": piece}}
+                                ]
+                            }
+                        )
+                        for piece in pieces
+                    ),
+                    delta({}, "tool_calls"),
+                ]
+                if (request.get("stream_options") or {}).get("include_usage"):
+                    events.append({**base, "choices": [], "usage": completion["usage"]})
+
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                start = time.monotonic()
+                try:
+                    for i, event in enumerate([*events, "[DONE]"]):
+                        if 0 < i <= len(pieces):
+                            # Against a deadline, so oversleeping doesn't accumulate
+                            deadline = start + server.latency_s * i / len(pieces)
+                            time.sleep(max(0.0, deadline - time.monotonic()))
+                        data = event if isinstance(event, str) else json.dumps(event)
+                        payload = f"data: {data}\n\n".encode()
+                        self.wfile.write(
+                            f"{len(payload):x}\r\n".encode() + payload + b"\r\n"
+                        )
+                        self.wfile.flush()
+                    self.wfile.write(b"0\r\n\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    # The client stopped reading, e.g., after a validation error
+                    with server._lock:
+                        server.streams_closed_early += 1
+                    self.close_connection = True
+
+            def _not_found(self):
+                self._send_json(404, {"error": {"message": "not found"}})
+
+            def do_GET(self):
+                parts = self.path.split("?")[0].strip("/").split("/")
+                if parts[-2:-1] == ["batches"]:
+                    batch = server._get_batch(parts[-1])
+                    if batch is None:
+                        return self._not_found()
+                    return self._send_json(200, batch)
+                if parts[-3:-2] == ["files"] and parts[-1] == "content":
+                    content = server.file_contents.get(parts[-2])
+                    if content is None:
+                        return self._not_found()
+                    self.send_response(200)
+                    self.send_header("Content-Type", "application/octet-stream")
+                    self.send_header("Content-Length", str(len(content)))
+                    self.end_headers()
+                    self.wfile.write(content)
+                    return
+                self._not_found()
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                path = self.path.split("?")[0].rstrip("/")
+                if path.endswith("/files"):
+                    form = _multipart_form(self.headers["Content-Type"], body)
+                    filename, content = form["file"]
+                    with server._lock:
+                        file = server._create_file(
+                            filename, content, form["purpose"][1].decode()
+                        )
+                    return self._send_json(200, file)
+                if path.endswith("/batches"):
+                    with server._lock:
+                        batch = dict(server._create_batch(json.loads(body)))
+                    return self._send_json(200, batch)
+                if not path.endswith("/chat/completions"):
+                    return self._not_found()
+                request = json.loads(body or b"{}")
+
+                with server._lock:
+                    server.request_count += 1
+                    fail = random.random() < server.error_rate
+                    if fail:
+                        server.error_count += 1
+                stream = bool(request.get("stream"))
+                if fail or not stream:
+                    time.sleep(server.latency_s)
+                if fail:
+                    self._send_json(
+                        server.error_status,
+                        {"error": {"message": "mock error", "type": "mock"}},
+                        {"retry-after-ms": "10"},
+                    )
+                    return
+                if stream:
+                    self._send_stream(request)
+                    return
+                self._send_json(200, chat_completion(request, server.arguments))
+
+        return Handler
+
+    def start(self) -> "MockOpenAIServer":
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self) -> "MockOpenAIServer":
+        return self.start()
+
+    def __exit__(self, *exc) -> None:
+        self.stop()
+
+
+if __name__ == "__main__":
+    server = MockOpenAIServer(latency_s=1.0, port=8765)
+    logger.info("serving mock openai api", base_url=server.base_url)
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,11 +1,27 @@
-from dataclasses import dataclass
-from typing import List, Optional
+from dataclasses import dataclass, fields
+from typing import (
+    Annotated,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Union,
+)
 
 import duckdb
-from pydantic import BaseModel
+import numpy
+from pydantic import BaseModel, Field
 
 
-@dataclass
+def _fields_dict(obj) -> dict:
+    # Slotted dataclasses have no `__dict__`, and `dataclasses.asdict` deep copies
+    return {f.name: getattr(obj, f.name) for f in fields(obj)}
+
+
+@dataclass(slots=True)
 class InvoiceDenormalized:
     CompanyId: int
     ReturnedInvoiceId: int
@@ -75,15 +91,21 @@ class InvoiceDenormalized:
                 yield invoice
 
 
-@dataclass
+@dataclass(slots=True)
 class InvoiceLineItem:
+    # Field descriptions end up in the extraction tool's schema, see `tool_schema.py`
     LineItemTotal: float
     LineItemNetTotal: Optional[float] = None
     UnitPrice: Optional[float] = None
     Quantity: float = 1.0
-    ItemDescription: str = ""
+    ItemDescription: Annotated[
+        str, Field(description="Do not correct typos in the source document.")
+    ] = ""
     UnitOfMeasure: str = ""
-    SupplierPartNum: str = ""
+    SupplierPartNum: Annotated[
+        str,
+        Field(description="This may be called 'Model', 'Product', or similar names."),
+    ] = ""
 
     def __post_init__(self):
         self.ItemDescription = self.ItemDescription.upper()
@@ -92,11 +114,11 @@ class InvoiceLineItem:
         if self.LineItemNetTotal is None:
             self.LineItemNetTotal = self.LineItemTotal
 
-    def to_dict(self):
-        return self.__dict__
+    def to_dict(self) -> dict:
+        return _fields_dict(self)
 
 
-@dataclass
+@dataclass(slots=True)
 class Invoice:
     CompanyId: int
     ReturnedInvoiceId: int
@@ -141,7 +163,10 @@ class Invoice:
     line_items: List[InvoiceLineItem]
 
     def to_dict(self) -> dict:
-        return {**self.__dict__, "line_items": [l.to_dict() for l in self.line_items]}
+        return {
+            **_fields_dict(self),
+            "line_items": [l.to_dict() for l in self.line_items],
+        }
 
     def to_extracted(self) -> "ExtractedInvoice":
         return ExtractedInvoice(
@@ -228,6 +253,250 @@ class Invoice:
             file_path=file_path,
         )
 
+    @staticmethod
+    def from_record_batches(
+        batches: Iterable[Any], file_path_by_id: Dict[str, str]
+    ) -> Iterator["Invoice"]:
+        """Decodes Arrow record batches of `InvoiceDenormalized` rows, e.g., from
+        `cursor.fetch_record_batch()`, into invoices. Each invoice's rows must be next
+        to each other, and may span batches.
+
+        Equivalent to `Invoice.from_denormalized` on each run of rows, but converts
+        whole columns at once and never builds the per-row `InvoiceDenormalized`.
+        """
+        group: Optional[_RowGroup] = None
+        for batch in batches:
+            num_rows = batch.num_rows
+            if num_rows == 0:
+                continue
+            columns = batch.to_pydict()
+            ids = batch.column("OriginalMessageItemId").to_numpy(zero_copy_only=False)
+            starts = [0, *(numpy.flatnonzero(ids[1:] != ids[:-1]) + 1).tolist()]
+            ends = [*starts[1:], num_rows]
+            for start, end in zip(starts, ends):
+                if (
+                    group is not None
+                    and start == 0
+                    and group.header["OriginalMessageItemId"]
+                    == columns["OriginalMessageItemId"][0]
+                ):
+                    # The invoice continues from the previous batch
+                    group.extend(columns, 0, end)
+                    continue
+                if group is not None:
+                    yield group.to_invoice(file_path_by_id)
+                group = _RowGroup.from_columns(columns, start, end)
+        if group is not None:
+            yield group.to_invoice(file_path_by_id)
+
+
+# Fields of `Invoice` taken from the first denormalized row of the invoice
+INVOICE_HEADER_FIELDS = [
+    f.name for f in fields(Invoice) if f.name not in ("file_path", "line_items")
+]
+INVOICE_LINE_ITEM_FIELDS = [f.name for f in fields(InvoiceLineItem)]
+
+
+@dataclass(slots=True)
+class _RowGroup:
+    """The rows of one invoice while decoding record batches: the header values of its
+    first row and its line item columns."""
+
+    header: Dict[str, Any]
+    contact_types: List[Any]
+    line_items: Dict[str, List[Any]]
+
+    @staticmethod
+    def from_columns(
+        columns: Dict[str, List[Any]], start: int, end: int
+    ) -> "_RowGroup":
+        return _RowGroup(
+            header={name: columns[name][start] for name in INVOICE_HEADER_FIELDS},
+            contact_types=columns["ContactType"][start:end],
+            line_items={
+                name: columns[name][start:end] for name in INVOICE_LINE_ITEM_FIELDS
+            },
+        )
+
+    def extend(self, columns: Dict[str, List[Any]], start: int, end: int) -> None:
+        self.contact_types.extend(columns["ContactType"][start:end])
+        for name, values in self.line_items.items():
+            values.extend(columns[name][start:end])
+
+    def to_invoice(self, file_path_by_id: Dict[str, str]) -> Invoice:
+        # Positional arguments, in `InvoiceLineItem` field order
+        rows = zip(*(self.line_items[name] for name in INVOICE_LINE_ITEM_FIELDS))
+        return Invoice(
+            **self.header,
+            file_path=file_path_by_id.get(str(self.header["OriginalMessageItemId"])),
+            line_items=[
+                InvoiceLineItem(*row)
+                for row, contact_type in zip(rows, self.contact_types)
+                if contact_type != 5
+            ],
+        )
+
+
+@dataclass(slots=True)
+class LazyInvoice:
+    """Handle on an invoice which only holds its header, fetching its line items with
+    `fetch_line_items(item id)` each time they're needed. Header fields are available
+    as attributes, like on `Invoice`."""
+
+    header: Dict[str, Any]
+    file_path: Optional[str]
+    fetch_line_items: Callable[[str], List[InvoiceLineItem]]
+
+    def __getattr__(self, name: str) -> Any:
+        try:
+            return self.header[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+    @property
+    def OriginalMessageItemId(self) -> str:
+        return self.header["OriginalMessageItemId"]
+
+    @property
+    def line_items(self) -> List[InvoiceLineItem]:
+        return self.fetch_line_items(str(self.OriginalMessageItemId))
+
+    def load(self) -> Invoice:
+        return Invoice(
+            **self.header, file_path=self.file_path, line_items=self.line_items
+        )
+
+    def to_dict(self) -> dict:
+        return self.load().to_dict()
+
+    def to_extracted(self) -> "ExtractedInvoice":
+        return self.load().to_extracted()
+
+
+# Either kind of invoice, for code that only needs the header, file and extraction
+InvoiceLike = Union[Invoice, LazyInvoice]
+
+
+def _compact_column(column: numpy.ndarray) -> numpy.ndarray:
+    """Stores text columns as NumPy strings (short strings inline, the rest in one
+    arena) instead of an array of Python `str` objects, and drops all-valid masks."""
+    if column.dtype == object:
+        values = numpy.ma.getdata(column).tolist()
+        if numpy.ma.is_masked(column):
+            values = [
+                None if masked else value
+                for value, masked in zip(values, numpy.ma.getmaskarray(column))
+            ]
+        if all(value is None or isinstance(value, str) for value in values):
+            return numpy.array(values, dtype=numpy.dtypes.StringDType(na_object=None))
+        return numpy.array(values, dtype=object)
+    if isinstance(column, numpy.ma.MaskedArray) and not column.mask.any():
+        return column.data
+    return column
+
+
+def _column_value(column: numpy.ndarray, i: int) -> Any:
+    value = column[i]
+    if value is numpy.ma.masked:
+        return None
+    if isinstance(value, numpy.generic):
+        return value.item()
+    return value
+
+
+@dataclass(slots=True)
+class InvoiceBatch:
+    """Many invoices held as columns rather than objects: one array per header field
+    with an entry per invoice, and one array per line item field with the line items
+    of all invoices concatenated. `batch[i]` materializes a single `Invoice`."""
+
+    header: Dict[str, numpy.ndarray]
+    line_items: Dict[str, numpy.ndarray]
+    # The line items of invoice i are `offsets[i]:offsets[i + 1]`
+    offsets: numpy.ndarray
+    file_paths: numpy.ndarray
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> Invoice:
+        line_items = [
+            InvoiceLineItem(
+                **{
+                    name: _column_value(column, k)
+                    for name, column in self.line_items.items()
+                }
+            )
+            for k in range(self.offsets[i], self.offsets[i + 1])
+        ]
+        return Invoice(
+            **{name: _column_value(column, i) for name, column in self.header.items()},
+            file_path=_column_value(self.file_paths, i),
+            line_items=line_items,
+        )
+
+    def __iter__(self) -> Iterator[Invoice]:
+        return (self[i] for i in range(len(self)))
+
+    def item_ids(self) -> List[str]:
+        return [str(v) for v in self.header["OriginalMessageItemId"].tolist()]
+
+    def to_dict(self, i: int) -> dict:
+        return self[i].to_dict()
+
+    def to_extracted(self, i: int) -> "ExtractedInvoice":
+        return self[i].to_extracted()
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the arrays, excluding the Python objects of object columns."""
+        columns = [
+            *self.header.values(),
+            *self.line_items.values(),
+            self.offsets,
+            self.file_paths,
+        ]
+        return sum(column.nbytes for column in columns)
+
+    @staticmethod
+    def from_denormalized_columns(
+        columns: Dict[str, numpy.ndarray], file_path_by_id: Dict[str, str]
+    ) -> "InvoiceBatch":
+        """Builds the batch from `InvoiceDenormalized` columns, e.g.,
+        `cursor.fetchnumpy()`, with each invoice's rows next to each other. Equivalent
+        to `Invoice.from_denormalized` on each run of rows."""
+        ids = columns["OriginalMessageItemId"]
+        num_rows = len(ids)
+        if num_rows == 0:
+            starts = numpy.zeros(0, dtype=numpy.intp)
+        else:
+            starts = numpy.concatenate(
+                [[0], numpy.flatnonzero(ids[1:] != ids[:-1]) + 1]
+            )
+        contact_type = columns["ContactType"]
+        keep = numpy.ma.getdata(contact_type) != 5
+        if numpy.ma.is_masked(contact_type):
+            keep |= numpy.ma.getmaskarray(contact_type)
+        kept_rows = numpy.flatnonzero(keep)
+        offsets = numpy.searchsorted(kept_rows, numpy.append(starts, num_rows))
+        return InvoiceBatch(
+            header={
+                name: _compact_column(columns[name][starts])
+                for name in INVOICE_HEADER_FIELDS
+            },
+            line_items={
+                name: _compact_column(columns[name][kept_rows])
+                for name in INVOICE_LINE_ITEM_FIELDS
+            },
+            offsets=offsets,
+            file_paths=_compact_column(
+                numpy.array(
+                    [file_path_by_id.get(str(v)) for v in ids[starts].tolist()],
+                    dtype=object,
+                )
+            ),
+        )
+
 
 @dataclass
 class VendorContactInfo:
@@ -242,13 +511,33 @@ class VendorContactInfo:
 class InvoiceHeaderInfo:
     InvoiceNumber: str
     InvoiceAmount: float
-    InvoiceDate: str
-    VendorContactInfo: VendorContactInfo
-    PurchaseOrder: str = ""
+    InvoiceDate: Annotated[
+        str,
+        Field(
+            description="Use YYYY-MM-DDTHH:mm:SS format, and specify 00:00:00 if the time is not known."
+        ),
+    ]
+    VendorContactInfo: Annotated[
+        VendorContactInfo,
+        Field(
+            description="Under a remit to or other vendor stated section. Do not use the purchaser's contact information."
+        ),
+    ]
+    PurchaseOrder: Annotated[
+        str,
+        Field(
+            description="Usually an abbreviation, like PO. Do NOT use the 'Sales Order' or 'Invoice #' or 'Customer #' or similar as the purchase order."
+        ),
+    ] = ""
     SalesTaxAmount: float = 0.0
     ShippingCharges: float = 0.0
 
 
 class ExtractedInvoice(BaseModel):
     InvoiceHeaderInfo: InvoiceHeaderInfo
-    InvoiceLineItems: List[InvoiceLineItem]
+    InvoiceLineItems: Annotated[
+        List[InvoiceLineItem],
+        Field(
+            description="Make sure to capture ALL line items on the document. Capture each item. Look for horizontal entries which have a price in them on the far right side."
+        ),
+    ]
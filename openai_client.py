@@ -0,0 +1,82 @@
+import functools
+import os
+from dataclasses import dataclass, replace
+from typing import Optional
+
+import httpx
+import openai
+
+
+def _http2_available() -> bool:
+    # httpx only speaks HTTP/2 with the optional `h2` package, i.e., `httpx[http2]`
+    try:
+        import h2  # noqa: F401  # pyright: ignore[reportMissingImports]
+    except ImportError:
+        return False
+    return True
+
+
+@dataclass(frozen=True)
+class ClientConfig:
+    base_url: Optional[str] = None
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry_s: float = 30.0
+    connect_timeout_s: float = 10.0
+    # Vision requests with many pages can take minutes to generate
+    read_timeout_s: float = 300.0
+    http2: bool = True
+    max_retries: int = 2
+
+    def _limits(self) -> httpx.Limits:
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive_connections,
+            keepalive_expiry=self.keepalive_expiry_s,
+        )
+
+    def _timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.read_timeout_s, connect=self.connect_timeout_s)
+
+    def _http2(self) -> bool:
+        return self.http2 and _http2_available()
+
+
+@functools.lru_cache(maxsize=None)
+def get_client(config: ClientConfig = ClientConfig()) -> openai.OpenAI:
+    """Returns a process-wide client per config, so every extraction reuses the same
+    keep-alive connection pool instead of paying TCP and TLS setup per invoice."""
+    return openai.OpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        base_url=config.base_url,
+        max_retries=config.max_retries,
+        timeout=config._timeout(),
+        http_client=httpx.Client(
+            limits=config._limits(), timeout=config._timeout(), http2=config._http2()
+        ),
+    )
+
+
+def create_async_client(config: ClientConfig = ClientConfig()) -> openai.AsyncOpenAI:
+    """Async counterpart of `get_client`. Not cached, since an async connection pool is
+    bound to the event loop it was first used on; share one per run instead."""
+    return openai.AsyncOpenAI(
+        api_key=os.environ.get("OPENAI_API_KEY"),
+        base_url=config.base_url,
+        max_retries=config.max_retries,
+        timeout=config._timeout(),
+        http_client=httpx.AsyncClient(
+            limits=config._limits(), timeout=config._timeout(), http2=config._http2()
+        ),
+    )
+
+
+def with_pool_size(config: ClientConfig, max_concurrency: int) -> ClientConfig:
+    """Grows the pool so `max_concurrency` requests never wait on a connection."""
+    return replace(
+        config,
+        max_connections=max(config.max_connections, max_concurrency),
+        max_keepalive_connections=max(
+            config.max_keepalive_connections, max_concurrency
+        ),
+    )
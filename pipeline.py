@@ -0,0 +1,185 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+import structlog
+from openai.types.chat import ChatCompletion
+
+from async_runner import AsyncExtractionRunner, ExtractionResult, total_usage
+from rasterize import render_inline
+from response_cache import CACHED_RESPONSE_ID
+from scoring import FieldCounts, score_invoice
+
+logger = structlog.stdlib.get_logger()
+
+
+@dataclass
+class PipelineConfig:
+    """Workers and queue sizes of the `run_pipeline` stages. A stage falling behind
+    fills the queue in front of it, which blocks the stage before, so memory stays
+    bounded whatever the corpus size. Requests in flight are bounded by the runner's
+    `max_concurrency` and rate budget."""
+
+    # Processes building requests, i.e., rendering pages or converting to markdown.
+    # Defaults to one per core
+    prepare_workers: Optional[int] = None
+    # Built requests waiting to be sent, each holding a PDF's page images
+    prepared_queue: int = 8
+    # Responses waiting to be parsed and scored
+    response_queue: int = 32
+    # Processes parsing, validating and scoring responses, 0 to do it on the event loop
+    score_workers: int = 1
+    # Results waiting for the consumer
+    result_queue: int = 64
+
+
+def _finish(
+    parse_response: Callable[[ChatCompletion], dict],
+    response: ChatCompletion,
+    expected: Optional[dict],
+) -> Tuple[dict, Optional[Dict[str, FieldCounts]]]:
+    result = parse_response(response)
+    return result, score_invoice(result, expected) if expected is not None else None
+
+
+async def run_pipeline(
+    runner: AsyncExtractionRunner,
+    items: Iterable[Tuple[str, str]],
+    config: Optional[PipelineConfig] = None,
+    expected: Optional[Callable[[str], Optional[dict]]] = None,
+) -> AsyncIterator[ExtractionResult]:
+    """Like `runner.run`, but builds each request in a process pool and parses each
+    response in another, so the CPU-bound stages use every core while the event loop
+    only keeps requests in flight. With `expected`, which returns the manual
+    extraction of an item id, results are also scored in the pool (`scores`).
+
+    Only for backends sending one request per PDF built by a picklable
+    `build_request`, i.e., not `aextract` backends.
+    """
+    config = config or PipelineConfig()
+    backend = runner.backend
+    if getattr(backend, "aextract", None) is not None:
+        raise ValueError(
+            f"{type(backend).__name__} sends several requests per PDF, use AsyncExtractionRunner.run"
+        )
+    loop = asyncio.get_running_loop()
+    prepare_workers = config.prepare_workers or os.cpu_count() or 1
+    # Workers render pages themselves rather than through a nested render pool
+    prepare_pool = ProcessPoolExecutor(prepare_workers, initializer=render_inline)
+    score_pool = (
+        ProcessPoolExecutor(config.score_workers) if config.score_workers else None
+    )
+    # `(item id, start time, request or response)`, `None` once the stage before is done
+    prepared: asyncio.Queue[Optional[Tuple[str, float, dict]]] = asyncio.Queue(
+        config.prepared_queue
+    )
+    responses: asyncio.Queue[
+        Optional[Tuple[str, float, ChatCompletion]]
+    ] = asyncio.Queue(config.response_queue)
+    results: asyncio.Queue[Optional[ExtractionResult]] = asyncio.Queue(
+        config.result_queue
+    )
+
+    async def failed(key: str, start: float, e: Exception) -> None:
+        logger.error("extraction failed", key=key, error=repr(e))
+        await results.put(ExtractionResult(key, e, time.perf_counter() - start))
+
+    async def prepare(key: str, pdf_path: str, slots: asyncio.Semaphore) -> None:
+        start = time.perf_counter()
+        try:
+            request = await loop.run_in_executor(
+                prepare_pool, backend.build_request, pdf_path
+            )
+            await prepared.put((key, start, request))
+        except Exception as e:
+            await failed(key, start, e)
+        finally:
+            slots.release()
+
+    async def prepare_stage() -> None:
+        # Keep every worker busy with one PDF queued behind it
+        slots = asyncio.Semaphore(prepare_workers * 2)
+        pending = set()
+        for key, pdf_path in items:
+            await slots.acquire()
+            task = asyncio.create_task(prepare(key, pdf_path, slots))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        await asyncio.gather(*pending)
+
+    async def request_stage() -> None:
+        while (item := await prepared.get()) is not None:
+            key, start, request = item
+            try:
+                response = await runner.create(request)
+            except Exception as e:
+                await failed(key, start, e)
+                continue
+            await responses.put((key, start, response))
+
+    async def finish_stage() -> None:
+        while (item := await responses.get()) is not None:
+            key, start, response = item
+            try:
+                # Expected extractions may be read from DuckDB, so off the event loop
+                args = (
+                    backend.parse_response,
+                    response,
+                    await asyncio.to_thread(expected, key) if expected else None,
+                )
+                if score_pool is None:
+                    result, scores = _finish(*args)
+                else:
+                    result, scores = await loop.run_in_executor(
+                        score_pool, _finish, *args
+                    )
+            except Exception as e:
+                await failed(key, start, e)
+                continue
+            await results.put(
+                ExtractionResult(
+                    key,
+                    result,
+                    time.perf_counter() - start,
+                    total_usage([response]),
+                    response.id == CACHED_RESPONSE_ID,
+                    scores,
+                )
+            )
+
+    requesters = [
+        asyncio.create_task(request_stage()) for _ in range(runner.max_concurrency)
+    ]
+    finishers = [
+        asyncio.create_task(finish_stage()) for _ in range(max(config.score_workers, 1))
+    ]
+    tasks: List[asyncio.Task] = [*requesters, *finishers]
+
+    async def run_stages() -> None:
+        try:
+            await prepare_stage()
+            for _ in requesters:
+                await prepared.put(None)
+            await asyncio.gather(*requesters)
+            for _ in finishers:
+                await responses.put(None)
+            await asyncio.gather(*finishers)
+        finally:
+            await results.put(None)
+
+    stages = asyncio.create_task(run_stages())
+    tasks.append(stages)
+    try:
+        while (result := await results.get()) is not None:
+            yield result
+        # Raises whatever stopped the stages early
+        await stages
+    finally:
+        for task in tasks:
+            task.cancel()
+        prepare_pool.shutdown(cancel_futures=True)
+        if score_pool is not None:
+            score_pool.shutdown(cancel_futures=True)
@@ -0,0 +1,358 @@
+import asyncio
+import collections
+import functools
+import io
+import itertools
+import math
+import os
+import struct
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor
+from dataclasses import asdict, dataclass
+from typing import (
+    Any,
+    AsyncIterator,
+    Deque,
+    Generator,
+    Literal,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+import pymupdf
+
+from caching import DiskCache, cache_path, file_digest
+from instrumentation import PDF_OPEN, stage
+
+DEFAULT_DPI = 138
+PAGE_CACHE_MAX_BYTES = 5 << 30
+
+# OpenAI downsamples images to fit in 2048x2048 and then to 768px on the shortest
+# side before tiling them into 512px squares, see
+# https://platform.openai.com/docs/guides/vision/calculating-costs
+VISION_MAX_SIDE_PX = 2048
+VISION_SHORT_SIDE_PX = 768
+VISION_TILE_PX = 512
+VISION_BASE_TOKENS = 85
+VISION_TILE_TOKENS = 170
+
+
+def image_tokens(width: int, height: int) -> int:
+    """Input tokens the vision model bills for an image at the "high" detail level."""
+    scale = min(1.0, VISION_MAX_SIDE_PX / max(width, height))
+    scale *= min(1.0, VISION_SHORT_SIDE_PX / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / VISION_TILE_PX) * math.ceil(
+        height * scale / VISION_TILE_PX
+    )
+    return VISION_BASE_TOKENS + VISION_TILE_TOKENS * tiles
+
+
+@dataclass(frozen=True)
+class ImageEncoding:
+    """How pages are rendered for the vision model.
+
+    With `dpi=None` the DPI is picked per page: high enough to fill the resolution the
+    model actually looks at (see `VISION_SHORT_SIDE_PX`), then lowered until the page
+    fits `max_tokens_per_page`. `max_bytes_per_page` further lowers it after encoding.
+    """
+
+    format: Literal["png", "jpeg", "webp"] = "png"
+    grayscale: bool = False
+    # Only used by the lossy formats
+    quality: int = 85
+    dpi: Optional[int] = DEFAULT_DPI
+    min_dpi: int = 50
+    max_dpi: int = 200
+    max_tokens_per_page: Optional[int] = None
+    max_bytes_per_page: Optional[int] = None
+
+    @property
+    def mime_type(self) -> str:
+        return f"image/{self.format}"
+
+    def cache_key(self) -> str:
+        return ":".join(f"{k}={v}" for k, v in sorted(asdict(self).items()))
+
+    def page_dpi(self, width_pt: float, height_pt: float) -> int:
+        if self.dpi is not None:
+            return self.dpi
+        dpi: float = min(
+            self.max_dpi, VISION_SHORT_SIDE_PX * 72 / min(width_pt, height_pt)
+        )
+        while (
+            self.max_tokens_per_page is not None
+            and dpi > self.min_dpi
+            and image_tokens(int(width_pt * dpi / 72), int(height_pt * dpi / 72))
+            > self.max_tokens_per_page
+        ):
+            dpi *= 0.9
+        return max(self.min_dpi, int(dpi))
+
+
+PNG_ENCODING = ImageEncoding()
+
+
+def image_dimensions(data: bytes) -> Optional[Tuple[int, int]]:
+    """Reads `(width, height)` from a PNG, JPEG or WebP header without decoding it."""
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return struct.unpack(">II", data[16:24])
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            w, h = struct.unpack("<HH", data[26:30])
+            return w & 0x3FFF, h & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            w = int.from_bytes(data[24:27], "little") + 1
+            h = int.from_bytes(data[27:30], "little") + 1
+            return w, h
+        return None
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 < len(data):
+            if data[i] != 0xFF:
+                return None
+            marker = data[i + 1]
+            length = int.from_bytes(data[i + 2 : i + 4], "big")
+            # Start of frame markers, excluding DHT, JPG and DAC
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                h, w = struct.unpack(">HH", data[i + 5 : i + 9])
+                return w, h
+            i += 2 + length
+    return None
+
+
+# Workers render consecutive pages of the same few PDFs, so keep them open, keyed by
+# path, size and mtime so a PDF changed on disk is reopened rather than rendered stale
+OPEN_DOCUMENTS_MAX = 8
+_open_documents: "collections.OrderedDict[Tuple[str, int, int], pymupdf.Document]" = (
+    collections.OrderedDict()
+)
+_open_documents_lock = threading.Lock()
+
+
+def _open_document(pdf_path: str) -> pymupdf.Document:
+    stat = os.stat(pdf_path)
+    key = (os.path.abspath(pdf_path), stat.st_size, stat.st_mtime_ns)
+    with _open_documents_lock:
+        doc = _open_documents.get(key)
+        if doc is not None:
+            _open_documents.move_to_end(key)
+            return doc
+        doc = pymupdf.Document(pdf_path)
+        _open_documents[key] = doc
+        while len(_open_documents) > OPEN_DOCUMENTS_MAX:
+            _, evicted = _open_documents.popitem(last=False)
+            evicted.close()
+        return doc
+
+
+def _encode(pix: pymupdf.Pixmap, encoding: ImageEncoding) -> bytes:
+    if encoding.format == "png":
+        return pix.tobytes("png")
+    if encoding.format == "jpeg":
+        return pix.tobytes("jpg", jpg_quality=encoding.quality)
+    try:
+        from PIL import Image  # pyright: ignore[reportMissingImports]
+    except ImportError as e:
+        raise ImportError("WebP encoding requires Pillow, `pip install pillow`") from e
+    mode = "L" if pix.n == 1 else "RGB"
+    buf = io.BytesIO()
+    Image.frombytes(mode, (pix.width, pix.height), pix.samples).save(
+        buf, "WEBP", quality=encoding.quality
+    )
+    return buf.getvalue()
+
+
+def render_page(
+    pdf_path: str, page_number: int, encoding: ImageEncoding = PNG_ENCODING
+) -> bytes:
+    """Renders and encodes a single page. Runs in the worker processes."""
+    page: Any = _open_document(pdf_path)[page_number]
+    colorspace = pymupdf.csGRAY if encoding.grayscale else pymupdf.csRGB
+    dpi = encoding.page_dpi(page.rect.width, page.rect.height)
+    while True:
+        pix: pymupdf.Pixmap = page.get_pixmap(dpi=dpi, colorspace=colorspace)
+        data = _encode(pix, encoding)
+        if (
+            encoding.max_bytes_per_page is None
+            or len(data) <= encoding.max_bytes_per_page
+            or dpi <= encoding.min_dpi
+        ):
+            return data
+        # Encoded size scales roughly with the pixel count, i.e., with dpi^2
+        dpi = max(
+            encoding.min_dpi,
+            int(dpi * math.sqrt(encoding.max_bytes_per_page / len(data)) * 0.95),
+        )
+
+
+class InlineExecutor(Executor):
+    """Runs each task as it's submitted, in the calling thread."""
+
+    _max_workers = 1
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except BaseException as e:
+            future.set_exception(e)
+        return future
+
+
+# Set by `render_inline`
+_render_executor: Optional[Executor] = None
+
+
+def render_inline() -> None:
+    """Renders pages in this process from now on, for processes which are already
+    workers of a pool, where a nested render pool would only oversubscribe the cores."""
+    global _render_executor
+    _render_executor = InlineExecutor()
+
+
+@functools.lru_cache(maxsize=None)
+def get_render_pool(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """Process-wide pool, since rendering is CPU-bound and holds the GIL."""
+    return ProcessPoolExecutor(max_workers=max_workers or os.cpu_count())
+
+
+def _default_executor() -> Executor:
+    return _render_executor or get_render_pool()
+
+
+def _default_max_in_flight(executor: Executor) -> int:
+    workers = getattr(executor, "_max_workers", None) or os.cpu_count() or 1
+    return workers * 2
+
+
+def page_count(pdf_path: str) -> int:
+    with stage(PDF_OPEN, pdf_path=pdf_path), pymupdf.Document(pdf_path) as doc:
+        return len(doc)
+
+
+class PageCache(DiskCache):
+    """Rendered page images, keyed by the PDF's content rather than its path, so the
+    same corpus is only rasterized once across prompt and model experiments."""
+
+    @staticmethod
+    def page_key(pdf_digest: str, page_number: int, encoding: ImageEncoding) -> str:
+        return f"{pdf_digest}:{page_number}:{encoding.cache_key()}"
+
+
+@functools.lru_cache(maxsize=None)
+def get_page_cache() -> PageCache:
+    return PageCache(cache_path("pages.sqlite"), max_bytes=PAGE_CACHE_MAX_BYTES)
+
+
+def _store_on_completion(cache: PageCache, key: str, future) -> None:
+    def store(f):
+        if not f.cancelled() and f.exception() is None:
+            cache.set(key, f.result())
+
+    future.add_done_callback(store)
+
+
+def render_pages(
+    pdf_path: str,
+    encoding: ImageEncoding = PNG_ENCODING,
+    executor: Optional[Executor] = None,
+    max_in_flight: Optional[int] = None,
+    use_cache: bool = True,
+    pages: Optional[Sequence[int]] = None,
+) -> Generator[bytes, None, None]:
+    """Renders pages across `executor` (the shared process pool by default), yielding
+    encoded images in page order. Pages found in the page cache aren't rendered again.
+
+    At most `max_in_flight` pages are rendered ahead of the consumer, which bounds the
+    memory held in pixmaps for long documents. Pass `pages` to render only those pages.
+    """
+    executor = executor or _default_executor()
+    max_in_flight = max_in_flight or _default_max_in_flight(executor)
+    cache = get_page_cache() if use_cache else None
+    pdf_digest = file_digest(pdf_path) if cache is not None else ""
+
+    def submit(n: int) -> Future[bytes]:
+        key = PageCache.page_key(pdf_digest, n, encoding)
+        cached = cache.get(key) if cache is not None else None
+        if cached is not None:
+            future: Future[bytes] = Future()
+            future.set_result(cached)
+            return future
+        future = executor.submit(render_page, pdf_path, n, encoding)
+        if cache is not None:
+            _store_on_completion(cache, key, future)
+        return future
+
+    todo = iter(pages if pages is not None else range(page_count(pdf_path)))
+    in_flight: Deque[Future[bytes]] = collections.deque(
+        submit(n) for n in itertools.islice(todo, max_in_flight)
+    )
+    try:
+        while in_flight:
+            png = in_flight.popleft().result()
+            for n in itertools.islice(todo, 1):
+                in_flight.append(submit(n))
+            yield png
+    finally:
+        # The consumer stopped early, don't keep rendering pages nobody will read
+        for future in in_flight:
+            future.cancel()
+
+
+async def arender_pages(
+    pdf_path: str,
+    encoding: ImageEncoding = PNG_ENCODING,
+    executor: Optional[Executor] = None,
+    max_in_flight: Optional[int] = None,
+    use_cache: bool = True,
+    pages: Optional[Sequence[int]] = None,
+) -> AsyncIterator[bytes]:
+    """Async counterpart of `render_pages`, for building requests on the event loop."""
+    loop = asyncio.get_running_loop()
+    executor = executor or _default_executor()
+    max_in_flight = max_in_flight or _default_max_in_flight(executor)
+    # The cache is SQLite, so its reads and writes run in threads rather than
+    # blocking the requests in flight on the event loop
+    cache = await asyncio.to_thread(get_page_cache) if use_cache else None
+    pdf_digest = (
+        await loop.run_in_executor(None, file_digest, pdf_path)
+        if cache is not None
+        else ""
+    )
+
+    async def render(n: int) -> bytes:
+        if cache is None:
+            return await loop.run_in_executor(
+                executor, render_page, pdf_path, n, encoding
+            )
+        key = PageCache.page_key(pdf_digest, n, encoding)
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached
+        data = await loop.run_in_executor(executor, render_page, pdf_path, n, encoding)
+        await asyncio.to_thread(cache.set, key, data)
+        return data
+
+    def submit(n: int) -> asyncio.Future[bytes]:
+        return asyncio.ensure_future(render(n))
+
+    if pages is None:
+        pages = range(await loop.run_in_executor(None, page_count, pdf_path))
+    todo = iter(pages)
+    in_flight: Deque[asyncio.Future[bytes]] = collections.deque(
+        submit(n) for n in itertools.islice(todo, max_in_flight)
+    )
+    try:
+        while in_flight:
+            png = await in_flight.popleft()
+            for n in itertools.islice(todo, 1):
+                in_flight.append(submit(n))
+            yield png
+    finally:
+        for future in in_flight:
+            future.cancel()
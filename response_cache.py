@@ -0,0 +1,102 @@
+import functools
+import hashlib
+import json
+from typing import Optional
+
+import openai
+import structlog
+from openai.types.chat import ChatCompletion
+
+from caching import DiskCache, cache_path
+from streaming import tool_arguments
+
+logger = structlog.stdlib.get_logger()
+
+RESPONSE_CACHE_MAX_BYTES = 1 << 30
+# `ChatCompletion.id` of responses replayed from the cache
+CACHED_RESPONSE_ID = "chatcmpl-cached"
+
+
+def request_key(request: dict) -> str:
+    """Content address of a chat completion request: the model, the full message
+    payload (so rendered page images or markdown) and the tool schema."""
+    payload = {k: request.get(k) for k in ("model", "messages", "tools", "tool_choice")}
+    return hashlib.sha256(
+        json.dumps(payload, sort_keys=True, separators=(",", ":")).encode()
+    ).hexdigest()
+
+
+class ResponseCache(DiskCache):
+    """Caches the tool call arguments and usage of extraction responses, so re-running
+    an evaluation with unchanged inputs doesn't call (or pay for) the API again."""
+
+    def get_response(self, request: dict) -> Optional[ChatCompletion]:
+        value = self.get(request_key(request))
+        if value is None:
+            return None
+        cached = json.loads(value)
+        return _to_chat_completion(request, cached["arguments"], cached["usage"])
+
+    def set_response(self, request: dict, response: ChatCompletion) -> None:
+        arguments = tool_arguments(response)
+        if not arguments:
+            # Nothing worth replaying, e.g., the model answered in text instead
+            return
+        value = {
+            "arguments": arguments,
+            "usage": response.usage.model_dump() if response.usage else None,
+        }
+        self.set(request_key(request), json.dumps(value).encode())
+
+
+def _to_chat_completion(
+    request: dict, arguments: str, usage: Optional[dict]
+) -> ChatCompletion:
+    tool_name = request.get("tool_choice", {}).get("function", {}).get("name", "")
+    return ChatCompletion.model_validate(
+        {
+            "id": CACHED_RESPONSE_ID,
+            "object": "chat.completion",
+            "created": 0,
+            "model": request["model"],
+            "choices": [
+                {
+                    "index": 0,
+                    "finish_reason": "tool_calls",
+                    "message": {
+                        "role": "assistant",
+                        "tool_calls": [
+                            {
+                                "id": "call_cached",
+                                "type": "function",
+                                "function": {"name": tool_name, "arguments": arguments},
+                            }
+                        ],
+                    },
+                }
+            ],
+            "usage": usage,
+        }
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def get_response_cache() -> ResponseCache:
+    return ResponseCache(
+        cache_path("responses.sqlite"), max_bytes=RESPONSE_CACHE_MAX_BYTES
+    )
+
+
+def create_with_cache(
+    client: openai.OpenAI, request: dict, use_cache: bool = True
+) -> ChatCompletion:
+    """`client.chat.completions.create(**request)`, served from the response cache
+    when the same request has been made before."""
+    cache = get_response_cache() if use_cache else None
+    if cache is not None and (response := cache.get_response(request)) is not None:
+        logger.debug("response cache hit", model=request["model"])
+        return response
+    response = client.chat.completions.create(**request)
+    if cache is not None:
+        cache.set_response(request, response)
+    return response
@@ -0,0 +1,231 @@
+import asyncio
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple, cast
+
+import structlog
+from openai.types.chat import ChatCompletion
+
+import bb_gpt_4o_vision_chat
+import bc_gpt_4o_pymupdf_text
+from async_runner import AsyncExtractionRunner, ExtractionBackend
+from corpus_index import CorpusIndex, PdfInfo, get_corpus_index
+from rasterize import PNG_ENCODING, ImageEncoding, image_tokens
+
+logger = structlog.stdlib.get_logger()
+
+TEXT = "text"
+VISION = "vision"
+# Line item totals within this fraction of the invoice amount (or of the amount less
+# tax and shipping) pass validation
+AMOUNT_TOLERANCE = 0.01
+# Rough size of the markdown the text path sends, per character of the text layer
+CHARS_PER_TOKEN = 4
+# List price of `gpt-4o-2024-05-13` prompt tokens, per million
+PROMPT_USD_PER_M_TOKENS = 5.0
+
+
+def validate_extraction(extracted: dict) -> List[str]:
+    """Internal consistency problems of an extraction, which suggest the text layer
+    didn't capture the invoice (e.g., a table came out scrambled)."""
+    line_items = extracted.get("InvoiceLineItems") or []
+    if not line_items:
+        return ["no line items"]
+    header = extracted.get("InvoiceHeaderInfo") or {}
+    amount = header.get("InvoiceAmount") or 0.0
+    total = sum(item.get("LineItemTotal") or 0.0 for item in line_items)
+    extras = (header.get("SalesTaxAmount") or 0.0) + (
+        header.get("ShippingCharges") or 0.0
+    )
+    tolerance = max(0.01, abs(amount) * AMOUNT_TOLERANCE)
+    if abs(total - amount) > tolerance and abs(total + extras - amount) > tolerance:
+        return [f"line items sum to {total:.2f}, the invoice amount is {amount:.2f}"]
+    return []
+
+
+def vision_prompt_tokens(info: PdfInfo, encoding: ImageEncoding) -> int:
+    """Image tokens the vision path would send for the PDF."""
+    tokens = 0
+    for width_pt, height_pt in info.page_sizes:
+        dpi = encoding.page_dpi(width_pt, height_pt)
+        tokens += image_tokens(int(width_pt * dpi / 72), int(height_pt * dpi / 72))
+    return tokens
+
+
+@dataclass
+class RouteStats:
+    invoices: int = 0
+    latency_s: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+    def add(self, latency_s: float, responses: List[ChatCompletion]) -> None:
+        self.invoices += 1
+        self.latency_s += latency_s
+        for response in responses:
+            if response.usage is not None:
+                self.prompt_tokens += response.usage.prompt_tokens
+                self.completion_tokens += response.usage.completion_tokens
+
+    @property
+    def mean_latency_s(self) -> Optional[float]:
+        return self.latency_s / self.invoices if self.invoices else None
+
+
+@dataclass
+class RoutingReport:
+    """Where invoices went, and what sending text-native ones through the text path
+    saved compared to sending everything through vision."""
+
+    routes: Dict[str, RouteStats] = field(
+        default_factory=lambda: {TEXT: RouteStats(), VISION: RouteStats()}
+    )
+    fallbacks: int = 0
+    # Text attempts which failed and were redone with vision, kept apart from both
+    # routes since they're overhead of routing rather than either path's cost
+    failed_text: RouteStats = field(default_factory=RouteStats)
+    # Estimated vision prompt tokens of the invoices the text path handled, less what
+    # their markdown cost
+    saved_prompt_tokens: int = 0
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    def summary(self) -> dict:
+        invoices = sum(stats.invoices for stats in self.routes.values())
+        elapsed_s = (
+            self.finished_at - self.started_at
+            if self.started_at is not None and self.finished_at is not None
+            else None
+        )
+        text, vision = self.routes[TEXT], self.routes[VISION]
+        # Latency saved assumes the text-routed invoices would have taken as long as
+        # the vision-routed ones did, less the time failed text attempts took
+        saved_latency_s = (
+            (vision.mean_latency_s - text.mean_latency_s) * text.invoices
+            - self.failed_text.latency_s
+            if text.mean_latency_s is not None and vision.mean_latency_s is not None
+            else None
+        )
+        saved_prompt_tokens = self.saved_prompt_tokens - self.failed_text.prompt_tokens
+        return {
+            "invoices": invoices,
+            "fallbacks": self.fallbacks,
+            "failed_text_prompt_tokens": self.failed_text.prompt_tokens,
+            "failed_text_completion_tokens": self.failed_text.completion_tokens,
+            "invoices_per_s": invoices / elapsed_s if elapsed_s else None,
+            "routes": {
+                name: {
+                    "invoices": stats.invoices,
+                    "mean_latency_s": stats.mean_latency_s,
+                    "prompt_tokens": stats.prompt_tokens,
+                    "completion_tokens": stats.completion_tokens,
+                }
+                for name, stats in self.routes.items()
+            },
+            "saved_prompt_tokens": saved_prompt_tokens,
+            "saved_usd": saved_prompt_tokens * PROMPT_USD_PER_M_TOKENS / 1e6,
+            "saved_latency_s": saved_latency_s,
+        }
+
+    def print(self) -> None:
+        summary = self.summary()
+        for name, route in summary["routes"].items():
+            latency = route["mean_latency_s"]
+            print(
+                f"{name:>6}: {route['invoices']} invoices, "
+                + (f"{latency:.2f}s mean latency, " if latency is not None else "")
+                + f"{route['prompt_tokens']} prompt tokens"
+            )
+        print(
+            f"Fell back to vision after failed validation: {summary['fallbacks']}, "
+            f"wasting {summary['failed_text_prompt_tokens']} text prompt tokens"
+        )
+        if summary["invoices_per_s"] is not None:
+            print(f"Throughput: {summary['invoices_per_s']:.2f} invoices/s")
+        print(
+            f"Saved vs. all vision: ~{summary['saved_prompt_tokens']} prompt tokens (${summary['saved_usd']:.2f})"
+            + (
+                f", ~{summary['saved_latency_s']:.0f}s of request latency"
+                if summary["saved_latency_s"] is not None
+                else ""
+            )
+        )
+
+
+class RoutedBackend:
+    """Extraction backend which sends text-native PDFs through the markdown path and
+    scanned ones through the vision path, based on the corpus index.
+
+    With `fallback`, text extractions failing `validate_extraction` (or failing
+    outright) are redone with vision. Only `AsyncExtractionRunner` uses the fallback,
+    through `aextract`; `build_request` just routes.
+    """
+
+    def __init__(
+        self,
+        text: ExtractionBackend = cast(ExtractionBackend, bc_gpt_4o_pymupdf_text),
+        vision: ExtractionBackend = cast(ExtractionBackend, bb_gpt_4o_vision_chat),
+        fallback: bool = True,
+        index: Optional[CorpusIndex] = None,
+        vision_encoding: ImageEncoding = PNG_ENCODING,
+    ):
+        self.backends = {TEXT: text, VISION: vision}
+        self.fallback = fallback
+        self.index = index or get_corpus_index()
+        self.vision_encoding = vision_encoding
+        self.report = RoutingReport()
+
+    def route(self, info: PdfInfo) -> str:
+        return TEXT if info.has_text_layer else VISION
+
+    def build_request(self, pdf_path: str) -> dict:
+        backend = self.backends[self.route(self.index.lookup(pdf_path))]
+        return backend.build_request(pdf_path)
+
+    def parse_response(self, response: ChatCompletion) -> dict:
+        # Both backends ask for the same tool call
+        return self.backends[TEXT].parse_response(response)
+
+    async def aextract(
+        self, runner: AsyncExtractionRunner, pdf_path: str
+    ) -> Tuple[dict, List[ChatCompletion]]:
+        report = self.report
+        if report.started_at is None:
+            report.started_at = time.perf_counter()
+        info = await asyncio.to_thread(self.index.lookup, pdf_path)
+        route = self.route(info)
+        start = time.perf_counter()
+        responses: List[ChatCompletion] = []
+        if route == TEXT:
+            result: Optional[dict] = None
+            try:
+                result, response = await runner.extract_with(
+                    self.backends[TEXT], pdf_path
+                )
+                responses.append(response)
+                problems = validate_extraction(result)
+            except Exception as e:
+                if not self.fallback:
+                    raise
+                problems = [repr(e)]
+            if result is not None and (not problems or not self.fallback):
+                report.routes[TEXT].add(time.perf_counter() - start, responses)
+                report.saved_prompt_tokens += (
+                    vision_prompt_tokens(info, self.vision_encoding)
+                    - sum(info.page_text_chars) // CHARS_PER_TOKEN
+                )
+                report.finished_at = time.perf_counter()
+                return result, responses
+            logger.info("falling back to vision", pdf_path=pdf_path, problems=problems)
+            report.fallbacks += 1
+            report.failed_text.add(time.perf_counter() - start, responses)
+            start = time.perf_counter()
+        result, response = await runner.extract_with(self.backends[VISION], pdf_path)
+        responses.append(response)
+        report.routes[VISION].add(time.perf_counter() - start, [response])
+        report.finished_at = time.perf_counter()
+        return result, responses
+
+
+def create_backend(**kwargs) -> ExtractionBackend:
+    return cast(ExtractionBackend, RoutedBackend(**kwargs))
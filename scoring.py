@@ -0,0 +1,324 @@
+import datetime
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+import numpy
+
+# Header fields compared between the extraction and the manual extraction, as paths
+# into `ExtractedInvoice.InvoiceHeaderInfo`
+HEADER_FIELDS: List[Tuple[str, ...]] = [
+    ("InvoiceNumber",),
+    ("InvoiceAmount",),
+    ("InvoiceDate",),
+    ("PurchaseOrder",),
+    ("SalesTaxAmount",),
+    ("ShippingCharges",),
+    ("VendorContactInfo", "ContactName"),
+    ("VendorContactInfo", "ContactAddress1"),
+    ("VendorContactInfo", "ContactAddress2"),
+    ("VendorContactInfo", "ContactCity"),
+    ("VendorContactInfo", "ContactState"),
+]
+LINE_ITEM_FIELDS = [
+    "ItemDescription",
+    "Quantity",
+    "UnitPrice",
+    "LineItemNetTotal",
+    "LineItemTotal",
+    "SupplierPartNum",
+    "UnitOfMeasure",
+]
+# Amounts within a cent are considered equal
+AMOUNT_TOLERANCE = 0.01
+DATE_PREFIX = re.compile(r"\d{4}-\d{2}-\d{2}")
+# Line items whose match cost (see `line_item_cost_matrix`) exceeds this are different
+# items rather than a poor extraction of the same one
+MAX_MATCH_COST = 0.5
+
+
+@dataclass
+class FieldCounts:
+    """Counts for precision and recall of one field: how often it was extracted, how
+    often the manual extraction has it, and how often the two agree."""
+
+    predicted: int = 0
+    expected: int = 0
+    correct: int = 0
+
+    @property
+    def precision(self) -> Optional[float]:
+        return self.correct / self.predicted if self.predicted else None
+
+    @property
+    def recall(self) -> Optional[float]:
+        return self.correct / self.expected if self.expected else None
+
+    def add(self, other: "FieldCounts") -> None:
+        self.predicted += other.predicted
+        self.expected += other.expected
+        self.correct += other.correct
+
+
+def _normalize(value: Any) -> Any:
+    """Maps values onto what's compared, with `None` meaning "not present". Zero amounts
+    count as not present, since that's what the schema defaults them to."""
+    if value is None:
+        return None
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()[:10]
+    if isinstance(value, (int, float)):
+        return float(value) or None
+    value = " ".join(str(value).split()).casefold()
+    if not value:
+        return None
+    # Dates are compared by day, the manual extraction has no times
+    if DATE_PREFIX.match(value):
+        return value[:10]
+    return value
+
+
+def values_match(predicted: Any, expected: Any) -> bool:
+    if isinstance(predicted, float) and isinstance(expected, float):
+        return abs(predicted - expected) <= AMOUNT_TOLERANCE
+    return predicted == expected
+
+
+def _count(counts: Dict[str, FieldCounts], name: str, predicted: Any, expected: Any):
+    predicted, expected = _normalize(predicted), _normalize(expected)
+    field_counts = counts.setdefault(name, FieldCounts())
+    field_counts.predicted += predicted is not None
+    field_counts.expected += expected is not None
+    field_counts.correct += (
+        predicted is not None
+        and expected is not None
+        and values_match(predicted, expected)
+    )
+
+
+def _get_path(d: dict, path: Tuple[str, ...]) -> Any:
+    for key in path:
+        if not isinstance(d, dict):
+            return None
+        d = d.get(key)  # pyright: ignore[reportAssignmentType]
+    return d
+
+
+def _linear_sum_assignment(cost: numpy.ndarray) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Minimum cost assignment (Hungarian algorithm with potentials), vectorized over
+    columns. Same contract as `scipy.optimize.linear_sum_assignment`."""
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    n, m = cost.shape
+    u = numpy.zeros(n + 1)
+    v = numpy.zeros(m + 1)
+    # Row assigned to each column and the previous column on the augmenting path, both
+    # 1-indexed so that column 0 is the virtual start of the path
+    row_of = numpy.zeros(m + 1, dtype=numpy.intp)
+    way = numpy.zeros(m + 1, dtype=numpy.intp)
+    for i in range(1, n + 1):
+        row_of[0] = i
+        j0 = 0
+        min_reduced = numpy.full(m + 1, numpy.inf)
+        used = numpy.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = row_of[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            improved = free & (reduced < min_reduced[1:])
+            min_reduced[1:][improved] = reduced[improved]
+            way[1:][improved] = j0
+            candidates = numpy.where(free, min_reduced[1:], numpy.inf)
+            j1 = int(numpy.argmin(candidates)) + 1
+            delta = candidates[j1 - 1]
+            u[row_of[used]] += delta
+            v[used] -= delta
+            min_reduced[~used] -= delta
+            j0 = j1
+            if row_of[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            row_of[j0] = row_of[j1]
+            j0 = j1
+    cols = numpy.flatnonzero(row_of[1:])
+    rows = row_of[1:][cols] - 1
+    if transposed:
+        rows, cols = cols, rows
+    order = numpy.argsort(rows)
+    return rows[order], cols[order]
+
+
+try:
+    from scipy.optimize import linear_sum_assignment  # pyright: ignore
+except ImportError:
+    linear_sum_assignment = _linear_sum_assignment
+
+
+def _amounts(items: List[dict], field: str) -> numpy.ndarray:
+    values = [_normalize(item.get(field)) for item in items]
+    return numpy.array(
+        [v if isinstance(v, float) else numpy.nan for v in values], dtype=float
+    )
+
+
+def _amount_cost(predicted: List[dict], expected: List[dict], field: str):
+    a = _amounts(predicted, field)[:, None]
+    b = _amounts(expected, field)[None, :]
+    diff = numpy.abs(a - b)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        relative = numpy.minimum(1.0, diff / numpy.maximum(numpy.abs(a), numpy.abs(b)))
+    cost = numpy.where(diff <= AMOUNT_TOLERANCE, 0.0, relative)
+    return cost, ~numpy.isnan(diff)
+
+
+def _exact_cost(predicted: List[dict], expected: List[dict], field: str):
+    a = numpy.array([_normalize(item.get(field)) for item in predicted], dtype=object)
+    b = numpy.array([_normalize(item.get(field)) for item in expected], dtype=object)
+    present = (a != None)[:, None] & (b != None)[None, :]  # noqa: E711
+    return (a[:, None] != b[None, :]).astype(float), present
+
+
+def _token_cost(predicted: List[dict], expected: List[dict], field: str):
+    """Jaccard distance between the word sets, via a product of word incidence
+    matrices."""
+    tokens = [
+        [set(str(_normalize(item.get(field)) or "").split()) for item in items]
+        for items in (predicted, expected)
+    ]
+    vocabulary: Dict[str, int] = {}
+    for token_sets in tokens:
+        for token_set in token_sets:
+            for token in token_set:
+                vocabulary.setdefault(token, len(vocabulary))
+    incidence = []
+    for token_sets in tokens:
+        matrix = numpy.zeros((len(token_sets), len(vocabulary)), dtype=numpy.float32)
+        for row, token_set in enumerate(token_sets):
+            matrix[row, [vocabulary[t] for t in token_set]] = 1
+        incidence.append(matrix)
+    a, b = incidence
+    intersection = a @ b.T
+    sizes_a, sizes_b = a.sum(axis=1)[:, None], b.sum(axis=1)[None, :]
+    union = sizes_a + sizes_b - intersection
+    present = (sizes_a > 0) & (sizes_b > 0)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        cost = numpy.where(present, 1.0 - intersection / union, 1.0)
+    return cost, present
+
+
+# How much each field weighs in telling whether two line items are the same item
+LINE_ITEM_MATCH_WEIGHTS = {
+    "LineItemTotal": (0.5, _amount_cost),
+    "SupplierPartNum": (0.25, _exact_cost),
+    "ItemDescription": (0.25, _token_cost),
+}
+
+
+def line_item_cost_matrix(predicted: List[dict], expected: List[dict]) -> numpy.ndarray:
+    """Pairwise dissimilarity in [0, 1] of predicted (rows) and expected (columns) line
+    items, a weighted mean over the `LINE_ITEM_MATCH_WEIGHTS` fields both items have.
+    Pairs sharing none of them cost 1."""
+    total = numpy.zeros((len(predicted), len(expected)))
+    weights = numpy.zeros_like(total)
+    for field, (weight, field_cost) in LINE_ITEM_MATCH_WEIGHTS.items():
+        cost, present = field_cost(predicted, expected, field)
+        total += numpy.where(present, weight * cost, 0.0)
+        weights += weight * present
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        return numpy.where(weights > 0, total / weights, 1.0)
+
+
+def match_line_items(
+    predicted: List[dict], expected: List[dict]
+) -> List[Tuple[int, int]]:
+    """Pairs up `(predicted index, expected index)` line items with a minimum total cost
+    assignment, independent of the order either side lists them in. Pairs costlier
+    than `MAX_MATCH_COST` are left unmatched."""
+    if not predicted or not expected:
+        return []
+    cost = line_item_cost_matrix(predicted, expected)
+    rows, cols = linear_sum_assignment(cost)
+    return [
+        (int(i), int(j)) for i, j in zip(rows, cols) if cost[i, j] <= MAX_MATCH_COST
+    ]
+
+
+def align_line_items(
+    predicted: List[dict], expected: List[dict]
+) -> List[Tuple[Optional[int], Optional[int]]]:
+    """Matched `(predicted index, expected index)` pairs, followed by the unmatched
+    items of either side paired with `None`."""
+    pairs = match_line_items(predicted, expected)
+    matched_predicted = {i for i, _ in pairs}
+    matched_expected = {j for _, j in pairs}
+    aligned: List[Tuple[Optional[int], Optional[int]]] = list(pairs)
+    aligned += [(i, None) for i in range(len(predicted)) if i not in matched_predicted]
+    aligned += [(None, j) for j in range(len(expected)) if j not in matched_expected]
+    return aligned
+
+
+def _compare_fields(
+    extracted: dict, expected: dict, aligned: List[Tuple[Optional[int], Optional[int]]]
+) -> Generator[Tuple[str, Any, Any], None, None]:
+    for path in HEADER_FIELDS:
+        yield (
+            ".".join(path),
+            _get_path(extracted.get("InvoiceHeaderInfo") or {}, path),
+            _get_path(expected.get("InvoiceHeaderInfo") or {}, path),
+        )
+    predicted_items = extracted.get("InvoiceLineItems") or []
+    expected_items = expected.get("InvoiceLineItems") or []
+    for i, j in aligned:
+        for field in LINE_ITEM_FIELDS:
+            yield (
+                f"InvoiceLineItems.{field}",
+                predicted_items[i].get(field) if i is not None else None,
+                expected_items[j].get(field) if j is not None else None,
+            )
+
+
+def compare_fields(
+    extracted: dict, expected: dict
+) -> Generator[Tuple[str, Any, Any], None, None]:
+    """Yields `(field, extracted value, expected value)` for every compared field of one
+    invoice, both in the `ExtractedInvoice.model_dump()` shape. Line items are aligned
+    with `align_line_items`, so item order doesn't matter."""
+    aligned = align_line_items(
+        extracted.get("InvoiceLineItems") or [], expected.get("InvoiceLineItems") or []
+    )
+    yield from _compare_fields(extracted, expected, aligned)
+
+
+def field_differences(extracted: dict, expected: dict) -> List[Tuple[str, Any, Any]]:
+    """The `compare_fields` entries that don't match."""
+    differences = []
+    for name, predicted, expected_value in compare_fields(extracted, expected):
+        a, b = _normalize(predicted), _normalize(expected_value)
+        if not (a is None and b is None) and (
+            a is None or b is None or not values_match(a, b)
+        ):
+            differences.append((name, predicted, expected_value))
+    return differences
+
+
+def score_invoice(extracted: dict, expected: dict) -> Dict[str, FieldCounts]:
+    """Field-level counts for one invoice. Unmatched line items count against precision
+    or recall of all their fields, and the item count itself is scored as
+    `"InvoiceLineItems"`."""
+    predicted_items = extracted.get("InvoiceLineItems") or []
+    expected_items = expected.get("InvoiceLineItems") or []
+    aligned = align_line_items(predicted_items, expected_items)
+    counts: Dict[str, FieldCounts] = {}
+    for name, predicted, expected_value in _compare_fields(
+        extracted, expected, aligned
+    ):
+        _count(counts, name, predicted, expected_value)
+    counts["InvoiceLineItems"] = FieldCounts(
+        predicted=len(predicted_items),
+        expected=len(expected_items),
+        correct=sum(i is not None and j is not None for i, j in aligned),
+    )
+    return counts
@@ -0,0 +1,263 @@
+import json
+from dataclasses import dataclass
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, Union, get_type_hints
+
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+from pydantic import TypeAdapter, ValidationError
+
+from models import InvoiceHeaderInfo, InvoiceLineItem
+
+_WHITESPACE = " \t\r\n"
+# Characters ending a number, `true`, `false` or `null`
+_SCALAR_END = ",}]" + _WHITESPACE
+
+# Keys and indices leading to a value, `None` for a key not yet read
+_Path = Tuple[Union[str, int, None], ...]
+
+_HEADER_FIELDS = {
+    name: TypeAdapter(annotation)
+    for name, annotation in get_type_hints(
+        InvoiceHeaderInfo, include_extras=True
+    ).items()
+}
+_LINE_ITEM = TypeAdapter(InvoiceLineItem)
+
+
+class HeaderField(NamedTuple):
+    name: str
+    # Validated, as it will be in the final extraction
+    value: Any
+
+
+class LineItem(NamedTuple):
+    position: int
+    # Validated, as it will be in the final extraction
+    item: dict
+
+
+class Completed(NamedTuple):
+    # The whole extraction, parsed by the backend
+    result: dict
+    response: ChatCompletion
+
+
+StreamEvent = Union[HeaderField, LineItem, Completed]
+
+
+class StreamValidationError(ValueError):
+    """A streamed field failed validation, so the extraction will fail whatever follows."""
+
+
+@dataclass(slots=True)
+class _Frame:
+    path: _Path
+    start: int
+    is_object: bool
+    key: Optional[str] = None
+    index: int = 0
+    expecting_key: bool = True
+
+
+class ExtractionStreamParser:
+    """Incrementally parses streamed `extract_invoice_info` arguments, returning each
+    `InvoiceHeaderInfo` field and `InvoiceLineItems` entry as soon as its JSON value is
+    complete. Raises `StreamValidationError` as soon as one doesn't validate.
+
+    Only the values it returns are decoded, the scan itself just tracks nesting. Text
+    is dropped once scanned unless a value still open needs it, so feeding the
+    arguments takes time linear in their length.
+    """
+
+    def __init__(self):
+        # The unconsumed arguments, which every index below is into
+        self._text = ""
+        self._pos = 0
+        self._stack: List[_Frame] = []
+        self._string_start: Optional[int] = None
+        self._string_is_key = False
+        self._escape = False
+        self._scalar_start: Optional[int] = None
+        self.line_items = 0
+
+    def _path(self) -> _Path:
+        return tuple(
+            frame.key if frame.is_object else frame.index for frame in self._stack
+        )
+
+    def _complete(
+        self,
+        path: _Path,
+        start: int,
+        end: int,
+        events: List[StreamEvent],
+    ) -> None:
+        if len(path) != 2:
+            return
+        section, name = path
+        if section == "InvoiceHeaderInfo" and isinstance(name, str):
+            adapter = _HEADER_FIELDS.get(name)
+            if adapter is None:
+                # Not part of the model, so dropped by validation anyway
+                return
+            value = json.loads(self._text[start:end])
+            try:
+                value = adapter.dump_python(adapter.validate_python(value))
+            except ValidationError as e:
+                raise StreamValidationError(f"InvoiceHeaderInfo.{name}: {e}") from e
+            events.append(HeaderField(name, value))
+        elif section == "InvoiceLineItems" and isinstance(name, int):
+            value = json.loads(self._text[start:end])
+            try:
+                item = _LINE_ITEM.dump_python(_LINE_ITEM.validate_python(value))
+            except ValidationError as e:
+                raise StreamValidationError(f"InvoiceLineItems[{name}]: {e}") from e
+            self.line_items += 1
+            events.append(LineItem(name, item))
+
+    def feed(self, chunk: str) -> List[StreamEvent]:
+        """Adds the next piece of the arguments, returning what it completed."""
+        self._text += chunk
+        text = self._text
+        events: List[StreamEvent] = []
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._string_start is not None:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    start, self._string_start = self._string_start, None
+                    if self._string_is_key:
+                        self._stack[-1].key = json.loads(text[start : i + 1])
+                    else:
+                        self._complete(self._path(), start, i + 1, events)
+                continue
+            if self._scalar_start is not None and c in _SCALAR_END:
+                start, self._scalar_start = self._scalar_start, None
+                self._complete(self._path(), start, i, events)
+            if c == '"':
+                top = self._stack[-1] if self._stack else None
+                self._string_start = i
+                self._string_is_key = (
+                    top is not None and top.is_object and top.expecting_key
+                )
+            elif c == "{" or c == "[":
+                self._stack.append(_Frame(self._path(), i, c == "{"))
+            elif c == "}" or c == "]":
+                frame = self._stack.pop()
+                self._complete(frame.path, frame.start, i + 1, events)
+            elif c == ":":
+                self._stack[-1].expecting_key = False
+            elif c == ",":
+                top = self._stack[-1]
+                if top.is_object:
+                    top.expecting_key = True
+                else:
+                    top.index += 1
+            elif c not in _WHITESPACE and self._scalar_start is None:
+                self._scalar_start = i
+        self._trim(text)
+        return events
+
+    def _trim(self, text: str) -> None:
+        # Only the values `_complete` returns and keys are sliced out of the text
+        starts = [
+            start
+            for start in (self._string_start, self._scalar_start)
+            if start is not None
+        ]
+        starts += [frame.start for frame in self._stack if len(frame.path) == 2]
+        keep = min(starts, default=len(text))
+        self._text = text[keep:]
+        self._pos = len(text) - keep
+        if self._string_start is not None:
+            self._string_start -= keep
+        if self._scalar_start is not None:
+            self._scalar_start -= keep
+        for frame in self._stack:
+            frame.start -= keep
+
+
+class ChunkAccumulator:
+    """Reassembles streamed chunks into the `ChatCompletion` the request would have
+    returned without streaming, e.g., for `parse_response` and the response cache."""
+
+    def __init__(self):
+        self.id = ""
+        self.model = ""
+        self.created = 0
+        self.content: List[str] = []
+        self.tool_calls: Dict[int, dict] = {}
+        self.finish_reason: Optional[str] = None
+        self.usage: Optional[dict] = None
+
+    def add(self, chunk: ChatCompletionChunk) -> str:
+        """Adds a chunk, returning what it added to the first tool call's arguments."""
+        self.id, self.model, self.created = chunk.id, chunk.model, chunk.created
+        if chunk.usage is not None:
+            self.usage = chunk.usage.model_dump()
+        arguments = ""
+        for choice in chunk.choices:
+            if choice.index != 0:
+                continue
+            if choice.finish_reason is not None:
+                self.finish_reason = choice.finish_reason
+            if choice.delta.content:
+                self.content.append(choice.delta.content)
+            for delta in choice.delta.tool_calls or []:
+                call = self.tool_calls.setdefault(
+                    delta.index,
+                    {"id": "", "type": "function", "name": "", "arguments": []},
+                )
+                if delta.id:
+                    call["id"] = delta.id
+                if delta.function is not None:
+                    if delta.function.name:
+                        call["name"] += delta.function.name
+                    if delta.function.arguments:
+                        call["arguments"].append(delta.function.arguments)
+                        if delta.index == 0:
+                            arguments += delta.function.arguments
+        return arguments
+
+    def completion(self) -> ChatCompletion:
+        tool_calls = [
+            {
+                "id": call["id"],
+                "type": "function",
+                "function": {
+                    "name": call["name"],
+                    "arguments": "".join(call["arguments"]),
+                },
+            }
+            for _, call in sorted(self.tool_calls.items())
+        ]
+        return ChatCompletion.model_validate(
+            {
+                "id": self.id,
+                "object": "chat.completion",
+                "created": self.created,
+                "model": self.model,
+                "choices": [
+                    {
+                        "index": 0,
+                        "finish_reason": self.finish_reason or "stop",
+                        "message": {
+                            "role": "assistant",
+                            "content": "".join(self.content) or None,
+                            "tool_calls": tool_calls or None,
+                        },
+                    }
+                ],
+                "usage": self.usage,
+            }
+        )
+
+
+def tool_arguments(response: ChatCompletion) -> str:
+    """The first tool call's arguments, e.g., to replay a cached response."""
+    message = response.choices[0].message
+    if not message.tool_calls:
+        return ""
+    return message.tool_calls[0].function.arguments  # pyright: ignore
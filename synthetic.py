@@ -0,0 +1,206 @@
+import json
+import os
+import random
+from typing import Dict, List, Tuple
+
+import pymupdf
+
+from models import InvoiceDenormalized
+
+
+def make_manifest_rows(
+    num_invoices: int, max_line_items: int = 5, seed: int = 0
+) -> List[dict]:
+    """Generate rows shaped like the Infinx manual extraction export, i.e., one
+    denormalized row per line item with the invoice header repeated on each."""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(num_invoices):
+        og_msg_item_id = str(100_000_000 + i)
+        header = {
+            "CompanyId": 1,
+            "ReturnedInvoiceId": 30_000_000 + i,
+            "returnedMessageItemId": 200_000_000 + i,
+            "returnedDocumentId": 300_000_000 + i,
+            "ReturnedMessageItemFileName": f"invoice_{i}.pdf",
+            "OriginalMessageItemId": og_msg_item_id,
+            "ReturnedMessageId": 400_000_000 + i,
+            "ReturnedMessageCreatedTime": "2024-06-03T00:00:00",
+            "VendorName": f"VENDOR {i % 97}",
+            "VendorNumber": f"V{i % 97:05d}",
+            "InfinxInvoiceNumber": f"INV-{i:07d}",
+            "InfinxInvoiceAmount": 0.0,
+            "InfinxInvoiceDate": "2024-06-01T00:00:00",
+            "InfinxVendorNumber": f"V{i % 97:05d}",
+            "InfinxPurchaseOrder": f"PO{i:06d}",
+            "SalesOrderNumber": f"SO{i:06d}",
+            "SalesOrderDate": None,
+            "DueDate": "2024-07-01T00:00:00",
+            "SalesTaxPercent": 0.0,
+            "SalesTaxAmount": 0.0,
+            "MiscCharges": 0.0,
+            "DeliveryDate": None,
+            "ShipDate": None,
+            "ShippingCharges": 0.0,
+            "PurchaseOrderNum": f"PO{i:06d}",
+            "PurchaseOrderLineNum": "",
+            "TaxPercent": 0.0,
+            "TaxAmount": 0.0,
+            "MiscAmount": 0.0,
+            "MiscInfo": "",
+            "MiscInfoXML": None,
+            "ContactType": 1,
+            "ContactType_US": "Remit To",
+            "ContactName": f"Vendor {i % 97}",
+            "ContactAddress1": f"{rng.randint(1, 9999)} Main St",
+            "ContactAddress2": "",
+            "ContactCity": "Springfield",
+            "ContactState": "IL",
+        }
+        line_items = []
+        for j in range(rng.randint(1, max_line_items)):
+            quantity = float(rng.randint(1, 20))
+            unit_price = round(rng.uniform(1, 500), 2)
+            total = round(quantity * unit_price, 2)
+            line_items.append(
+                {
+                    "SupplierPartNum": f"P-{rng.randint(0, 99999):05d}",
+                    "ItemDescription": f"Widget {rng.randint(0, 999)} model {j}",
+                    "UnitOfMeasure": "EA",
+                    "UnitPrice": unit_price,
+                    "Quantity": quantity,
+                    "LineItemNetTotal": total,
+                    "LineItemTotal": total,
+                }
+            )
+        header["InfinxInvoiceAmount"] = round(
+            sum(l["LineItemTotal"] for l in line_items), 2
+        )
+        for line_item in line_items:
+            row = {**header, **line_item}
+            # Keep the same column order as the export
+            rows.append(
+                {name: row[name] for name in InvoiceDenormalized.get_column_names()}
+            )
+    return rows
+
+
+def write_manifest(rows: List[dict], path: str) -> None:
+    with open(path, "w") as f:
+        json.dump(rows, f)
+
+
+def make_pdf_tree(
+    root: str, og_msg_item_ids: List[str], num_missing: int = 0
+) -> Tuple[List[str], List[str]]:
+    """Lay out placeholder files like `2024-06-20_AI_Testing_3/<msg id>/<item id>/<file>`.
+
+    `num_missing` extra item ids are created which don't appear in the manifest.
+    Returns the created file paths and the ids of the missing items.
+    """
+    missing_ids = [str(900_000_000 + i) for i in range(num_missing)]
+    file_paths = []
+    for i, og_msg_item_id in enumerate([*og_msg_item_ids, *missing_ids]):
+        item_dir = os.path.join(root, str(500_000_000 + i), og_msg_item_id)
+        os.makedirs(item_dir, exist_ok=True)
+        file_path = os.path.join(item_dir, f"invoice_{og_msg_item_id}.pdf")
+        open(file_path, "wb").close()
+        file_paths.append(file_path)
+    return file_paths, missing_ids
+
+
+def invoice_document(rows: List[dict], lines_per_page: int = 40) -> pymupdf.Document:
+    """Lays out the rows of one invoice (see `make_manifest_rows`) as a text PDF."""
+    header = rows[0]
+    doc = pymupdf.Document()
+    page = doc.new_page(width=612, height=792)  # Letter size
+    y = 72
+    for text in [
+        header["ContactName"],
+        header["ContactAddress1"],
+        f"{header['ContactCity']}, {header['ContactState']}",
+        "",
+        f"INVOICE # {header['InfinxInvoiceNumber']}",
+        f"Invoice Date: {header['InfinxInvoiceDate'][:10]}",
+        f"PO: {header['InfinxPurchaseOrder']}",
+        "",
+        f"{'Part':<10} {'Description':<32} {'Qty':>6} {'Price':>10} {'Total':>10}",
+    ]:
+        page.insert_text((54, y), text, fontname="cour", fontsize=9)
+        y += 12
+    for i, row in enumerate(rows):
+        if i and i % lines_per_page == 0:
+            page = doc.new_page(width=612, height=792)
+            y = 72
+        page.insert_text(
+            (54, y),
+            f"{row['SupplierPartNum']:<10} {row['ItemDescription'][:32]:<32} "
+            f"{row['Quantity']:>6.0f} {row['UnitPrice']:>10.2f} {row['LineItemTotal']:>10.2f}",
+            fontname="cour",
+            fontsize=9,
+        )
+        y += 14
+    page.insert_text(
+        (54, y + 12),
+        f"{'TOTAL':<50} {header['InfinxInvoiceAmount']:>20.2f}",
+        fontname="cour",
+        fontsize=9,
+    )
+    return doc
+
+
+def scanned_document(doc: pymupdf.Document, dpi: int = 150) -> pymupdf.Document:
+    """`doc` with each page replaced by a grayscale image of it and no text layer, like
+    a scanned paper invoice."""
+    scanned = pymupdf.Document()
+    for page in doc:
+        pix = page.get_pixmap(dpi=dpi, colorspace=pymupdf.csGRAY)
+        scanned_page = scanned.new_page(width=page.rect.width, height=page.rect.height)
+        scanned_page.insert_image(scanned_page.rect, pixmap=pix)
+    return scanned
+
+
+def write_invoice_pdf(
+    path: str, rows: List[dict], lines_per_page: int = 40, scanned: bool = False
+) -> None:
+    """Renders the rows of one invoice (see `make_manifest_rows`) as a text PDF, or as
+    a scanned one without a text layer."""
+    with invoice_document(rows, lines_per_page) as doc:
+        if scanned:
+            with scanned_document(doc) as scanned_doc:
+                scanned_doc.save(path, deflate=True)
+        else:
+            doc.save(path)
+
+
+def make_corpus(
+    root: str,
+    num_invoices: int,
+    max_line_items: int = 40,
+    scanned_fraction: float = 0.3,
+    seed: int = 0,
+) -> Tuple[str, str]:
+    """Writes a manifest and a PDF folder laid out like the real ones under `root`,
+    with an actual invoice PDF for each manifest invoice. Page counts vary from one to
+    over ten, and `scanned_fraction` of the PDFs have no text layer.
+
+    Returns the manifest path and the PDF folder.
+    """
+    rng = random.Random(seed)
+    rows = make_manifest_rows(num_invoices, max_line_items=max_line_items, seed=seed)
+    manifest_path = os.path.join(root, "manifest.json")
+    pdfs_dir = os.path.join(root, "pdfs")
+    write_manifest(rows, manifest_path)
+    rows_by_id: Dict[str, List[dict]] = {}
+    for row in rows:
+        rows_by_id.setdefault(row["OriginalMessageItemId"], []).append(row)
+    ids = sorted(rows_by_id)
+    file_paths, _ = make_pdf_tree(pdfs_dir, ids)
+    for og_msg_item_id, file_path in zip(ids, file_paths):
+        write_invoice_pdf(
+            file_path,
+            rows_by_id[og_msg_item_id],
+            lines_per_page=rng.choice([4, 20, 40]),
+            scanned=rng.random() < scanned_fraction,
+        )
+    return manifest_path, pdfs_dir
@@ -0,0 +1,171 @@
+import json
+from typing import Any, Dict, List, Union, cast
+
+import structlog
+from openai.types.chat import ChatCompletion
+from pydantic import TypeAdapter
+
+from instrumentation import VALIDATE, stage
+from models import ExtractedInvoice
+
+logger = structlog.stdlib.get_logger()
+
+MODEL = "gpt-4o-2024-05-13"
+TOOL_NAME = "extract_invoice_info"
+SYSTEM_PROMPT = (
+    "You are an accounts payable clerk."
+    + " You extract information from submitted PDF invoices and call the provided function."
+    + " Unless otherwise instructured, preserve the case and formatting as is from the PDF."
+    + " It is okay to leave fields blank if you don't know."
+)
+INSTRUCTION = "Generate a data object from this PDF"
+# Only document the pydantic model, and cost prompt tokens on every request
+_OMITTED_KEYS = {"title", "default"}
+
+
+def _inline(schema: Any, defs: Dict[str, dict]) -> Any:
+    """`schema` with `$ref`s replaced by the definitions they point to, since not every
+    function calling implementation resolves them, and without `_OMITTED_KEYS`."""
+    if isinstance(schema, list):
+        return [_inline(s, defs) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if "$ref" in schema:
+        ref = schema["$ref"].removeprefix("#/$defs/")
+        siblings = {k: v for k, v in schema.items() if k != "$ref"}
+        return _inline({**defs[ref], **siblings}, defs)
+    inlined = {}
+    for key, value in schema.items():
+        if key in _OMITTED_KEYS or key == "$defs":
+            continue
+        if key == "properties":
+            # Keys here are field names, not schema keywords
+            inlined[key] = {name: _inline(s, defs) for name, s in value.items()}
+        else:
+            inlined[key] = _inline(value, defs)
+    return inlined
+
+
+def tool_parameters() -> dict:
+    """JSON schema of the `extract_invoice_info` arguments, generated from
+    `ExtractedInvoice` so the tool always matches what `parse_response` validates."""
+    schema = ExtractedInvoice.model_json_schema()
+    return _inline(schema, schema.get("$defs", {}))
+
+
+# Built once and shared by every request, so the static prefix of the prompt (tools,
+# system message and instruction) serializes byte-identically each time and the
+# provider's prompt caching can reuse it. Don't mutate these.
+TOOLS: List[dict] = [
+    {
+        "type": "function",
+        "function": {"name": TOOL_NAME, "parameters": tool_parameters()},
+    }
+]
+TOOL_CHOICE = {"type": "function", "function": {"name": TOOL_NAME}}
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+INSTRUCTION_PART = {"type": "text", "text": INSTRUCTION}
+TOOLS_JSON = json.dumps(TOOLS)
+
+
+def build_request(content: List[dict]) -> dict:
+    """Keyword arguments for `chat.completions.create` asking for an
+    `extract_invoice_info` call on the user message `content` (the PDF as text or
+    images), which follows the shared prefix."""
+    return dict(
+        model=MODEL,
+        messages=[
+            SYSTEM_MESSAGE,
+            {"role": "user", "content": [INSTRUCTION_PART, *content]},
+        ],
+        tool_choice=TOOL_CHOICE,
+        tools=TOOLS,
+    )
+
+
+# `parse_responses` validates small responses in groups of up to this many bytes of
+# arguments. Per call overhead dominates for those, while larger groups of big
+# responses only add garbage collection work, measured with `bench_validation.py`
+BULK_VALIDATE_MAX_BYTES = 64 * 1024
+_EXTRACTIONS = TypeAdapter(List[ExtractedInvoice])
+
+
+def _arguments(response: ChatCompletion) -> str:
+    return (
+        response.choices[0]  # pyright: ignore[reportOptionalSubscript]
+        .message.tool_calls[0]  # pyright: ignore[reportOptionalSubscript]
+        .function.arguments  # pyright: ignore[reportAttributeAccessIssue]
+    )
+
+
+def _validate(arguments: str) -> Union[dict, Exception]:
+    # Validating the JSON directly skips building the intermediate dicts and lists
+    try:
+        return ExtractedInvoice.model_validate_json(arguments).model_dump()
+    except ValueError as e:
+        return e
+
+
+def _validate_group(arguments: List[str]) -> List[Union[dict, Exception]]:
+    if len(arguments) == 1:
+        return [_validate(arguments[0])]
+    try:
+        extractions = _EXTRACTIONS.dump_python(
+            _EXTRACTIONS.validate_json("[" + ",".join(arguments) + "]")
+        )
+        if len(extractions) == len(arguments):
+            return extractions
+    except ValueError:
+        pass
+    # Some failed (or weren't a single JSON value), so find out which
+    return [_validate(a) for a in arguments]
+
+
+def parse_response(response: ChatCompletion) -> dict:
+    """The validated `extract_invoice_info` arguments of `response`, as a dict."""
+    logger.info(
+        "model response for extract_invoice_info",
+        llm_usage=response.usage.model_dump(),  # pyright: ignore[reportOptionalMemberAccess]
+    )
+    arguments = _arguments(response)
+    with stage(VALIDATE) as sample:
+        sample.bytes = len(arguments)
+        result = _validate(arguments)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def parse_responses(responses: List[ChatCompletion]) -> List[Union[dict, Exception]]:
+    """`parse_response` for many responses at once, e.g., a finished batch, with the
+    exception instead of the result for the ones which fail."""
+    logger.info("model responses for extract_invoice_info", responses=len(responses))
+    results: List[Union[dict, Exception, None]] = [None] * len(responses)
+    group: List[int] = []
+    group_arguments: List[str] = []
+
+    def validate_group():
+        with stage(VALIDATE) as sample:
+            sample.bytes = sum(len(a) for a in group_arguments)
+            for i, result in zip(group, _validate_group(group_arguments)):
+                results[i] = result
+        group.clear()
+        group_arguments.clear()
+
+    group_bytes = 0
+    for i, response in enumerate(responses):
+        try:
+            arguments = _arguments(response)
+        except Exception as e:
+            # No tool call to validate
+            results[i] = e
+            continue
+        if group and group_bytes + len(arguments) > BULK_VALIDATE_MAX_BYTES:
+            validate_group()
+            group_bytes = 0
+        group.append(i)
+        group_arguments.append(arguments)
+        group_bytes += len(arguments)
+    if group:
+        validate_group()
+    return cast(List[Union[dict, Exception]], results)